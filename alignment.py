@@ -0,0 +1,181 @@
+# alignment of fixations to transcription sentences.
+# A fixation belongs to the first sentence that ends after it does, never
+# going back to an earlier sentence than the previous fixation's. Fixations
+# starting before the first sentence, before any fixation was assigned past
+# it, go to _pre_transcript. Fixations ending after the last sentence go to
+# _post_transcript, and also stay in the last sentence.
+# Fixations with negative coordinates are ignored.
+# Everything is computed with np.searchsorted and cumulative operations over
+# arrays, for one sample or for many concatenated ones.
+
+import numpy as np
+
+
+def parse_timed_sentences(transcription, tokens):
+    """splits :param transcription: into period separated sentences, timed
+    by :param tokens:, the rows of timestamps_transcription.csv.
+    returns a list of {'start_t', 'end_t', 'sentence'}"""
+    sentences = [sentence.strip(' \n')
+                 for sentence in transcription.split('.')
+                 if sentence != '']
+    if len(tokens) == 0:
+        return []
+    words = np.asarray([token['word'] for token in tokens])
+    starts = np.asarray([token['timestamp_start_word'] for token in tokens], dtype=float)
+    ends = np.asarray([token['timestamp_end_word'] for token in tokens], dtype=float)
+
+    dots = np.flatnonzero(words == '.')
+    first = np.concatenate([[0], dots[:-1] + 1])
+    # a sentence ends with the word before its period, or the period itself
+    # if there's nothing else in it
+    last = np.where(dots > first, dots - 1, dots)
+    return [{'start_t': starts[f].item(),
+             'end_t': ends[l].item(),
+             'sentence': sentences[i]}
+            for i, (f, l) in enumerate(zip(first, last))]
+
+
+def fixation_arrays(fixations):
+    """returns start, end, x and y arrays of a record array or list of dicts"""
+    if len(fixations) == 0:
+        return tuple(np.zeros(0) for _ in range(4))
+    if isinstance(fixations, np.ndarray):
+        fixations = fixations.view(np.ndarray)
+        return tuple(np.asarray(fixations[name], dtype=float)
+                     for name in ['timestamp_start_fixation',
+                                  'timestamp_end_fixation',
+                                  'x_position',
+                                  'y_position'])
+    return tuple(np.asarray([f[name] for f in fixations], dtype=float)
+                 for name in ['timestamp_start_fixation',
+                              'timestamp_end_fixation',
+                              'x_position',
+                              'y_position'])
+
+
+def assign_fixations(group, starts, ends, xs, ys, sentence_group, sentence_starts, sentence_ends):
+    """assigns fixations of many samples at once.
+    :param group: sample number of each fixation, non decreasing
+    :param sentence_group: sample number of each sentence, non decreasing.
+    Every sample with fixations must have at least one sentence, and each
+    sample's sentence_ends must be sorted.
+    returns (sentence, pre, post): the global index of the sentence each
+    fixation belongs to, -1 if none, and masks of pre and post transcript
+    fixations"""
+    n_groups = max(group.max(initial=-1), sentence_group.max(initial=-1)) + 1
+    n_sentences = np.bincount(sentence_group, minlength=n_groups)
+    offsets = np.concatenate([[0], np.cumsum(n_sentences)])
+
+    # searchsorted over every sample at once, on keys ordered by sample then time
+    times = np.concatenate([ends, sentence_ends])
+    t0 = times.min(initial=0)
+    span = times.max(initial=0) - t0 + 1
+    k = np.searchsorted(sentence_group * span + (sentence_ends - t0),
+                        group * span + (ends - t0),
+                        side='left')
+    first = offsets[group]
+    last = offsets[group + 1] - 1
+    k = np.minimum(k, last)
+
+    valid = (xs >= 0) & (ys >= 0)
+    before_first = starts < sentence_starts[first]
+    # fixations can only be pre transcript until one moves past the first sentence
+    moves_on = valid & ~before_first & (k > first)
+    # how many fixations moved on before each one, within its sample
+    moved_on = np.cumsum(moves_on) - moves_on
+    moved_on = moved_on - moved_on[np.searchsorted(group, group, side='left')]
+    pre = valid & before_first & (moved_on == 0)
+
+    assigned = valid & ~pre
+    sentence = np.maximum.accumulate(np.where(assigned, k, first))
+    post = assigned & (ends > sentence_ends[last])
+    sentence = np.where(assigned, sentence, -1)
+    return sentence, pre, post
+
+
+def build_timed_sentences(timed_sentences, fixations, sentence, pre, post):
+    """adds fixations to the sentences of a single sample, given
+    assign_fixations' results relative to it.
+    returns (timed sentences, indices), indices being, for each sentence, the
+    index array of its fixations"""
+    timed_sentences = [dict(s) for s in timed_sentences]
+    indices = [np.zeros(0, dtype=int) for _ in timed_sentences]
+    if len(fixations) == 0:
+        return timed_sentences, indices
+    if isinstance(fixations, np.ndarray):
+        # plain ndarray indexing, recarray's is much slower
+        base = fixations.view(np.ndarray)
+        select = lambda idx: base[idx].view(type(fixations))
+    else:
+        base = np.empty(len(fixations), dtype=object)
+        base[:] = fixations
+        select = lambda idx: list(base[idx])
+
+    assigned = np.flatnonzero(sentence >= 0)
+    # sentences of assigned fixations are non decreasing
+    bounds = np.searchsorted(sentence[assigned], np.arange(len(timed_sentences) + 1))
+    for i, s in enumerate(timed_sentences):
+        if bounds[i + 1] > bounds[i]:
+            indices[i] = assigned[bounds[i]:bounds[i + 1]]
+            s['fixations'] = select(indices[i])
+
+    pre_idx = np.flatnonzero(pre)
+    if len(pre_idx) > 0:
+        pre_fixations = select(pre_idx)
+        timed_sentences.insert(0, {'start_t': pre_fixations[0]['timestamp_start_fixation'],
+                                   'end_t': pre_fixations[-1]['timestamp_end_fixation'],
+                                   'sentence': '_pre_transcript',
+                                   'fixations': pre_fixations})
+        indices.insert(0, pre_idx)
+
+    post_idx = np.flatnonzero(post)
+    if len(post_idx) > 0:
+        post_fixations = select(post_idx)
+        timed_sentences.append({'start_t': post_fixations[0]['timestamp_start_fixation'],
+                                'end_t': post_fixations[-1]['timestamp_end_fixation'],
+                                'sentence': '_post_transcript',
+                                'fixations': post_fixations})
+        indices.append(post_idx)
+    return timed_sentences, indices
+
+
+def align_batch(samples, return_indices=False):
+    """aligns many samples at once.
+    :param samples: list of (timed_sentences, fixations), as returned by
+    parse_timed_sentences and ReflacxSample.get_fixations
+    returns a list of timed sentences with their fixations, as
+    ReflacxSample.get_timed_sentences. If :param return_indices:, a list of
+    (timed sentences, indices), see build_timed_sentences"""
+    arrays = [fixation_arrays(fixations) for _, fixations in samples]
+    # samples without sentences get no fixations
+    usable = [len(sentences) > 0 for sentences, _ in samples]
+    counts = np.array([len(a[0]) if ok else 0 for a, ok in zip(arrays, usable)], dtype=int)
+    n_sentences = np.array([len(s) if ok else 0 for (s, _), ok in zip(samples, usable)], dtype=int)
+
+    group = np.repeat(np.arange(len(samples)), counts)
+    starts, ends, xs, ys = (np.concatenate([a[i] for a, ok in zip(arrays, usable) if ok] + [np.zeros(0)])
+                            for i in range(4))
+    sentence_group = np.repeat(np.arange(len(samples)), n_sentences)
+    sentence_starts = np.array([s['start_t'] for (sentences, _), ok in zip(samples, usable) if ok for s in sentences], dtype=float)
+    sentence_ends = np.array([s['end_t'] for (sentences, _), ok in zip(samples, usable) if ok for s in sentences], dtype=float)
+
+    sentence, pre, post = assign_fixations(group, starts, ends, xs, ys,
+                                           sentence_group, sentence_starts, sentence_ends)
+
+    results = []
+    fix_offsets = np.concatenate([[0], np.cumsum(counts)])
+    sentence_offsets = np.concatenate([[0], np.cumsum(n_sentences)])
+    for i, (timed_sentences, fixations) in enumerate(samples):
+        if not usable[i]:
+            result = ([], [])
+        else:
+            a, b = fix_offsets[i], fix_offsets[i + 1]
+            local = np.where(sentence[a:b] >= 0, sentence[a:b] - sentence_offsets[i], -1)
+            result = build_timed_sentences(timed_sentences, fixations, local, pre[a:b], post[a:b])
+        results.append(result if return_indices else result[0])
+    return results
+
+
+def align_fixations(timed_sentences, fixations, return_indices=False):
+    """aligns a single sample's fixations, see align_batch"""
+    return align_batch([(timed_sentences, fixations)], return_indices)[0]
@@ -0,0 +1,122 @@
+# batched iteration over Metadata samples, see Metadata.iter_split.
+# Batches are loaded by a thread or process pool, a bounded number of them
+# ahead of the consumer, and yielded in order, so an epoch is the same for a
+# given seed whatever the number of workers.
+# Each batch is a dict of field: values, values being stacked into a single
+# array when they all have the same shape and a list otherwise. Fixations
+# are always a list of record arrays.
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from instrumentation import instrumented
+
+FIELDS = {'index': lambda sample, i, size: i,
+          'reflacx_id': lambda sample, i, size: sample.reflacx_id,
+          'dicom_id': lambda sample, i, size: sample.dicom_id,
+          'img': lambda sample, i, size: sample.get_dicom_img(copy=True, size=size),
+          'chest_img': lambda sample, i, size: sample.get_cropped_chest_img(size=size),
+          'heatmap': lambda sample, i, size: np.array(sample.get_heatmap(size=size)),
+          'chest_heatmap': lambda sample, i, size: sample.get_heatmap(chest_only=True, size=size),
+          'fixations': lambda sample, i, size: sample.get_fixations()}
+RAGGED_FIELDS = {'fixations'}
+
+
+def epoch_indices(indices, shuffle=True, seed=0, epoch=0, rank=0, world_size=1):
+    """returns this rank's share of an epoch's :param indices:.
+    The order depends only on :param seed: and :param epoch:. Every rank
+    gets as many indices, the first ones being repeated if needed"""
+    assert 0 <= rank < world_size
+    indices = np.asarray(indices, dtype=int)
+    if shuffle:
+        indices = np.random.default_rng((seed, epoch)).permutation(indices)
+    if len(indices) % world_size != 0:
+        pad = world_size - len(indices) % world_size
+        indices = np.concatenate([indices, np.resize(indices, pad)])
+    return indices[rank::world_size]
+
+
+def collate(values):
+    if (len(values) > 0
+        and all(isinstance(v, np.ndarray) for v in values)
+        and len({(v.shape, v.dtype) for v in values}) == 1):
+        return np.stack(values)
+    if all(isinstance(v, (int, np.integer)) for v in values):
+        return np.array(values, dtype=int)
+    return list(values)
+
+
+@instrumented('batch_loader.load_batch')
+def load_batch(metadata, indices, fields, size=None):
+    samples = [metadata[i] for i in indices]
+    result = {}
+    for field in fields:
+        values = [FIELDS[field](sample, i, size) for sample, i in zip(samples, indices)]
+        result[field] = values if field in RAGGED_FIELDS else collate(values)
+    return result
+
+
+_worker_metadata = None
+
+
+def init_worker_metadata(init_kwargs):
+    """process pool initializer opening the worker's own Metadata, from the
+    init_kwargs of the parent's"""
+    global _worker_metadata
+    from metadata import Metadata
+    _worker_metadata = Metadata(**init_kwargs)
+
+
+def worker_metadata():
+    return _worker_metadata
+
+
+def _load_batch_in_worker(indices, fields, size):
+    return load_batch(_worker_metadata, indices, fields, size)
+
+
+def iter_batches(metadata, indices, batch_size=32, fields=('img', 'heatmap', 'fixations'),
+                 size=None, workers=4, prefetch=8, executor='thread', drop_last=False):
+    """yields the batches of :param indices:, in order.
+    :param size: optional (width, height) images and heatmaps are read at
+    :param executor: 'thread', or 'process', in which case every worker
+    opens its own Metadata, with the same arguments as :param metadata:.
+    Use a sqlite backend and shared_imgs, so they don't each load the
+    metadata and cache their own images
+    :param prefetch: how many batches are loaded ahead, at least workers"""
+    for field in fields:
+        if field not in FIELDS:
+            raise ValueError("unknown field {}, expected one of {}".format(field, list(FIELDS)))
+    batches = [[int(i) for i in indices[start:start + batch_size]]
+               for start in range(0, len(indices), batch_size)]
+    if drop_last and len(batches) > 0 and len(batches[-1]) < batch_size:
+        batches.pop()
+
+    if executor == 'thread':
+        pool = ThreadPoolExecutor(max_workers=workers)
+        submit = lambda batch: pool.submit(load_batch, metadata, batch, fields, size)
+    elif executor == 'process':
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=workers,
+                                   initializer=init_worker_metadata,
+                                   initargs=(metadata.init_kwargs,))
+        submit = lambda batch: pool.submit(_load_batch_in_worker, batch, fields, size)
+    else:
+        raise ValueError("unknown executor {}".format(executor))
+
+    pending = deque()
+    batches = iter(batches)
+    try:
+        while True:
+            while len(pending) < max(prefetch, workers):
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                pending.append(submit(batch))
+            if len(pending) == 0:
+                return
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
@@ -0,0 +1,377 @@
+# benchmarks of the main operations on REFLACX data, real or synthetic.
+# Each benchmark runs in a fresh process, so they don't warm each other's
+# caches and each one's peak RSS is its own. Timings are reported as
+# latency percentiles of single calls and as throughput, in items (samples,
+# images) per second.
+# Results can be saved as a JSON baseline, and later runs compared to one,
+# benchmarks whose median latency grew by more than --tolerance being
+# reported as regressions.
+# import_metadata times `import metadata` in a new interpreter, and warns if
+# it loaded any of the heavy dependencies that should load on first use.
+#
+# usage: python benchmark.py <work_dir> --images 50 --save baseline.json
+# benchmarks a synthetic dataset written to <work_dir>/data, see synthetic_data.py
+# usage: python benchmark.py <work_dir> --reflacx-dir <reflacx_dir> --mimic-dir <mimic_dir> --compare baseline.json
+# benchmarks a real one, comparing it to a baseline
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import psutil
+
+BENCHMARKS = ['import_metadata', 'metadata_cold', 'metadata_warm', 'dicom_miss', 'dicom_hit', 'create_heatmap',
+              'timed_sentences', 'timed_sentences_batch', 'render_fixations', 'render_ellipses',
+              'iter_split', 'prefetch']
+
+
+# loaded on first use, not by importing metadata
+HEAVY_MODULES = ['pandas', 'scipy', 'cv2', 'matplotlib', 'pydicom', 'psutil']
+IMPORT_PROBE = '''import sys, time
+start = time.perf_counter()
+import {}
+print(time.perf_counter() - start)
+print(' '.join(m for m in {!r} if m in sys.modules))'''
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        # no getrusage on windows, the current RSS is the best there is
+        return psutil.Process().memory_info().rss / 2**20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def timed(fn, *args, **kwargs):
+    """returns (seconds, result) of a call"""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def summarize(seconds, items):
+    """latency percentiles in ms of calls that took :param seconds: and
+    the throughput of the :param items: they handled"""
+    ms = np.asarray(seconds, dtype=np.float64) * 1000
+    return {'calls': len(ms),
+            'items': int(np.sum(items)),
+            'mean_ms': float(np.mean(ms)),
+            'p50_ms': float(np.percentile(ms, 50)),
+            'p90_ms': float(np.percentile(ms, 90)),
+            'p99_ms': float(np.percentile(ms, 99)),
+            'max_ms': float(np.max(ms)),
+            'items_per_s': float(np.sum(items) / max(np.sum(seconds), 1e-12))}
+
+
+def open_metadata(config, full_meta_path=None):
+    from metadata import Metadata
+    return Metadata(config['reflacx_dir'],
+                    config['mimic_dir'],
+                    full_meta_path or config['full_meta_path'],
+                    backend=config['backend'],
+                    pixel_cache_dir=config['pixel_cache_dir'],
+                    tables_dir=config['tables_dir'])
+
+
+def sample_indices(metadata, config):
+    return list(range(min(config['samples'], len(metadata))))
+
+
+def import_time(module, heavy=HEAVY_MODULES):
+    """returns (seconds, heavy modules loaded) of importing :param module:
+    in a new interpreter"""
+    env = dict(os.environ)
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    env['PYTHONPATH'] = os.pathsep.join([package_dir] + [p for p in [env.get('PYTHONPATH')] if p])
+    output = subprocess.run([sys.executable, '-c', IMPORT_PROBE.format(module, heavy)],
+                            env=env, check=True, capture_output=True, text=True).stdout.split('\n')
+    return float(output[0]), output[1].split()
+
+
+def bench_import_metadata(config):
+    calls = []
+    for _ in range(config['repeats']):
+        seconds, loaded = import_time('metadata')
+        if len(loaded) > 0:
+            print("importing metadata loaded {}".format(', '.join(loaded)))
+        calls.append((seconds, 1))
+    return calls
+
+
+def bench_metadata_cold(config):
+    calls = []
+    for r in range(config['repeats']):
+        meta_dir = os.path.join(config['work_dir'], 'cold')
+        shutil.rmtree(meta_dir, ignore_errors=True)
+        os.makedirs(meta_dir)
+        calls.append((timed(open_metadata, config, os.path.join(meta_dir, 'full_meta.json'))[0], 1))
+    shutil.rmtree(os.path.join(config['work_dir'], 'cold'), ignore_errors=True)
+    return calls
+
+
+def bench_metadata_warm(config):
+    return [(timed(open_metadata, config)[0], 1) for _ in range(config['repeats'])]
+
+
+def dicom_paths(config):
+    metadata = open_metadata(config)
+    return [(dicom_id, metadata[i].data['image'])
+            for dicom_id, i in {metadata[i].dicom_id: i
+                                for i in sample_indices(metadata, config)}.items()]
+
+
+def bench_dicom_miss(config):
+    from dicom_imgs import DicomImgs
+    paths = dicom_paths(config)
+    calls = []
+    for _ in range(config['repeats']):
+        for dicom_id, imgpath in paths:
+            # a new library each time, so images are decoded, or read from
+            # the pixel cache
+            imgs_lib = DicomImgs(cache_dir=config['pixel_cache_dir'])
+            calls.append((timed(imgs_lib.get_dicom_img, dicom_id, imgpath)[0], 1))
+    return calls
+
+
+def bench_dicom_hit(config):
+    from dicom_imgs import DicomImgs
+    paths = dicom_paths(config)
+    imgs_lib = DicomImgs(cache_dir=config['pixel_cache_dir'])
+    for dicom_id, imgpath in paths:
+        imgs_lib.get_dicom_img(dicom_id, imgpath)
+    return [(timed(imgs_lib.get_dicom_img, dicom_id, imgpath, copy=True)[0], 1)
+            for _ in range(config['repeats'])
+            for dicom_id, imgpath in paths]
+
+
+def bench_create_heatmap(config):
+    from generate_heatmaps import create_heatmap
+    metadata = open_metadata(config)
+    jobs = []
+    for i in sample_indices(metadata, config):
+        sample = metadata[i]
+        if len(sample.get_fixations()) > 0:
+            jobs.append((sample.get_fixations(as_dicts=True),
+                         int(float(sample.data['image_size_x'])),
+                         int(float(sample.data['image_size_y']))))
+    return [(timed(create_heatmap, *job)[0], 1)
+            for _ in range(config['repeats'])
+            for job in jobs]
+
+
+def bench_timed_sentences(config):
+    metadata = open_metadata(config)
+    calls = []
+    for _ in range(config['repeats']):
+        for i in sample_indices(metadata, config):
+            # a new sample each time, the first call is cached in it
+            sample = metadata[i]
+            calls.append((timed(sample.get_timed_sentences)[0], 1))
+    return calls
+
+
+def bench_timed_sentences_batch(config):
+    metadata = open_metadata(config)
+    indices = sample_indices(metadata, config)
+    return [(timed(metadata.get_timed_sentences, indices)[0], len(indices))
+            for _ in range(config['repeats'])]
+
+
+def bench_render_fixations(config):
+    metadata = open_metadata(config)
+    size = config['size']
+    calls = []
+    for _ in range(config['repeats']):
+        for i in sample_indices(metadata, config):
+            sample = metadata[i]
+            if len(sample.get_fixations()) > 0:
+                calls.append((timed(sample.draw_fixations, size=size)[0], 1))
+    return calls
+
+
+def bench_render_ellipses(config):
+    metadata = open_metadata(config)
+    size = config['size']
+    calls = []
+    for _ in range(config['repeats']):
+        for i in sample_indices(metadata, config):
+            sample = metadata[i]
+            if sample.get_anomaly_ellipses() is not None:
+                calls.append((timed(sample.draw_anomaly_ellipses, size=size)[0], 1))
+    return calls
+
+
+def bench_iter_split(config):
+    """one call per epoch over the whole split"""
+    metadata = open_metadata(config)
+    fields = ['img', 'heatmap', 'fixations'] if config['size'] is not None else ['img', 'fixations']
+    calls = []
+    for epoch in range(config['repeats']):
+        def epoch_items():
+            return sum(len(batch['fixations'])
+                       for batch in metadata.iter_split(config['split'],
+                                                        batch_size=config['batch_size'],
+                                                        fields=fields,
+                                                        size=config['size'],
+                                                        workers=config['workers'],
+                                                        epoch=epoch))
+        calls.append(timed(epoch_items))
+    return calls
+
+
+def bench_prefetch(config):
+    """one call per repeat, prefetching the samples' fields into a new
+    Metadata"""
+    calls = []
+    for _ in range(config['repeats']):
+        metadata = open_metadata(config)
+        indices = sample_indices(metadata, config)
+        calls.append((timed(metadata.prefetch, indices, concurrency=config['workers'])[0],
+                      len(indices)))
+    return calls
+
+
+def run_benchmark(name, config):
+    """runs benchmark :param name:, in a process of its own.
+    returns its summary, with the RSS before it started and its peak"""
+    bench = globals()['bench_' + name]
+    rss_before = psutil.Process().memory_info().rss / 2**20
+    calls = bench(config)
+    if len(calls) == 0:
+        return None
+    seconds, items = zip(*calls)
+    result = summarize(seconds, items)
+    result['rss_before_mb'] = rss_before
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def run_benchmarks(config, names=BENCHMARKS):
+    results = {}
+    # spawned, so nothing imported or cached by the parent is shared
+    context = multiprocessing.get_context('spawn')
+    for name in names:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            result = pool.submit(run_benchmark, name, config).result()
+        if result is None:
+            print("{}: nothing to run".format(name))
+            continue
+        results[name] = result
+        print("{}: p50 {:.2f}ms  p90 {:.2f}ms  p99 {:.2f}ms  {:.1f} items/s  peak RSS {:.0f}MB".format(
+            name, result['p50_ms'], result['p90_ms'], result['p99_ms'],
+            result['items_per_s'], result['peak_rss_mb']))
+    return results
+
+
+def environment():
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'ram_gb': psutil.virtual_memory().total / 2**30}
+
+
+def save_baseline(path, config, results):
+    from tools import dump_json_atomic
+    dump_json_atomic(path, {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                            'environment': environment(),
+                            'config': config,
+                            'results': results})
+
+
+def compare(results, baseline, tolerance=0.2):
+    """returns the names of benchmarks whose median latency is more than
+    :param tolerance: above the baseline's, printing every ratio"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline['results']:
+            continue
+        base = baseline['results'][name]
+        ratio = result['p50_ms'] / max(base['p50_ms'], 1e-12)
+        regressed = ratio > 1 + tolerance
+        if regressed:
+            regressions.append(name)
+        print("{:<24} p50 {:9.2f}ms -> {:9.2f}ms  x{:.2f}  peak RSS {:6.0f}MB -> {:6.0f}MB{}".format(
+            name, base['p50_ms'], result['p50_ms'], ratio,
+            base['peak_rss_mb'], result['peak_rss_mb'],
+            '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmarks loading, heatmaps, alignment, rendering and iteration')
+    parser.add_argument('work_dir', help='where metadata, and the synthetic dataset if any, are written')
+    parser.add_argument('--reflacx-dir', default=None,
+                        help='benchmarks a real dataset instead of a synthetic one')
+    parser.add_argument('--mimic-dir', default=None)
+    parser.add_argument('--images', type=int, default=50, help='images of the synthetic dataset')
+    parser.add_argument('--image-size', type=int, nargs=2, default=[1024, 1024], metavar=('WIDTH', 'HEIGHT'),
+                        help='size of the synthetic images')
+    parser.add_argument('--backend', default='json')
+    parser.add_argument('--pixel-cache-dir', default=None)
+    parser.add_argument('--tables-dir', default=None)
+    parser.add_argument('--only', nargs='+', default=BENCHMARKS, choices=BENCHMARKS)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--samples', type=int, default=20, help='samples per repeat of per sample benchmarks')
+    parser.add_argument('--size', type=int, nargs=2, default=None, metavar=('WIDTH', 'HEIGHT'),
+                        help='size images are rendered and iterated at')
+    parser.add_argument('--split', default='train')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--save', default=None, help='saves results as a JSON baseline')
+    parser.add_argument('--compare', default=None, help='JSON baseline to compare results to')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    work_dir = os.path.abspath(args.work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    reflacx_dir, mimic_dir = args.reflacx_dir, args.mimic_dir
+    if reflacx_dir is None:
+        reflacx_dir = os.path.join(work_dir, 'data', 'reflacx')
+        mimic_dir = os.path.join(work_dir, 'data', 'mimic')
+        if not os.path.exists(reflacx_dir):
+            from synthetic_data import make_dataset
+            make_dataset(os.path.join(work_dir, 'data'),
+                         n_images=args.images,
+                         size=tuple(args.image_size))
+
+    config = {'work_dir': work_dir,
+              'reflacx_dir': reflacx_dir,
+              'mimic_dir': mimic_dir,
+              'full_meta_path': os.path.join(work_dir, 'full_meta.json'),
+              'backend': args.backend,
+              'pixel_cache_dir': args.pixel_cache_dir,
+              'tables_dir': args.tables_dir,
+              'repeats': args.repeats,
+              'samples': args.samples,
+              'size': None if args.size is None else tuple(args.size),
+              'split': args.split,
+              'batch_size': args.batch_size,
+              'workers': args.workers}
+    # warm benchmarks read metadata built beforehand
+    open_metadata(config)
+
+    results = run_benchmarks(config, args.only)
+    if args.save is not None:
+        save_baseline(args.save, config, results)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print("{} regressions: {}".format(len(regressions), ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
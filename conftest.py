@@ -0,0 +1,11 @@
+import pytest
+from synthetic_data import make_dataset
+
+
+@pytest.fixture(scope='session')
+def synthetic_dataset(tmp_path_factory):
+    """(reflacx_dir, mimic_dir) of a small synthetic dataset with heatmaps,
+    shared by the tests that only read it"""
+    return make_dataset(str(tmp_path_factory.mktemp('synthetic')), n_images=4, readers=2,
+                        phases=(1, 2), size=(96, 80), fixations_range=(20, 40),
+                        discarded_fraction=0, workers=2)
@@ -0,0 +1,161 @@
+# consensus heatmaps of the readers of a MIMIC-CXR image.
+# Several REFLACX readings share a dicom_id. Their consensus is the weighted
+# mean of their heatmaps, each taken as a gaze probability map (sum 1), then
+# normalized to [0, 1] as single readers' heatmaps are.
+# Readers' heatmaps are streamed one at a time and reduced in float32, by
+# blocks of rows, so memory doesn't grow with the number of readers.
+# Results are kept in a HeatmapStore, by '{dicom_id}_{weighting}', with the
+# readers and heatmap files they were made from, and made again if those
+# change.
+#
+# usage: python consensus.py <reflacx_dir> <mimic_dir> <full_meta.json> <out_dir> --weighting uniform --workers 8
+# precomputes the consensus heatmap of every dicom_id
+
+import argparse
+import os
+import numpy as np
+from heatmap_store import HeatmapStore, load_heatmap
+from batch_loader import init_worker_metadata, worker_metadata
+
+WEIGHTINGS = ['uniform', 'duration', 'fixations']
+
+
+def reader_weight(sample, weighting):
+    """'uniform' weighs every reader the same, 'duration' by their total
+    fixation time and 'fixations' by their number of fixations"""
+    if weighting == 'uniform':
+        return 1.0
+    fixations = sample.get_fixations()
+    if fixations is None or len(fixations) == 0:
+        return 0.0
+    if weighting == 'fixations':
+        return float(len(fixations))
+    if weighting == 'duration':
+        fixations = np.asarray(fixations).view(np.ndarray)
+        return float(np.sum(fixations['timestamp_end_fixation'] - fixations['timestamp_start_fixation']))
+    raise ValueError("unknown weighting {}, expected one of {}".format(weighting, WEIGHTINGS))
+
+
+def readers(samples):
+    """the samples that have a heatmap"""
+    return [sample for sample in samples if 'heatmaps' in sample.data]
+
+
+def consensus_heatmap(samples, weighting='uniform', rows_per_block=256):
+    """returns (heatmap normalized to [0, 1], info) of :param samples:,
+    the readers of one dicom_id, info being the readers, their weights and
+    their heatmap files. It's all zeros if every heatmap is"""
+    samples = readers(samples)
+    weights = [reader_weight(sample, weighting) for sample in samples]
+    if len(samples) == 0 or sum(weights) == 0:
+        raise KeyError('no heatmaps to aggregate')
+
+    result = None
+    for sample, weight in zip(samples, weights):
+        if weight == 0:
+            continue
+        hm = load_heatmap(sample.data['heatmaps'])
+        if result is None:
+            result = np.zeros(hm.shape, dtype=np.float32)
+        assert hm.shape == result.shape, 'readers of the same image with heatmaps of different shapes'
+        total = np.sum(hm, dtype=np.float64)
+        if total == 0:
+            # nothing looked at, nothing to add
+            continue
+        scale = np.float32(weight / sum(weights) / total)
+        for start in range(0, hm.shape[0], rows_per_block):
+            block = np.asarray(hm[start:start + rows_per_block], dtype=np.float32)
+            result[start:start + rows_per_block] += block * scale
+    top = np.max(result)
+    if top > 0:
+        result /= top
+
+    info = {'dicom_id': samples[0].dicom_id,
+            'weighting': weighting,
+            'readers': [sample.reflacx_id for sample in samples],
+            'weights': weights,
+            'heatmaps': [sample.data['heatmaps'] for sample in samples]}
+    return result, info
+
+
+def consensus_key(dicom_id, weighting):
+    return '{}_{}'.format(dicom_id, weighting)
+
+
+def is_fresh(store, samples, weighting):
+    """whether the store's consensus was made from the current readers"""
+    samples = readers(samples)
+    if len(samples) == 0:
+        return False
+    key = consensus_key(samples[0].dicom_id, weighting)
+    return (key in store
+            and store.index[key]['readers'] == [sample.reflacx_id for sample in samples]
+            and store.index[key]['heatmaps'] == [sample.data['heatmaps'] for sample in samples])
+
+
+def _consensus_in_worker(store_path, dicom_id, weighting):
+    metadata = worker_metadata()
+    samples = [metadata.get_sample(dicom_id, rid) for rid in metadata.list_reflacx_ids(dicom_id)]
+    try:
+        heatmap, info = consensus_heatmap(samples, weighting)
+    except KeyError:
+        return dicom_id, None
+    store = HeatmapStore(store_path)
+    return dicom_id, store.write(consensus_key(dicom_id, weighting), heatmap, **info)
+
+
+def build_consensus(metadata, out_dir, weighting='uniform', dicom_ids=None, workers=None, log_every=100):
+    """precomputes the consensus heatmaps of :param dicom_ids:, all of them
+    if None, into a HeatmapStore at :param out_dir:, over a process pool.
+    Consensus heatmaps already there and fresh are skipped.
+    returns the store"""
+    from concurrent.futures import ProcessPoolExecutor
+    store = HeatmapStore(out_dir)
+    if dicom_ids is None:
+        dicom_ids = metadata.list_dicom_ids()
+    todo = [dicom_id for dicom_id in dicom_ids
+            if not is_fresh(store,
+                            [metadata.get_sample(dicom_id, rid)
+                             for rid in metadata.list_reflacx_ids(dicom_id)],
+                            weighting)]
+    print("{} of {} consensus heatmaps to compute".format(len(todo), len(dicom_ids)))
+
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=init_worker_metadata,
+                             initargs=(metadata.init_kwargs,)) as pool:
+        futures = [pool.submit(_consensus_in_worker, out_dir, dicom_id, weighting)
+                   for dicom_id in todo]
+        for count, future in enumerate(futures, 1):
+            dicom_id, entry = future.result()
+            if entry is not None:
+                store.index[consensus_key(dicom_id, weighting)] = entry
+            if count % log_every == 0 or count == len(futures):
+                store.flush()
+                print("{}/{} consensus heatmaps".format(count, len(futures)))
+    store.flush()
+    return store
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='precomputes consensus heatmaps of the readers of each image')
+    parser.add_argument('reflacx_dir')
+    parser.add_argument('mimic_dir')
+    parser.add_argument('full_meta_path')
+    parser.add_argument('out_dir')
+    parser.add_argument('--backend', default='json')
+    parser.add_argument('--weighting', default='uniform', choices=WEIGHTINGS)
+    parser.add_argument('--tables-dir', default=None)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+
+    from metadata import Metadata
+    metadata = Metadata(args.reflacx_dir,
+                        args.mimic_dir,
+                        args.full_meta_path,
+                        backend=args.backend,
+                        tables_dir=args.tables_dir)
+    build_consensus(metadata, args.out_dir, args.weighting, workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
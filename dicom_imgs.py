@@ -1,7 +1,154 @@
+# x-rays decoded from MIMIC-CXR DICOMs, cached in memory and on disk.
+# pydicom is imported when a DICOM is first decoded, and the cache shared by
+# processes lives in shared_imgs.py, so importing this module is cheap.
+#
+# usage: python dicom_imgs.py <mimic_dir> <cache_dir> --workers 8
+# warms a PixelCache with every .dcm in mimic_dir
+
 from rlogger import RLogger
+from collections import OrderedDict
+import argparse
+import json
+import os
+import threading
 import numpy as np
-import pydicom
-from psutil import virtual_memory
+from tools import save_atomic, dump_json_atomic
+from pyramid import build_pyramid, resample
+from instrumentation import instrumented, record_cache, record_file
+
+
+@instrumented('dicom_imgs.decode_dicom')
+def decode_dicom(imgpath):
+    import pydicom
+    record_file('dicom', imgpath)
+    return pydicom.read_file(imgpath).pixel_array
+
+
+class PixelCache:
+    """Decoded DICOM pixels kept on disk as raw .npy files, served as read
+    only memory maps, so decoding happens once and the OS page cache is
+    shared by every process reading them.
+    Each image is stored with its pyramid levels, {dicom_id}.{level}.npy,
+    down to :param min_side: pixels, see pyramid.py.
+    Each image has a .json sidecar with its source's mtime and size, and its
+    number of levels. Entries whose source changed are decoded again"""
+    def __init__(self, cache_dir, min_side=256):
+        self.cache_dir = cache_dir
+        self.min_side = min_side
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+    def paths(self, dicom_id):
+        base = os.path.join(self.cache_dir, dicom_id)
+        return base + '.npy', base + '.json'
+
+
+    def level_path(self, dicom_id, level):
+        if level == 0:
+            return self.paths(dicom_id)[0]
+        return os.path.join(self.cache_dir, '{}.{}.npy'.format(dicom_id, level))
+
+
+    @staticmethod
+    def source_stamp(imgpath):
+        st = os.stat(imgpath)
+        return {'mtime_ns': st.st_mtime_ns, 'size': st.st_size}
+
+
+    def sidecar(self, dicom_id, imgpath):
+        """returns the entry's sidecar, None if it's missing or stale"""
+        npy_path, json_path = self.paths(dicom_id)
+        try:
+            with open(json_path) as f:
+                stamp = json.load(f)
+            source = self.source_stamp(imgpath)
+        except (OSError, ValueError):
+            return None
+        if any(stamp.get(key) != source[key] for key in source) or not os.path.exists(npy_path):
+            return None
+        return stamp
+
+
+    def is_valid(self, dicom_id, imgpath):
+        return self.sidecar(dicom_id, imgpath) is not None
+
+
+    def get(self, dicom_id, imgpath, level=0):
+        """returns the cached pixels of a pyramid level as a read only
+        np.memmap, None if they aren't cached or are stale"""
+        levels = self.get_levels(dicom_id, imgpath)
+        if levels is None:
+            return None
+        return levels[min(level, len(levels) - 1)]
+
+
+    def get_levels(self, dicom_id, imgpath):
+        """returns every pyramid level, full resolution first, as read only
+        np.memmaps. None if they aren't cached or are stale"""
+        stamp = self.sidecar(dicom_id, imgpath)
+        record_cache('pixel_cache', stamp is not None)
+        if stamp is None:
+            return None
+        return [np.load(self.level_path(dicom_id, level), mmap_mode='r')
+                for level in range(stamp.get('levels', 1))]
+
+
+    @instrumented('pixel_cache.put')
+    def put(self, dicom_id, imgpath, img):
+        npy_path, json_path = self.paths(dicom_id)
+        stamp = self.source_stamp(imgpath)
+        img = np.ascontiguousarray(img)
+        levels = [img] + build_pyramid(img, self.min_side)
+        for level, level_img in enumerate(levels):
+            save_atomic(self.level_path(dicom_id, level), level_img)
+        stamp['levels'] = len(levels)
+        # the sidecar is written last, so it only exists for complete entries
+        dump_json_atomic(json_path, stamp)
+
+
+    def load(self, dicom_id, imgpath):
+        """returns cached pixels, decoding and caching them if needed"""
+        img = self.get(dicom_id, imgpath)
+        if img is None:
+            self.put(dicom_id, imgpath, decode_dicom(imgpath))
+            img = self.get(dicom_id, imgpath)
+        return img
+
+
+def _warm(args):
+    cache_dir, dicom_id, imgpath = args
+    cache = PixelCache(cache_dir)
+    stamp = cache.sidecar(dicom_id, imgpath)
+    # entries cached before pyramids were added are rebuilt
+    if stamp is not None and 'levels' in stamp:
+        return dicom_id, False
+    try:
+        cache.put(dicom_id, imgpath, decode_dicom(imgpath))
+    except ValueError:
+        return dicom_id, None
+    return dicom_id, True
+
+
+def warm_cache(imgpaths, cache_dir, workers=None, log_every=100):
+    """decodes every DICOM of :param imgpaths:, a dict of dicom_id: path,
+    that isn't already cached in :param cache_dir:, over a process pool.
+    returns the list of dicom_ids that couldn't be decoded"""
+    from concurrent.futures import ProcessPoolExecutor
+    jobs = [(cache_dir, dicom_id, imgpath) for dicom_id, imgpath in imgpaths.items()]
+    decoded = 0
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for count, (dicom_id, result) in enumerate(pool.map(_warm, jobs, chunksize=8), 1):
+            if result is None:
+                failed.append(dicom_id)
+            elif result:
+                decoded += 1
+            if count % log_every == 0 or count == len(jobs):
+                print("{}/{} checked, {} decoded, {} failed".format(count,
+                                                                    len(jobs),
+                                                                    decoded,
+                                                                    len(failed)))
+    return failed
 
 
 class DicomImgs:
@@ -9,47 +156,152 @@ class DicomImgs:
     can have the same MIMIC-CXR dicom_id, this class prevents loading the same
     one more than once.
     Loaded images occupy at most a fixed percentage of available virtual memory.
-    When exceeding limit, last accessed images will be unloaded first"""
-        
-    
-    def __init__(self, max_ram_percent=30):
+    When exceeding limit, least recently accessed images are unloaded first.
+    Threads missing the same image at once decode it once, the others wait
+    for it"""
+
+
+    def __init__(self, max_ram_percent=30, cache_dir=None):
         """param:max_ram_percent sets the maximum consumption of virtual memory
         by the images. It calculates a constant limit based on the total free
         memory reported by psutil.virtual_memory at instantiation
+        param:cache_dir optional PixelCache folder. When set, images are
+        decoded once into it and read back as memory maps
         """
+        from psutil import virtual_memory
         assert 0 < max_ram_percent <= 100
-        self.imgs = {}
+        self.pixel_cache = PixelCache(cache_dir) if cache_dir is not None else None
+        self.imgs = OrderedDict()
         self.max_ram_usage = int(virtual_memory().free * max_ram_percent / 100)
         self.ram_usage = 0
-        self.last_accessed = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.decoding = {}
 
         self.log = RLogger(__name__, self.__class__.__name__)
-    
+
     def check_id(self, dicom_id):
         return dicom_id in self.imgs
-    
-    
-    def get_dicom_img(self, dicom_id, imgpath=None):
+
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'bytes': self.ram_usage,
+                'max_bytes': self.max_ram_usage,
+                'imgs': len(self.imgs)}
+
+
+    def get_dicom_img(self, dicom_id, imgpath=None, copy=False):
+        """returns a read only view of the image, or a writable copy if
+        :param copy: is True. None if the file is corrupted"""
         assert dicom_id in self.imgs or imgpath is not None
-        if dicom_id not in self.imgs:
+        with self.lock:
+            img = self.imgs.get(dicom_id)
+            if img is not None:
+                self.imgs.move_to_end(dicom_id)
+                self.hits += 1
+            else:
+                decoding = self.decoding.get(dicom_id)
+                if decoding is None:
+                    self.decoding[dicom_id] = threading.Event()
+        record_cache('dicom_imgs', img is not None)
+
+        if img is None and decoding is not None:
+            decoding.wait()
+            return self.get_dicom_img(dicom_id, imgpath, copy)
+        if img is None:
             try:
-                img = pydicom.read_file(imgpath).pixel_array
-            except ValueError:
-                self.log("corrupted dicom file for dicom_id {} path: {}".format(dicom_id, imgpath))
+                img = self.decode(dicom_id, imgpath)
+                if img is None:
+                    return None
+                self.add(dicom_id, img)
+            finally:
+                with self.lock:
+                    self.decoding.pop(dicom_id).set()
+
+        return np.copy(img) if copy else img.view()
+
+
+    @instrumented('dicom_imgs.get_resampled')
+    def get_resampled(self, dicom_id, imgpath=None, size=None, crop=None):
+        """returns a new array of :param crop: of the image, resized to
+        :param size:, see pyramid.resample. With a pixel cache, it's read from
+        the smallest pyramid level that fits, without touching the full
+        resolution pixels. None if the file is corrupted"""
+        levels = None
+        if self.pixel_cache is not None and imgpath is not None:
+            levels = self.pixel_cache.get_levels(dicom_id, imgpath)
+        if levels is None:
+            img = self.get_dicom_img(dicom_id, imgpath)
+            if img is None:
                 return None
+            levels = [img]
+            if self.pixel_cache is not None and imgpath is not None:
+                levels = self.pixel_cache.get_levels(dicom_id, imgpath) or levels
+        return resample(levels, size, crop)
+
+
+    @instrumented('dicom_imgs.decode')
+    def decode(self, dicom_id, imgpath):
+        """returns the image as a read only array, from the pixel cache if
+        there's one. None if the file is corrupted"""
+        try:
+            img = (self.pixel_cache.load(dicom_id, imgpath)
+                   if self.pixel_cache is not None
+                   else decode_dicom(imgpath))
+        except ValueError:
+            self.log("corrupted dicom file for dicom_id {} path: {}".format(dicom_id, imgpath))
+            return None
+        img.setflags(write=False)
+        return img
+
+
+    def add(self, dicom_id, img):
+        with self.lock:
+            self.misses += 1
+            if dicom_id in self.imgs:
+                self.ram_usage -= self.imgs.pop(dicom_id).nbytes
             self.imgs[dicom_id] = img
-            try:
-                i = self.last_accessed.index(dicom_id)
-                self.last_accessed.pop(i)
-            except ValueError:
-                pass
-
-            self.last_accessed.insert(0, dicom_id)
-
-            self.ram_usage += img.size
-            while self.ram_usage > self.max_ram_usage:
-                d_id = self.last_accessed.pop()
-                self.ram_usage -= self.imgs[d_id].size
-                self.imgs.pop(d_id)
-            
-        return np.copy(self.imgs[dicom_id])
\ No newline at end of file
+            self.ram_usage += img.nbytes
+            # the image just added is kept even if it doesn't fit by itself
+            while self.ram_usage > self.max_ram_usage and len(self.imgs) > 1:
+                _, evicted = self.imgs.popitem(last=False)
+                self.ram_usage -= evicted.nbytes
+                self.evictions += 1
+
+
+_SHARED_NAMES = ['open_shared_memory', 'unlink_shared_memory', 'SharedImgsIndex',
+                 'SharedImgsManager', 'SharedImgs', 'SharedDicomImgs']
+
+
+def __getattr__(name):
+    # the shared image cache used to be defined here
+    if name in _SHARED_NAMES:
+        import shared_imgs
+        return getattr(shared_imgs, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='decodes MIMIC-CXR DICOMs into a PixelCache')
+    parser.add_argument('mimic_dir')
+    parser.add_argument('cache_dir')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+
+    imgpaths = {}
+    with os.scandir(args.mimic_dir) as it:
+        for entry in it:
+            if entry.name.endswith('.dcm'):
+                imgpaths[entry.name[:-len('.dcm')]] = entry.path
+    failed = warm_cache(imgpaths, args.cache_dir, args.workers)
+    for dicom_id in failed:
+        print("corrupted dicom file for dicom_id {}".format(dicom_id))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+# dataset wide index of fixations, for spatial and temporal queries.
+# The fixations of every sample are one set of column arrays, sorted by x-ray
+# then by x, each x-ray's rows being a contiguous slice. A query on an x-ray
+# binary searches its slice for the box's x range and filters the rest of its
+# conditions over those rows only, a query over the dataset filters every
+# row, both vectorized.
+# Positions are in full resolution pixels of each x-ray and times in seconds
+# from the start of each reading, as in the fixations csvs. Boxes are
+# (xmin, ymin, xmax, ymax), inclusive, and ellipses the ones inscribed in
+# such a box, as those of anomaly_location_ellipses.
+# Results are record arrays with the columns of COLUMNS, sample and dicom
+# being codes of reflacx_ids and dicom_ids, see FixationIndex.reflacx_ids_of,
+# and row the fixation's row in its sample's get_fixations.
+# An index is saved as a .npy per column, memory-mapped when loaded, and an
+# index.json of ids, with a digest of the metadata sources it was built from.
+#
+# usage: python fixation_index.py <reflacx_dir> <mimic_dir> <full_meta.json> <out_dir> --tables-dir tables
+# builds the index of every sample in the metadata
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from alignment import fixation_arrays
+from metadata_store import read_only, string_table, table_key, table_value
+from tools import dump_json_atomic, save_atomic
+
+COLUMNS = [('x_position', np.float32),
+           ('y_position', np.float32),
+           ('timestamp_start_fixation', np.float64),
+           ('timestamp_end_fixation', np.float64),
+           ('sample', np.int32),
+           ('dicom', np.int32),
+           ('row', np.int32)]
+
+
+class FixationIndex:
+    """Fixations of many samples, queried by x-ray, reader, box, ellipse and
+    time. :param columns: dict of COLUMNS' arrays, sorted by dicom then
+    x_position. :param reflacx_ids: and :param dicom_ids: are sorted id
+    tables the codes of sample and dicom refer to, sample_dicoms the dicom
+    code of each sample"""
+    index_name = 'index.json'
+
+    def __init__(self, columns, reflacx_ids, dicom_ids, sample_dicoms, sources=None):
+        self.columns = {name: read_only(columns[name]) for name, _ in COLUMNS}
+        self.reflacx_ids = read_only(string_table(reflacx_ids))
+        self.dicom_ids = read_only(string_table(dicom_ids))
+        self.sample_dicoms = read_only(np.asarray(sample_dicoms, dtype=np.int32))
+        self.dicom_starts = read_only(np.searchsorted(self.columns['dicom'],
+                                                      np.arange(len(self.dicom_ids) + 1)))
+        self.sources = sources
+
+
+    def __len__(self):
+        return len(self.columns['x_position'])
+
+
+    @staticmethod
+    def code(table, value):
+        """returns the position of :param value: in a sorted id table, None if
+        it's not there"""
+        key = table_key(table, value)
+        j = np.searchsorted(table, key)
+        if j == len(table) or table[j] != key:
+            return None
+        return int(j)
+
+
+    def select(self, dicom_id=None, reflacx_id=None, box=None, ellipse=None, t0=None, t1=None):
+        """returns the positions of the fixations
+        - of :param dicom_id: and of the reading :param reflacx_id:, if given,
+        - inside :param box: and the ellipse inscribed in :param ellipse:,
+          both (xmin, ymin, xmax, ymax), if given,
+        - starting in [:param t0:, :param t1:), either bound being optional"""
+        start, stop = 0, len(self)
+        sample = None
+        if reflacx_id is not None:
+            sample = self.code(self.reflacx_ids, reflacx_id)
+            if sample is None:
+                return np.zeros(0, dtype=np.int64)
+            dicom = int(self.sample_dicoms[sample])
+            if dicom_id is not None and self.code(self.dicom_ids, dicom_id) != dicom:
+                return np.zeros(0, dtype=np.int64)
+            dicom_id = table_value(self.dicom_ids, dicom)
+        if dicom_id is not None:
+            dicom = self.code(self.dicom_ids, dicom_id)
+            if dicom is None:
+                return np.zeros(0, dtype=np.int64)
+            start, stop = int(self.dicom_starts[dicom]), int(self.dicom_starts[dicom + 1])
+
+        bounds = [b for b in (box, ellipse) if b is not None]
+        if dicom_id is not None and len(bounds) > 0:
+            # x is sorted within an x-ray's rows
+            xs = self.columns['x_position'][start:stop]
+            start, stop = (start + int(np.searchsorted(xs, max(b[0] for b in bounds), 'left')),
+                           start + int(np.searchsorted(xs, min(b[2] for b in bounds), 'right')))
+            # bounds that don't overlap in x
+            stop = max(start, stop)
+
+        x = self.columns['x_position'][start:stop]
+        y = self.columns['y_position'][start:stop]
+        mask = np.ones(stop - start, dtype=bool)
+        for xmin, ymin, xmax, ymax in bounds:
+            mask &= (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+        if ellipse is not None:
+            cx = (ellipse[0] + ellipse[2]) / 2
+            cy = (ellipse[1] + ellipse[3]) / 2
+            rx = max((ellipse[2] - ellipse[0]) / 2, 0.5)
+            ry = max((ellipse[3] - ellipse[1]) / 2, 0.5)
+            mask &= ((x - cx) / rx) ** 2 + ((y - cy) / ry) ** 2 <= 1
+        if sample is not None:
+            mask &= self.columns['sample'][start:stop] == sample
+        t = self.columns['timestamp_start_fixation'][start:stop]
+        if t0 is not None:
+            mask &= t >= t0
+        if t1 is not None:
+            mask &= t < t1
+        return start + np.flatnonzero(mask)
+
+
+    def records(self, positions):
+        """returns the fixations at :param positions: as a record array"""
+        return np.rec.fromarrays([self.columns[name][positions] for name, _ in COLUMNS],
+                                 dtype=COLUMNS)
+
+
+    def query(self, dicom_id=None, reflacx_id=None, box=None, ellipse=None, t0=None, t1=None):
+        """returns the fixations matching the conditions of select as a
+        record array"""
+        return self.records(self.select(dicom_id, reflacx_id, box, ellipse, t0, t1))
+
+
+    def readers(self, dicom_id=None, box=None, ellipse=None, t0=None, t1=None):
+        """returns the reflacx_ids with a fixation matching the conditions of
+        select"""
+        samples = np.unique(self.columns['sample'][self.select(dicom_id, None, box, ellipse, t0, t1)])
+        return [table_value(self.reflacx_ids, sample) for sample in samples.tolist()]
+
+
+    def sample_fixations(self, reflacx_id):
+        """returns the fixations of a sample, in the order of its csv"""
+        records = self.query(reflacx_id=reflacx_id)
+        return records[np.argsort(records['row'], kind='stable')]
+
+
+    def reflacx_ids_of(self, records):
+        return [table_value(self.reflacx_ids, sample) for sample in records['sample'].tolist()]
+
+
+    def dicom_ids_of(self, records):
+        return [table_value(self.dicom_ids, dicom) for dicom in records['dicom'].tolist()]
+
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name, _ in COLUMNS:
+            save_atomic(os.path.join(path, name + '.npy'), np.ascontiguousarray(self.columns[name]))
+        dump_json_atomic(os.path.join(path, self.index_name),
+                         {'reflacx_ids': [table_value(self.reflacx_ids, i)
+                                          for i in range(len(self.reflacx_ids))],
+                          'dicom_ids': [table_value(self.dicom_ids, i)
+                                        for i in range(len(self.dicom_ids))],
+                          'sample_dicoms': self.sample_dicoms.tolist(),
+                          'sources': self.sources})
+
+
+    @classmethod
+    def exists(cls, path):
+        return os.path.exists(os.path.join(path, cls.index_name))
+
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, cls.index_name)) as f:
+            index = json.load(f)
+        columns = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                   for name, _ in COLUMNS}
+        return cls(columns, index['reflacx_ids'], index['dicom_ids'],
+                   index['sample_dicoms'], index['sources'])
+
+
+def build_fixation_index(samples, sources=None, workers=16):
+    """returns the FixationIndex of :param samples:, ReflacxSamples, whose
+    fixations are read over a thread pool of :param workers:.
+    :param sources: a digest of what the samples were read from, kept with
+    the index to tell if it's stale"""
+    samples = list(samples)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        fixations = list(pool.map(lambda sample: sample.get_fixations(), samples))
+
+    reflacx_ids, sample_codes = np.unique(string_table([s.reflacx_id for s in samples]),
+                                          return_inverse=True)
+    dicom_ids, dicom_codes = np.unique(string_table([s.dicom_id for s in samples]),
+                                       return_inverse=True)
+    sample_dicoms = np.zeros(len(reflacx_ids), dtype=np.int32)
+    sample_dicoms[sample_codes] = dicom_codes
+
+    parts = {name: [np.zeros(0, dtype=dtype)] for name, dtype in COLUMNS}
+    for sample_fixations, sample, dicom in zip(fixations, sample_codes, dicom_codes):
+        if sample_fixations is None or len(sample_fixations) == 0:
+            continue
+        starts, ends, xs, ys = fixation_arrays(sample_fixations)
+        n = len(xs)
+        for name, values in [('x_position', xs),
+                             ('y_position', ys),
+                             ('timestamp_start_fixation', starts),
+                             ('timestamp_end_fixation', ends),
+                             ('sample', np.full(n, sample)),
+                             ('dicom', np.full(n, dicom)),
+                             ('row', np.arange(n))]:
+            parts[name].append(values)
+    columns = {name: np.concatenate(parts[name]).astype(dtype, copy=False) for name, dtype in COLUMNS}
+    order = np.lexsort((columns['x_position'], columns['dicom']))
+    return FixationIndex({name: values[order] for name, values in columns.items()},
+                         reflacx_ids, dicom_ids, sample_dicoms, sources)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='builds the dataset wide index of fixations')
+    parser.add_argument('reflacx_dir')
+    parser.add_argument('mimic_dir')
+    parser.add_argument('full_meta_path')
+    parser.add_argument('out_dir')
+    parser.add_argument('--backend', default='json')
+    parser.add_argument('--tables-dir', default=None)
+    args = parser.parse_args(argv)
+
+    from metadata import Metadata
+    metadata = Metadata(args.reflacx_dir,
+                        args.mimic_dir,
+                        args.full_meta_path,
+                        backend=args.backend,
+                        tables_dir=args.tables_dir,
+                        fixation_index_dir=args.out_dir)
+    start = time.time()
+    index = metadata.get_fixation_index()
+    print("{} fixations of {} samples and {} x-rays indexed in {:.1f}s".format(len(index),
+                                                                             len(index.reflacx_ids),
+                                                                             len(index.dicom_ids),
+                                                                             time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,13 +5,19 @@
 # this script is relatively slow given the large number of high resolution gaussians being drawn
 # example of
 # - how to generate heatmaps
+#
+# usage: python generate_heatmaps.py <reflacx_dir> --phase 1 2 3 --workers 8
+# --tolerance none draws untruncated gaussians, as create_heatmap_dense does
 
-import pandas as pd
+import argparse
+import os
+import time
 import numpy as np
-from scipy.stats import multivariate_normal
-import pathlib
+from tools import save_atomic, dump_json_atomic
+from heatmap_store import dicom_id_from_img_path
 
 def get_gaussian(y, x, sy, sx, sizey, sizex, shown_rects_image_space):
+    from scipy.stats import multivariate_normal
     
     # displace center coordinates because gaussian will be drawn to an array representing only shown parts of the image
     mu = [y-shown_rects_image_space[1],x-shown_rects_image_space[0]]
@@ -29,7 +35,9 @@ def get_gaussian(y, x, sy, sx, sizey, sizex, shown_rects_image_space):
     
     return to_return
 
-def create_heatmap(sequence_table, size_x, size_y):
+def create_heatmap_dense(sequence_table, size_x, size_y):
+    """reference implementation, drawing one full frame gaussian per fixation.
+    Kept to check create_heatmap against, it is much slower"""
     img = np.zeros((size_y, size_x), dtype=np.float32)
     #for index, row in sequence_table.iterrows():
     for row in sequence_table:
@@ -43,39 +51,319 @@ def create_heatmap(sequence_table, size_x, size_y):
     #normalize heatmap to a gaze probabitly map
     return img/np.sum(img)
 
-def create_heatmaps(data_folder, filename_phase, folder_name='heatmaps', phase = None):
+def truncation_radius(tolerance):
+    """number of standard deviations after which a gaussian's value falls
+    below :param tolerance: times its peak. None means no truncation"""
+    if tolerance is None:
+        return None
+    assert 0 < tolerance < 1
+    return np.sqrt(-2 * np.log(tolerance))
+
+def get_gaussian_1d(mu, sigma, start, stop, k=None):
+    """samples a 1-D gaussian over integer coordinates in [start, stop),
+    restricted to mu +- k * sigma.
+    returns (first coordinate, values), values being empty when the
+    window doesn't intersect [start, stop)"""
+    if k is not None:
+        start = max(start, int(np.floor(mu - k * sigma)))
+        stop = min(stop, int(np.ceil(mu + k * sigma)) + 1)
+    if stop <= start:
+        return start, np.zeros(0, dtype=np.float32)
+    coords = np.arange(start, stop, dtype=np.float64)
+    values = np.exp(-0.5 * ((coords - mu) / sigma) ** 2) / (np.sqrt(2 * np.pi) * sigma)
+    return start, values.astype(np.float32)
+
+def splat_fixation(img, row, k=None, angle_circle=1):
+    """adds the gaussian of a single fixation to :param img: in place.
+    The gaussian is separable, so it's drawn as the outer product of two
+    1-D gaussians, each clipped to the shown rect and to +- k sigmas"""
+    sizey, sizex = img.shape
+    xmin = max(0, int(round(row['xmin_shown_from_image'])))
+    ymin = max(0, int(round(row['ymin_shown_from_image'])))
+    xmax = min(sizex, int(round(row['xmax_shown_from_image'])))
+    ymax = min(sizey, int(round(row['ymax_shown_from_image'])))
+
+    x0, gx = get_gaussian_1d(row['x_position'],
+                             row['angular_resolution_x_pixels_per_degree'] * angle_circle,
+                             xmin, xmax, k)
+    y0, gy = get_gaussian_1d(row['y_position'],
+                             row['angular_resolution_y_pixels_per_degree'] * angle_circle,
+                             ymin, ymax, k)
+    if len(gx) == 0 or len(gy) == 0:
+        return img
+
+    #give higher weight for fixations that last longer
+    gy *= row['timestamp_end_fixation'] - row['timestamp_start_fixation']
+    img[y0:y0 + len(gy), x0:x0 + len(gx)] += np.outer(gy, gx)
+    return img
+
+def create_heatmap(sequence_table, size_x, size_y, tolerance=1e-4):
+    """generates a gaze probability map of shape (size_y, size_x) from a
+    sequence of fixations.
+    Each fixation is a gaussian with 1 degree of visual angle as its standard
+    deviation, drawn only where it is above :param tolerance: times its peak.
+    tolerance=None draws the whole shown rect, matching create_heatmap_dense"""
+    img = np.zeros((int(size_y), int(size_x)), dtype=np.float32)
+    k = truncation_radius(tolerance)
+    for row in sequence_table:
+        splat_fixation(img, row, k)
+    #normalize heatmap to a gaze probabitly map
+    img /= np.sum(img)
+    return img
+
+def get_gaussians_1d(mu, sigma, start, stop, size, k=None):
+    """vectorized get_gaussian_1d: row i samples a gaussian of mean mu[i] and
+    standard deviation sigma[i] over [0, size), zero outside
+    [start[i], stop[i]) and mu[i] +- k * sigma[i]"""
+    start = np.maximum(np.round(start), 0)
+    stop = np.minimum(np.round(stop), size)
+    if k is not None:
+        start = np.maximum(start, np.floor(mu - k * sigma))
+        stop = np.minimum(stop, np.ceil(mu + k * sigma) + 1)
+    coords = np.arange(size, dtype=np.float64)[None, :]
+    mu = mu[:, None]
+    sigma = sigma[:, None]
+    values = np.exp(-0.5 * ((coords - mu) / sigma) ** 2) / (np.sqrt(2 * np.pi) * sigma)
+    values[(coords < start[:, None]) | (coords >= stop[:, None])] = 0
+    return values.astype(np.float32)
+
+class FixationSplats:
+    """The gaussians of a sequence of fixations, as create_heatmap draws them,
+    computed once.
+    A fixation's gaussian is separable, the outer product of a column gy and
+    a row gx. They are kept as the rows of gy (n x size_y), weighted by the
+    fixation's duration, and gx (n x size_x), so the heatmap of any subset of
+    fixations is a single matrix product, gy[subset].T @ gx[subset], and
+    cropping it only slices columns of gy and gx.
+    Heatmaps at another resolution are drawn directly at it, with positions,
+    shown rects and sigmas rescaled, and their factors are kept too"""
+    def __init__(self, sequence_table, size_x, size_y, tolerance=1e-4, angle_circle=1):
+        self.size_x = int(size_x)
+        self.size_y = int(size_y)
+        self.k = truncation_radius(tolerance)
+        columns = lambda name: np.array([row[name] for row in sequence_table], dtype=np.float64)
+        self.starts = columns('timestamp_start_fixation')
+        self.ends = columns('timestamp_end_fixation')
+        self.x = (columns('x_position'),
+                  columns('angular_resolution_x_pixels_per_degree') * angle_circle,
+                  columns('xmin_shown_from_image'),
+                  columns('xmax_shown_from_image'))
+        self.y = (columns('y_position'),
+                  columns('angular_resolution_y_pixels_per_degree') * angle_circle,
+                  columns('ymin_shown_from_image'),
+                  columns('ymax_shown_from_image'))
+        self.gx = get_gaussians_1d(*self.x, self.size_x, self.k)
+        self.gy = get_gaussians_1d(*self.y, self.size_y, self.k)
+        #give higher weight for fixations that last longer
+        self.gy *= (self.ends - self.starts).astype(np.float32)[:, None]
+        self.resized = {}
+    
+
+    def __len__(self):
+        return len(self.starts)
+    
+
+    def factors(self, crop=None, size=None):
+        """returns (gy, gx) over :param crop:, (xmin, ymin, xmax, ymax), at
+        :param size:, (width, height). Either can be None"""
+        if crop is None:
+            crop = (0, 0, self.size_x, self.size_y)
+        xmin, ymin, xmax, ymax = crop
+        if size is None:
+            return self.gy[:, ymin:ymax], self.gx[:, xmin:xmax]
+        
+        key = (tuple(crop), tuple(size))
+        if key not in self.resized:
+            def rescale(params, offset, length, out_length):
+                # pixel centers of the output map to the input's
+                scale = out_length / length
+                mu, sigma, start, stop = params
+                return (((mu - offset + 0.5) * scale - 0.5),
+                        sigma * scale,
+                        (start - offset) * scale,
+                        (stop - offset) * scale)
+            gx = get_gaussians_1d(*rescale(self.x, xmin, xmax - xmin, size[0]), int(size[0]), self.k)
+            gy = get_gaussians_1d(*rescale(self.y, ymin, ymax - ymin, size[1]), int(size[1]), self.k)
+            gy *= (self.ends - self.starts).astype(np.float32)[:, None]
+            self.resized[key] = gy, gx
+        return self.resized[key]
+    
+
+    def heatmap(self, selection=slice(None), crop=None, size=None):
+        """returns the normalized heatmap of the fixations in :param selection:,
+        an index, slice, mask or index array.
+        :param crop: optional (xmin, ymin, xmax, ymax), the heatmap is then
+        of that region only, normalized over it
+        :param size: optional (width, height) of the result.
+        It's all zeros if no selected fixation is drawn in it, as for an
+        empty selection"""
+        gy, gx = self.factors(crop, size)
+        img = gy[selection].T @ gx[selection]
+        #normalize heatmap to a gaze probabitly map
+        total = np.sum(img)
+        if total > 0:
+            img /= total
+        return img
     
-    pathlib.Path(folder_name).mkdir(parents=True, exist_ok=True) 
-    df = pd.read_csv(data_folder + filename_phase)
+
+    def between(self, t0, t1, crop=None, size=None):
+        """returns the heatmap of the fixations starting in [t0, t1), all
+        zeros if there are none, as when t0 >= t1"""
+        return self.heatmap((self.starts >= t0) & (self.starts < t1), crop, size)
+
+def heatmap_jobs(data_folder, filename_phase, folder_name, phase=None):
+    """lists one job per non discarded row of a phase's metadata csv.
+    Trials are numbered by sorted image name, so output names are the same
+    across runs"""
+    import pandas as pd
+    df = pd.read_csv(os.path.join(data_folder, filename_phase))
     df = df[df['eye_tracking_data_discarded']==False]
-    all_images = df['image'].unique()
-    for trial, image_name in enumerate(sorted(all_images)):
-        df_this_trial = df[df['image']==image_name]
-        index_image = 0
-        for _, df_this_index_this_trial in df_this_trial.iterrows():
-            
-            print('trial', trial, 'index_image', index_image)
-            image_size_x = int(float(df_this_index_this_trial['image_size_x']))
-            image_size_y = int(float(df_this_index_this_trial['image_size_y']))
-            fixations = pd.read_csv(f'{data_folder}/{df_this_index_this_trial["id"]}/fixations.csv')
-            this_img = create_heatmap(fixations,image_size_x, image_size_y)
-
-            # Saving the array in npy format
-            info_dict = {'np_image': this_img, 'img_path': image_name, 'trial': trial, 'id': df_this_index_this_trial['id'], 'phase': phase }
-            np.save(folder_name + '/' + str(trial) + '_' + str(index_image), info_dict)
-            
-            index_image += 1
-
-# # ### Phase 1
-#print('Starting Phase 1...')
-#file_phase_1 = 'metadata_phase_1.csv'
-#
-#create_heatmaps(eyetracking_dataset_path ,file_phase_1, 
-#                folder_name='heatmaps_phase_1', phase =  1)
-#
-## ### Phase 2
-#print('Starting Phase 2...')
-#file_phase_2 = 'metadata_phase_2.csv'
-#
-#create_heatmaps(eyetracking_dataset_path, file_phase_2,
-#                      folder_name='heatmaps_phase_2', phase =  1)
\ No newline at end of file
+    jobs = []
+    for trial, (image_name, df_this_trial) in enumerate(df.groupby('image', sort=True)):
+        for index_image, row in enumerate(df_this_trial.to_dict('records')):
+            jobs.append({'fixations': os.path.join(data_folder, row['id'], 'fixations.csv'),
+                         'size_x': int(float(row['image_size_x'])),
+                         'size_y': int(float(row['image_size_y'])),
+                         'path': os.path.join(folder_name,
+                                              '{}_{}.npy'.format(trial, index_image)),
+                         'info': {'img_path': image_name,
+                                  'trial': trial,
+                                  'id': row['id'],
+                                  'phase': phase}})
+    return jobs
+
+def is_valid_heatmap(path, reflacx_id=None, verify=False):
+    """checks if a heatmap file was completely written.
+    Files are written atomically, so by default checking that it has a
+    readable npy header and ends with pickle's STOP opcode is enough.
+    :param verify: loads it and checks its contents"""
+    try:
+        with open(path, 'rb') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                np.lib.format.read_array_header_1_0(f)
+            else:
+                np.lib.format.read_array_header_2_0(f)
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'.':
+                return False
+        if not verify:
+            return True
+        info = np.load(path, allow_pickle=True).item()
+        return ((reflacx_id is None or info['id'] == reflacx_id)
+                and info['np_image'].ndim == 2)
+    except Exception:
+        return False
+
+def write_manifest(folder_name, jobs):
+    """writes manifest.json, mapping each heatmap file to its owner, so
+    Metadata doesn't have to open the heatmaps to group them"""
+    manifest = {os.path.basename(job['path']): {'id': job['info']['id'],
+                                                'dicom_id': dicom_id_from_img_path(job['info']['img_path']),
+                                                'img_path': job['info']['img_path']}
+                for job in jobs
+                if os.path.exists(job['path'])}
+    dump_json_atomic(os.path.join(folder_name, 'manifest.json'), manifest)
+
+def make_heatmap(job, tolerance=1e-4):
+    import pandas as pd
+    fixations = pd.read_csv(job['fixations']).to_dict('records')
+    info_dict = {'np_image': create_heatmap(fixations,
+                                            job['size_x'],
+                                            job['size_y'],
+                                            tolerance),
+                 **job['info']}
+    return save_atomic(job['path'], info_dict)
+
+def create_heatmaps(data_folder, filename_phase, folder_name='heatmaps', phase = None,
+                    workers=None, verify=False, tolerance=1e-4, log_every=10):
+    """generates the heatmaps of every trial in a phase over a process pool.
+    Heatmaps already present in :param folder_name: are skipped, so a killed
+    run can be resumed by running it again"""
+    import pathlib
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    pathlib.Path(folder_name).mkdir(parents=True, exist_ok=True)
+    for leftover in pathlib.Path(folder_name).glob('*.tmp'):
+        leftover.unlink()
+
+    jobs = heatmap_jobs(data_folder, filename_phase, folder_name, phase)
+    todo = [job for job in jobs
+            if not is_valid_heatmap(job['path'], job['info']['id'], verify)]
+    print('phase {}: {} heatmaps, {} already done'.format(phase,
+                                                          len(jobs),
+                                                          len(jobs) - len(todo)))
+    if len(todo) == 0:
+        write_manifest(folder_name, jobs)
+        return
+
+    start = time.time()
+    written = 0
+    def report(done):
+        elapsed = max(time.time() - start, 1e-9)
+        print('{}/{} trials  {:.2f} trials/s  {:.1f} MB/s'.format(done,
+                                                                  len(todo),
+                                                                  done / elapsed,
+                                                                  written / elapsed / 2**20))
+
+    if workers == 1:
+        results = (make_heatmap(job, tolerance) for job in todo)
+        for done, nbytes in enumerate(results, 1):
+            written += nbytes
+            if done % log_every == 0 or done == len(todo):
+                report(done)
+        write_manifest(folder_name, jobs)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(make_heatmap, job, tolerance) for job in todo]
+        for done, future in enumerate(as_completed(futures), 1):
+            written += future.result()
+            if done % log_every == 0 or done == len(todo):
+                report(done)
+    write_manifest(folder_name, jobs)
+
+def tolerance_arg(value):
+    """a --tolerance, in (0, 1), or 'none' for no truncation"""
+    if value.lower() == 'none':
+        return None
+    try:
+        tolerance = float(value)
+    except ValueError:
+        tolerance = None
+    if tolerance is None or not 0 < tolerance < 1:
+        raise argparse.ArgumentTypeError("expected a number in (0, 1) or 'none', got {}".format(value))
+    return tolerance
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='generates REFLACX heatmaps from fixations')
+    parser.add_argument('reflacx_dir')
+    parser.add_argument('--main-data-dir', default='main_data')
+    parser.add_argument('--out-dir', default=None,
+                        help='where heatmaps_phase_* folders are written. defaults to reflacx_dir')
+    parser.add_argument('--phase', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--tolerance', type=tolerance_arg, default=1e-4,
+                        help="gaussians are drawn where they're above this times their peak, "
+                             "'none' draws them whole, as create_heatmap_dense")
+    parser.add_argument('--verify', action='store_true',
+                        help='load existing heatmaps to check them before skipping')
+    args = parser.parse_args(argv)
+
+    data_folder = os.path.join(args.reflacx_dir, args.main_data_dir)
+    out_dir = args.out_dir if args.out_dir is not None else args.reflacx_dir
+    for phase in args.phase:
+        filename_phase = 'metadata_phase_{}.csv'.format(phase)
+        if not os.path.exists(os.path.join(data_folder, filename_phase)):
+            print('{} not found, skipping phase {}'.format(filename_phase, phase))
+            continue
+        print('Starting Phase {}...'.format(phase))
+        create_heatmaps(data_folder,
+                        filename_phase,
+                        folder_name=os.path.join(out_dir, 'heatmaps_phase_{}'.format(phase)),
+                        phase=phase,
+                        workers=args.workers,
+                        verify=args.verify,
+                        tolerance=args.tolerance)
+
+if __name__ == '__main__':
+    main()
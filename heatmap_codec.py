@@ -0,0 +1,248 @@
+# compact heatmap files, quantized and compressed.
+# A full resolution float32 heatmap is ~30MB. A .hmz file keeps it as
+# - uint8 or uint16 multiples of a per heatmap scale, float16, or float32,
+#   which is lossless,
+# - cropped to the rect of its nonzero values, in tiles of TILE pixels,
+#   zeros outside of it being implied,
+# - compressed by blocks of rows, each decoded on its own straight into the
+#   output, with blocks of zeros not stored at all.
+# Integer values are stored as differences along rows, which are mostly
+# small for smooth heatmaps, and values of more than one byte as planes of
+# their bytes, all first bytes then all second bytes, so the compressor sees
+# runs of similar bytes. Each makes files ~40% smaller.
+# zlib is the default codec, being part of python. 'zstd' is usually faster
+# at a similar ratio, and needs the zstandard package.
+# A file is MAGIC, the length of its JSON header as 4 little endian bytes,
+# the header, and the compressed blocks, at the header's offsets.
+#
+# usage: python heatmap_codec.py <heatmap.npy> [<heatmap.npy> ...] --repeats 5
+# reports the size, decode time and error of each format for the given
+# heatmaps, pickled or from a HeatmapStore
+
+import argparse
+import json
+import os
+import struct
+import time
+import zlib
+import numpy as np
+
+MAGIC = b'\x93HMZ'
+EXTENSION = '.hmz'
+QUANTIZATIONS = ['uint8', 'uint16', 'float16', 'float32']
+CODECS = ['zlib', 'zstd', 'none']
+DEFAULT_LEVELS = {'zlib': 6, 'zstd': 3, 'none': 0}
+TILE = 16
+
+
+def is_compact(path):
+    return path.endswith(EXTENSION)
+
+
+def quantize(heatmap, dtype):
+    """returns (values, scale), :param heatmap: being values * scale"""
+    heatmap = np.asarray(heatmap, dtype=np.float32)
+    dtype = np.dtype(dtype)
+    if dtype.kind != 'u':
+        return heatmap.astype(dtype), 1.0
+    top = float(heatmap.max()) if heatmap.size > 0 else 0.0
+    scale = top / np.iinfo(dtype).max if top > 0 else 1.0
+    values = np.rint(np.clip(heatmap, 0, None) / scale)
+    return values.astype(dtype), scale
+
+
+def nonzero_rect(values, tile=TILE):
+    """returns (ymin, ymax, xmin, xmax) of the nonzero :param values:,
+    rounded out to multiples of :param tile:"""
+    rows = np.flatnonzero(values.any(axis=1))
+    cols = np.flatnonzero(values.any(axis=0))
+    if len(rows) == 0:
+        return 0, 0, 0, 0
+    height, width = values.shape
+    return (rows[0] // tile * tile, min(height, -(-(rows[-1] + 1) // tile) * tile),
+            cols[0] // tile * tile, min(width, -(-(cols[-1] + 1) // tile) * tile))
+
+
+def compress(data, codec, level):
+    if codec == 'zlib':
+        return zlib.compress(data, level)
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if codec == 'none':
+        return bytes(data)
+    raise ValueError("unknown codec {}, expected one of {}".format(codec, CODECS))
+
+
+def decompress(data, codec):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == 'none':
+        return data
+    raise ValueError("unknown codec {}, expected one of {}".format(codec, CODECS))
+
+
+def encode(heatmap, dtype='uint16', codec='zlib', level=None, rows_per_block=256, tile=TILE):
+    """returns the .hmz bytes of :param heatmap:, a 2d array"""
+    assert heatmap.ndim == 2
+    level = DEFAULT_LEVELS[codec] if level is None else level
+    values, scale = quantize(heatmap, dtype)
+    ymin, ymax, xmin, xmax = nonzero_rect(values, tile)
+    delta = values.dtype.kind == 'u'
+
+    payloads = []
+    blocks = []
+    offset = 0
+    for start in range(ymin, ymax, rows_per_block):
+        block = values[start:min(start + rows_per_block, ymax), xmin:xmax]
+        if not block.any():
+            blocks.append([offset, 0])
+            continue
+        if delta:
+            block = np.diff(block, axis=1, prepend=np.zeros((len(block), 1), block.dtype))
+        planes = np.ascontiguousarray(block).view(np.uint8).reshape(-1, block.itemsize).T
+        data = compress(np.ascontiguousarray(planes), codec, level)
+        blocks.append([offset, len(data)])
+        payloads.append(data)
+        offset += len(data)
+
+    header = json.dumps({'shape': list(heatmap.shape),
+                         'dtype': values.dtype.name,
+                         'scale': scale,
+                         'delta': delta,
+                         'codec': codec,
+                         'rect': [int(ymin), int(ymax), int(xmin), int(xmax)],
+                         'rows_per_block': rows_per_block,
+                         'blocks': blocks}).encode('utf-8')
+    return b''.join([MAGIC, struct.pack('<I', len(header)), header] + payloads)
+
+
+def write_heatmap(path, heatmap, **kwargs):
+    """writes :param heatmap: to the .hmz file at :param path:, atomically,
+    with the options of encode. returns the size of the written file"""
+    data = encode(heatmap, **kwargs)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return len(data)
+
+
+def read_header(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('not a .hmz file: {}'.format(getattr(f, 'name', f)))
+    length, = struct.unpack('<I', f.read(4))
+    return json.loads(f.read(length).decode('utf-8'))
+
+
+def heatmap_shape(path):
+    with open(path, 'rb') as f:
+        return tuple(read_header(f)['shape'])
+
+
+def decode_into(path, out=None):
+    """decodes the .hmz file at :param path: into :param out:, a float
+    array of its shape, allocated as float32 if None. Each block is
+    decompressed into a buffer of one block and scaled into place, so no
+    full resolution temporary is made.
+    returns out"""
+    with open(path, 'rb') as f:
+        header = read_header(f)
+        # one read of the whole payload, blocks are sliced from it
+        payload = memoryview(f.read())
+    height, width = header['shape']
+    if out is None:
+        out = np.empty((height, width), dtype=np.float32)
+    assert out.shape == (height, width), 'expected a buffer of shape {}'.format((height, width))
+    ymin, ymax, xmin, xmax = header['rect']
+    out[:ymin] = 0
+    out[ymax:] = 0
+    out[ymin:ymax, :xmin] = 0
+    out[ymin:ymax, xmax:] = 0
+
+    dtype = np.dtype(header['dtype'])
+    scale = out.dtype.type(header['scale'])
+    rows = header['rows_per_block']
+    buffer = np.empty((min(rows, ymax - ymin), xmax - xmin), dtype=dtype)
+    for i, (offset, length) in enumerate(header['blocks']):
+        start = ymin + i * rows
+        target = out[start:min(start + rows, ymax), xmin:xmax]
+        if length == 0:
+            target[...] = 0
+            continue
+        data = decompress(payload[offset:offset + length], header['codec'])
+        block = buffer[:len(target)]
+        # byte planes back to values, a plane at a time
+        planes = np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1)
+        values = block.reshape(-1).view(np.uint8).reshape(-1, dtype.itemsize)
+        for byte in range(dtype.itemsize):
+            values[:, byte] = planes[byte]
+        if header['delta']:
+            np.cumsum(block, axis=1, dtype=dtype, out=block)
+        np.multiply(block, scale, out=target, casting='unsafe')
+    return out
+
+
+def compare_formats(heatmaps, formats, repeats=3):
+    """returns a row per (quantization, codec) of :param formats:, with the
+    mean size, compression ratio, encode and decode times and max error
+    over :param heatmaps:, a list of 2d float arrays"""
+    import tempfile
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'heatmap' + EXTENSION)
+        for dtype, codec in formats:
+            sizes, encode_s, decode_s, errors, raw = [], [], [], [], []
+            for heatmap in heatmaps:
+                heatmap = np.asarray(heatmap, dtype=np.float32)
+                start = time.perf_counter()
+                sizes.append(write_heatmap(path, heatmap, dtype=dtype, codec=codec))
+                encode_s.append(time.perf_counter() - start)
+                out = np.empty(heatmap.shape, dtype=np.float32)
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    decode_into(path, out)
+                    decode_s.append(time.perf_counter() - start)
+                errors.append(float(np.max(np.abs(out - heatmap))))
+                raw.append(heatmap.nbytes)
+            rows.append({'dtype': dtype,
+                         'codec': codec,
+                         'mb': np.mean(sizes) / 2**20,
+                         'ratio': np.sum(raw) / np.sum(sizes),
+                         'encode_ms': np.mean(encode_s) * 1000,
+                         'decode_ms': np.median(decode_s) * 1000,
+                         'max_error': max(errors)})
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='reports the size and decode time of heatmap formats')
+    parser.add_argument('heatmaps', nargs='+')
+    parser.add_argument('--quantizations', nargs='+', default=QUANTIZATIONS, choices=QUANTIZATIONS)
+    parser.add_argument('--codecs', nargs='+', default=['zlib'], choices=CODECS)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    from heatmap_store import load_heatmap
+    heatmaps = [load_heatmap(path) for path in args.heatmaps]
+    start = time.perf_counter()
+    for heatmap in heatmaps:
+        np.array(heatmap, dtype=np.float32)
+    print("{} heatmaps, {:.1f}MB each as float32, read in {:.1f}ms each".format(
+        len(heatmaps),
+        np.mean([heatmap.size * 4 for heatmap in heatmaps]) / 2**20,
+        (time.perf_counter() - start) / len(heatmaps) * 1000))
+    rows = compare_formats(heatmaps,
+                           [(dtype, codec) for dtype in args.quantizations for codec in args.codecs],
+                           args.repeats)
+    print('{:8} {:5} {:>8} {:>7} {:>10} {:>10} {:>10}'.format('dtype', 'codec', 'MB', 'ratio',
+                                                             'encode_ms', 'decode_ms', 'max_error'))
+    for row in rows:
+        print('{dtype:8} {codec:5} {mb:8.2f} {ratio:7.1f} {encode_ms:10.1f} {decode_ms:10.1f} {max_error:10.2e}'.format(**row))
+
+
+if __name__ == '__main__':
+    main()
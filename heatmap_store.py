@@ -0,0 +1,322 @@
+# on-disk heatmap storage that doesn't need pickle.
+# heatmaps generated by generate_heatmaps.py are np.save'd pickled dicts, which
+# have to be unpickled whole on every read and can't be memory-mapped.
+# A HeatmapStore keeps each heatmap as a raw float32 .npy, already normalized
+# to [0, 1], and everything else that was pickled with it in an index.json
+# sidecar. Stores made with a quantization keep .hmz files instead, a tenth
+# of the size or less, decoded on read, see heatmap_codec.py.
+#
+# usage: python heatmap_store.py <reflacx_dir> [--full-meta full_meta.json] [--quantization uint16 --codec zlib]
+# converts every heatmaps_phase_* folder into a heatmaps_store_phase_* folder
+
+import argparse
+import json
+import os
+import pickletools
+import numpy as np
+from tools import normalize, save_atomic, dump_json_atomic
+from pyramid import build_pyramid
+from heatmap_codec import CODECS, EXTENSION, QUANTIZATIONS, decode_into, is_compact, write_heatmap
+from instrumentation import instrumented, record_file
+
+
+class HeatmapStore:
+    """A folder of raw .npy heatmaps, named by REFLACX id, plus an index.json
+    mapping each id to its file and metadata (dicom_id, img_path, trial,
+    phase, shape, dtype, levels).
+    Each heatmap's pyramid levels, down to :param min_side: pixels, are
+    {reflacx_id}.{level}.npy, see pyramid.py.
+    Heatmaps are written as .hmz files of :param quantization:, 'uint8',
+    'uint16', 'float16' or 'float32', compressed with :param codec: if
+    it's given, see heatmap_codec.py. Stores can mix both"""
+    index_name = 'index.json'
+
+    def __init__(self, path, min_side=256, quantization=None, codec='zlib'):
+        self.path = path
+        self.min_side = min_side
+        self.quantization = quantization
+        self.codec = codec
+        index_path = os.path.join(path, self.index_name)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+
+
+    def __contains__(self, reflacx_id):
+        return reflacx_id in self.index
+    
+
+    def __len__(self):
+        return len(self.index)
+    
+
+    def ids(self):
+        return list(self.index.keys())
+    
+
+    def array_path(self, reflacx_id):
+        return os.path.join(self.path, self.index[reflacx_id]['file'])
+    
+
+    def get(self, reflacx_id):
+        """returns the heatmap as a read only np.memmap, or a decoded array
+        for .hmz files"""
+        return load_heatmap(self.array_path(reflacx_id))
+    
+
+    def get_levels(self, reflacx_id):
+        """returns the heatmap's pyramid levels, full resolution first, as
+        read only np.memmaps, or decoded arrays for .hmz files"""
+        return load_heatmap_levels(self.array_path(reflacx_id))
+    
+
+    def put(self, reflacx_id, heatmap, **info):
+        self.index[reflacx_id] = self.write(reflacx_id, heatmap, **info)
+    
+
+    def write(self, reflacx_id, heatmap, **info):
+        """writes a heatmap's arrays without adding it to the index, so
+        other processes can write them. returns its index entry"""
+        os.makedirs(self.path, exist_ok=True)
+        heatmap = np.ascontiguousarray(heatmap, dtype=np.float32)
+        compact = self.quantization is not None
+        file = '{}{}'.format(reflacx_id, EXTENSION if compact else '.npy')
+        levels = [heatmap] + build_pyramid(heatmap, self.min_side)
+        nbytes = 0
+        for level, level_img in enumerate(levels):
+            path = level_path(os.path.join(self.path, file), level)
+            if compact:
+                nbytes += write_heatmap(path, level_img, dtype=self.quantization, codec=self.codec)
+            else:
+                nbytes += save_atomic(path, level_img)
+        entry = dict(info,
+                     file=file,
+                     shape=list(heatmap.shape),
+                     dtype=str(heatmap.dtype),
+                     levels=len(levels),
+                     bytes=nbytes)
+        if compact:
+            entry.update(quantization=self.quantization, codec=self.codec)
+        return entry
+    
+
+    def flush(self):
+        os.makedirs(self.path, exist_ok=True)
+        dump_json_atomic(os.path.join(self.path, self.index_name), self.index)
+
+
+def dicom_id_from_img_path(img_path):
+    return img_path.split('/')[-1].split('.')[0]
+
+
+_OPCODES = {op.code.encode('latin-1'): op for op in pickletools.opcodes}
+_LENGTH_BYTES = {pickletools.TAKEN_FROM_ARGUMENT1: 1,
+                 pickletools.TAKEN_FROM_ARGUMENT4: 4,
+                 pickletools.TAKEN_FROM_ARGUMENT4U: 4,
+                 pickletools.TAKEN_FROM_ARGUMENT8U: 8}
+_UNICODE_OPS = {'SHORT_BINUNICODE', 'BINUNICODE', 'BINUNICODE8'}
+
+
+def read_pickled_fields(npy_path, keys=('img_path', 'id'), max_len=4096):
+    """reads string values of :param keys: from a np.save'd pickled dict
+    without unpickling it. The pickle's opcodes are walked and every long
+    payload, such as the heatmap's bytes, is seeked over instead of read.
+    A key's value is the first string following it.
+    returns a dict with the keys found"""
+    found = {}
+    pending = None
+    with open(npy_path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            np.lib.format.read_array_header_1_0(f)
+        else:
+            np.lib.format.read_array_header_2_0(f)
+
+        while len(found) < len(keys):
+            code = f.read(1)
+            if code == b'' or code not in _OPCODES:
+                raise ValueError('unexpected pickle content in {}'.format(npy_path))
+            op = _OPCODES[code]
+            if op.name == 'STOP':
+                break
+            if op.arg is None:
+                continue
+
+            n = op.arg.n
+            if op.arg.name == 'stringnl_noescape_pair':
+                f.readline()
+                f.readline()
+                continue
+            if n == pickletools.UP_TO_NEWLINE:
+                f.readline()
+                continue
+            if n >= 0:
+                f.seek(n, os.SEEK_CUR)
+                continue
+
+            length = int.from_bytes(f.read(_LENGTH_BYTES[n]), 'little')
+            if op.name not in _UNICODE_OPS or length > max_len:
+                f.seek(length, os.SEEK_CUR)
+                continue
+            
+            value = f.read(length).decode('utf-8', 'surrogatepass')
+            if pending is not None:
+                found[pending] = value
+                pending = None
+            elif value in keys and value not in found:
+                pending = value
+    return found
+
+
+def read_heatmap_owner(npy_path):
+    """returns (dicom_id, reflacx_id) of a pickled heatmap file, reading only
+    what's needed. Falls back to unpickling if the fields aren't found"""
+    try:
+        fields = read_pickled_fields(npy_path)
+    except ValueError:
+        fields = {}
+    if 'img_path' not in fields or 'id' not in fields:
+        fields = np.load(npy_path, allow_pickle=True).item()
+    return dicom_id_from_img_path(fields['img_path']), fields['id']
+
+
+def load_heatmap(path):
+    """loads a heatmap normalized to [0, 1] as a read only array.
+    .npy files from a HeatmapStore are memory-mapped, .hmz ones decoded,
+    pickled files from generate_heatmaps.py are unpickled and normalized"""
+    record_file('heatmap', path)
+    if is_compact(path):
+        hm = decode_into(path)
+        hm.setflags(write=False)
+        return hm
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        # pickled dict, can't be memory-mapped
+        hm = np.load(path, allow_pickle=True).item()['np_image']
+        hm = normalize(hm, type=hm.dtype)
+        hm.setflags(write=False)
+        return hm
+
+
+def read_heatmap_into(path, out):
+    """reads the heatmap at :param path:, normalized to [0, 1], into
+    :param out:, a preallocated float array of its shape. .hmz files are
+    decoded straight into it. returns out"""
+    if is_compact(path):
+        record_file('heatmap', path)
+        return decode_into(path, out)
+    np.copyto(out, load_heatmap(path), casting='same_kind')
+    return out
+
+
+def level_path(path, level):
+    """path of a pyramid level of the heatmap at :param path:, itself for
+    level 0"""
+    if level == 0:
+        return path
+    root, extension = os.path.splitext(path)
+    return '{}.{}{}'.format(root, level, extension)
+
+
+@instrumented('heatmap_store.load_heatmap_levels')
+def load_heatmap_levels(path):
+    """returns a heatmap's pyramid levels, full resolution first. Only
+    HeatmapStore files have more than one. The levels of .hmz files are all
+    decoded"""
+    levels = [load_heatmap(path)]
+    while os.path.exists(level_path(path, len(levels))):
+        path_level = level_path(path, len(levels))
+        levels.append(load_heatmap(path_level) if is_compact(path_level)
+                      else np.load(path_level, mmap_mode='r'))
+    return levels
+
+
+def convert_heatmaps(reflacx_dir,
+                     heatmaps_search_term='heatmaps_phase_',
+                     store_search_term='heatmaps_store_phase_',
+                     quantization=None,
+                     codec='zlib',
+                     flush_every=100):
+    """converts every pickled heatmaps folder in :param reflacx_dir: to a
+    HeatmapStore, of .hmz files if :param quantization: is given. Heatmaps
+    already in the store are skipped without being unpickled, and the
+    store's index is written every :param flush_every: heatmaps, so an
+    interrupted conversion resumes where it stopped.
+    returns a dict of reflacx_id: path of its converted heatmap"""
+    converted = {}
+    for dir in sorted(os.listdir(reflacx_dir)):
+        if heatmaps_search_term not in dir:
+            continue
+        src = os.path.join(reflacx_dir, dir)
+        store = HeatmapStore(os.path.join(reflacx_dir,
+                                          dir.replace(heatmaps_search_term,
+                                                      store_search_term)),
+                             quantization=quantization,
+                             codec=codec)
+        print("converting {} to {}".format(src, store.path))
+        puts = 0
+        for count, npy in enumerate(sorted(os.listdir(src))):
+            if not npy.endswith('.npy'):
+                continue
+            if count % 100 == 0:
+                print("converting {}th npy".format(count))
+            path = os.path.join(src, npy)
+            _, reflacx_id = read_heatmap_owner(path)
+            if reflacx_id not in store:
+                info = np.load(path, allow_pickle=True).item()
+                info = {k: v.item() if isinstance(v, np.generic) else v
+                        for k, v in info.items()}
+                reflacx_id = info.pop('id')
+                hm = info.pop('np_image')
+                store.put(reflacx_id,
+                          normalize(hm, type=np.float32),
+                          dicom_id=dicom_id_from_img_path(info['img_path']),
+                          source=npy,
+                          **info)
+                puts += 1
+                if puts % flush_every == 0:
+                    store.flush()
+            converted[reflacx_id] = store.array_path(reflacx_id)
+        store.flush()
+    return converted
+
+
+def update_full_meta(full_meta_path, converted):
+    """points the heatmaps of an existing full_meta.json to converted files"""
+    with open(full_meta_path) as f:
+        metadata = json.load(f)
+    for dicom_id in metadata:
+        for reflacx_id in metadata[dicom_id]:
+            if reflacx_id in converted:
+                metadata[dicom_id][reflacx_id]['heatmaps'] = converted[reflacx_id]
+    dump_json_atomic(full_meta_path, metadata)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='converts pickled heatmaps to memory-mappable ones')
+    parser.add_argument('reflacx_dir')
+    parser.add_argument('--full-meta', default=None,
+                        help='full_meta.json to point at the converted heatmaps')
+    parser.add_argument('--store-search-term', default='heatmaps_store_phase_')
+    parser.add_argument('--quantization', default=None, choices=QUANTIZATIONS,
+                        help='writes compressed .hmz files of this type instead of .npy')
+    parser.add_argument('--codec', default='zlib', choices=CODECS)
+    parser.add_argument('--flush-every', type=int, default=100,
+                        help='heatmaps converted between writes of the store index')
+    args = parser.parse_args(argv)
+
+    converted = convert_heatmaps(args.reflacx_dir,
+                                 store_search_term=args.store_search_term,
+                                 quantization=args.quantization,
+                                 codec=args.codec,
+                                 flush_every=args.flush_every)
+    if args.full_meta is not None and os.path.exists(args.full_meta):
+        update_full_meta(args.full_meta, converted)
+    print("done")
+
+
+if __name__ == '__main__':
+    main()
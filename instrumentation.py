@@ -0,0 +1,243 @@
+# opt-in instrumentation of dataset access.
+# Methods decorated with @instrumented(name) count their calls and time, and
+# hot paths record the bytes they read and their caches' hits and misses,
+# all in a registry of this process. Timers are inclusive, get_heatmap's
+# counts the time of the get_chest_bounding_box it calls.
+# Disabled, the default, a decorated method only checks a flag before
+# calling through, and nothing else is recorded. Set REFLACX_INSTRUMENT=1 to
+# enable it at import, in worker processes too, each one having its own
+# registry.
+#
+# usage:
+#   import instrumentation
+#   instrumentation.enable()
+#   ... access samples ...
+#   instrumentation.snapshot(), instrumentation.to_json(), instrumentation.to_prometheus()
+#
+#   with instrumentation.profile(trace_memory=True) as session:
+#       ... access samples ...
+#   session.stats, session.print_profile(), session.memory
+
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+_enabled = os.environ.get('REFLACX_INSTRUMENT', '') not in ('', '0')
+_lock = threading.Lock()
+_timers = {}
+_bytes = {}
+_caches = {}
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _bytes.clear()
+        _caches.clear()
+
+
+def record_time(name, seconds):
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            timer = _timers[name] = [0, 0.0, 0.0]
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2] = max(timer[2], seconds)
+
+
+def record_bytes(name, nbytes):
+    """adds :param nbytes: read, or copied, by :param name:"""
+    if not _enabled:
+        return
+    with _lock:
+        _bytes[name] = _bytes.get(name, 0) + int(nbytes)
+
+
+def record_file(name, path):
+    """records the size of a file read whole by :param name:"""
+    if not _enabled:
+        return
+    try:
+        record_bytes(name, os.path.getsize(path))
+    except OSError:
+        pass
+
+
+def record_cache(name, hit):
+    if not _enabled:
+        return
+    with _lock:
+        cache = _caches.get(name)
+        if cache is None:
+            cache = _caches[name] = [0, 0]
+        cache[0 if hit else 1] += 1
+
+
+def instrumented(name):
+    """decorator recording the calls and time of a function as :param name:"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record_time(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """returns {'timers': {name: {'calls', 'seconds', 'mean_ms', 'max_ms'}},
+    'bytes': {name: bytes}, 'caches': {name: {'hits', 'misses', 'hit_rate'}}}"""
+    with _lock:
+        timers = {name: list(timer) for name, timer in _timers.items()}
+        nbytes = dict(_bytes)
+        caches = {name: list(cache) for name, cache in _caches.items()}
+    return {'enabled': _enabled,
+            'timers': {name: {'calls': calls,
+                              'seconds': seconds,
+                              'mean_ms': seconds / calls * 1000,
+                              'max_ms': max_seconds * 1000}
+                       for name, (calls, seconds, max_seconds) in sorted(timers.items())},
+            'bytes': dict(sorted(nbytes.items())),
+            'caches': {name: {'hits': hits,
+                              'misses': misses,
+                              'hit_rate': hits / max(hits + misses, 1)}
+                       for name, (hits, misses) in sorted(caches.items())}}
+
+
+def diff(after, before):
+    """the stats recorded between two snapshots. Max times can't be told
+    apart, those of :param after: are kept"""
+    timers = {}
+    for name, timer in after['timers'].items():
+        old = before['timers'].get(name, {'calls': 0, 'seconds': 0.0})
+        calls = timer['calls'] - old['calls']
+        if calls > 0:
+            seconds = timer['seconds'] - old['seconds']
+            timers[name] = {'calls': calls,
+                            'seconds': seconds,
+                            'mean_ms': seconds / calls * 1000,
+                            'max_ms': timer['max_ms']}
+    nbytes = {name: n - before['bytes'].get(name, 0)
+              for name, n in after['bytes'].items()
+              if n != before['bytes'].get(name, 0)}
+    caches = {}
+    for name, cache in after['caches'].items():
+        old = before['caches'].get(name, {'hits': 0, 'misses': 0})
+        hits = cache['hits'] - old['hits']
+        misses = cache['misses'] - old['misses']
+        if hits + misses > 0:
+            caches[name] = {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses)}
+    return {'enabled': after['enabled'], 'timers': timers, 'bytes': nbytes, 'caches': caches}
+
+
+def to_json(stats=None, path=None):
+    """:param stats: a snapshot, the current one if None, as JSON, written
+    to :param path: if given"""
+    text = json.dumps(stats if stats is not None else snapshot(), indent=2)
+    if path is not None:
+        with open(path, 'w') as f:
+            f.write(text)
+    return text
+
+
+def to_prometheus(stats=None, prefix='reflacx'):
+    """:param stats: a snapshot, the current one if None, in Prometheus'
+    text exposition format"""
+    stats = stats if stats is not None else snapshot()
+    metrics = [('calls_total', 'counter', 'op', {n: t['calls'] for n, t in stats['timers'].items()}),
+               ('seconds_total', 'counter', 'op', {n: t['seconds'] for n, t in stats['timers'].items()}),
+               ('seconds_max', 'gauge', 'op', {n: t['max_ms'] / 1000 for n, t in stats['timers'].items()}),
+               ('bytes_total', 'counter', 'source', stats['bytes']),
+               ('cache_hits_total', 'counter', 'cache', {n: c['hits'] for n, c in stats['caches'].items()}),
+               ('cache_misses_total', 'counter', 'cache', {n: c['misses'] for n, c in stats['caches'].items()})]
+    lines = []
+    for metric, kind, label, values in metrics:
+        if len(values) == 0:
+            continue
+        lines.append('# TYPE {}_{} {}'.format(prefix, metric, kind))
+        lines += ['{}_{}{{{}="{}"}} {}'.format(prefix, metric, label, name, value)
+                  for name, value in values.items()]
+    return '\n'.join(lines) + '\n'
+
+
+class ProfileSession:
+    """results of a profile() block, set when it exits. stats are the
+    instrumentation stats recorded in the block, profile a pstats.Stats if
+    it was profiled, memory {'current', 'peak', 'top'} if memory was traced,
+    top being the lines that allocated the most"""
+    def __init__(self):
+        self.stats = None
+        self.profile = None
+        self.memory = None
+
+
+    def print_profile(self, sort='cumulative', limit=30):
+        import io
+        stream = io.StringIO()
+        self.profile.stream = stream
+        self.profile.sort_stats(sort).print_stats(limit)
+        print(stream.getvalue())
+
+
+@contextmanager
+def profile(cprofile=True, trace_memory=False, top=20, out_path=None):
+    """enables instrumentation over a block, profiling it with cProfile and
+    tracing its allocations with tracemalloc if asked.
+    :param out_path: optional file the cProfile stats are dumped to, for
+    snakeviz and the like.
+    yields a ProfileSession"""
+    import cProfile
+    import pstats
+    import tracemalloc
+    was_enabled = _enabled
+    enable()
+    session = ProfileSession()
+    before = snapshot()
+    profiler = cProfile.Profile() if cprofile else None
+    was_tracing = tracemalloc.is_tracing()
+    if trace_memory and not was_tracing:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield session
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            session.profile = pstats.Stats(profiler)
+            if out_path is not None:
+                profiler.dump_stats(out_path)
+        if trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            allocations = tracemalloc.take_snapshot().statistics('lineno')[:top]
+            if not was_tracing:
+                tracemalloc.stop()
+            session.memory = {'current': current,
+                              'peak': peak,
+                              'top': [str(stat) for stat in allocations]}
+        session.stats = diff(snapshot(), before)
+        if not was_enabled:
+            disable()
@@ -1,12 +1,25 @@
 from rlogger import RLogger
-import os
-from tools import csv2dictlist
 import json
+import os
+import time
 import numpy as np
-from random import randint
 
 from reflacx_sample import ReflacxSample
 from dicom_imgs import DicomImgs
+from metadata_builder import build_metadata, build_settings, refresh_metadata
+from metadata_store import SampleIndex, make_store
+from table_store import TableStore
+from alignment import align_batch
+from batch_loader import epoch_indices, iter_batches
+from prefetch import DEFAULT_FIELDS, PrefetchedSamples, prefetch, aprefetch
+from validity import ValidityManifest
+from rendering import Renderer
+from heatmap_store import HeatmapStore
+from consensus import consensus_heatmap, consensus_key, is_fresh, readers
+from pyramid import resample
+from fixation_index import FixationIndex, build_fixation_index
+from tools import dump_json_atomic, file_digest
+from instrumentation import instrumented
 
 
 class Metadata:
@@ -16,209 +29,381 @@ class Metadata:
                  full_meta_path,
                  reflacx_main_data_dir='main_data',
                  heatmaps_search_term='heatmaps_phase_',
+                 heatmap_store_search_term='heatmaps_store_phase_',
                  metadata_search_term='metadata',
                  exclude_invalid_eyetracking=True,
                  max_dicom_lib_ram_percent=60,
                  valid_img_only=False,
-                 valid_fixations_only=False):
+                 valid_fixations_only=False,
+                 scan_workers=32,
+                 backend='json',
+                 pixel_cache_dir=None,
+                 shared_imgs=None,
+                 tables_dir=None,
+                 refresh=False,
+                 consensus_dir=None,
+                 max_prefetched=256,
+                 fixation_index_dir=None):
+        """param:backend is where metadata is kept, 'json' for full_meta.json
+        and its index files, 'sqlite' for a single indexed file next to it,
+        see metadata_store.py
+        param:pixel_cache_dir optional folder of decoded DICOM pixels, see
+        dicom_imgs.PixelCache
+        param:shared_imgs optional shared_imgs.SharedImgs, created in the main
+        process, making every worker share the same images under a single
+        memory budget. max_dicom_lib_ram_percent is then the coordinator's
+        param:tables_dir optional folder built by table_store.py, from which
+        samples read fixations, transcription timestamps, chest bounding
+        boxes and anomaly ellipses instead of parsing their csvs
+        valid_img_only and valid_fixations_only are checked without decoding
+        images, and their results kept for later runs, see validity.py
+        param:refresh rescans the sources that changed since metadata was
+        built, and patches it, see Metadata.refresh. Metadata built with
+        other settings, see has_current_sources, is always refreshed
+        param:consensus_dir optional folder where consensus heatmaps are
+        kept, see consensus.py
+        param:max_prefetched the number of prefetched samples kept, with
+        their loaded fields, see Metadata.prefetch
+        param:fixation_index_dir optional folder where the index of every
+        sample's fixations is kept, see fixation_index.py"""
         
+        # to open the same metadata in worker processes, see batch_loader.py
+        self.init_kwargs = {k: v for k, v in locals().items() if k != 'self'}
+        # workers open metadata this process already refreshed
+        self.init_kwargs['refresh'] = False
         self.log = RLogger(__name__, self.__class__.__name__)
-        self.imgs_lib = DicomImgs(max_ram_percent=max_dicom_lib_ram_percent)
+        if shared_imgs is None:
+            self.imgs_lib = DicomImgs(max_ram_percent=max_dicom_lib_ram_percent,
+                                      cache_dir=pixel_cache_dir)
+        else:
+            from shared_imgs import SharedDicomImgs
+            self.imgs_lib = SharedDicomImgs(shared_imgs.index, cache_dir=pixel_cache_dir)
+        
+        self.tables = TableStore(tables_dir) if tables_dir is not None else None
+        self.renderer = Renderer()
+        self.consensus = HeatmapStore(consensus_dir) if consensus_dir is not None else None
+        self.prefetched = PrefetchedSamples(max_prefetched)
+        self.fixation_index_dir = fixation_index_dir
+        self.fixation_index = None
         
         self.valid_img_only = valid_img_only
         self.valid_fixations_only = valid_fixations_only        
+        self.scan_workers = scan_workers
+        self.validity = ValidityManifest(full_meta_path)
+        self.sources_path = os.path.join(os.path.dirname(full_meta_path), 'sources.json')
         
-        full_meta_dir = full_meta_path.rpartition(os.sep)[0]
-        mk_pth = lambda s: os.sep.join([full_meta_dir, s])
-        reflacx_idx_path = mk_pth('reflacx_idx.json')
-        idx_path = mk_pth('idx.json')
-        splits_path = mk_pth('splits.json')
+        self.store = make_store(full_meta_path, backend)
         print("loading metadata")
-        if os.path.exists(full_meta_path):
-            with open(full_meta_path) as f:
-                self.metadata = json.load(f)
-                print("metadata loaded from file")
-            if (os.path.exists(reflacx_idx_path) and
-                os.path.exists(idx_path) and
-                os.path.exists(splits_path)):
-                with open(reflacx_idx_path, 'r') as f:
-                    self.reflacx_idx = json.load(f)
-                with open(idx_path, 'r') as f:
-                    self.idx = json.load(f)
-                    self.idx = {int(k): self.idx[k] for k in self.idx}
-                with open(splits_path, 'r') as f:
-                    self.splits = json.load(f)
-                    self.splits = {int(k): self.splits[k] for k in self.splits}
+        start = time.time()
+        if self.store.exists():
+            self.store.load()
+            print("metadata loaded from file in {:.2f}s".format(time.time() - start))
+            if refresh or not self.has_current_sources():
+                self.refresh()
+            if self.store.has_idx() and self.validity.filters not in (None, self.filters()):
+                print("indices were built with other filters. calculating indices")
+                self.make_idx()
+            elif self.store.has_idx():
                 print("indices loaded from file")
             else:
                 print("missing indices' files. calculating indices")
-                self.make_idx(reflacx_idx_path, idx_path, splits_path)            
+                self.make_idx()
             return
         
-        print("file not found, generating metadata from reflacx and mimic. This will take about 20 min.")
-        
-        main_data_dir = "{}{}{}".format(reflacx_dir,
-                                        os.sep,
-                                        reflacx_main_data_dir)
-        reflacx_metadata = []
-        for metadata_file in [item
-                            for item in os.listdir(main_data_dir)
-                            if metadata_search_term in item]:
-            phase = int(metadata_file.split("_")[-1].split('.')[0])
-            md = csv2dictlist("{}{}{}".format(main_data_dir,
-                              os.sep,
-                              metadata_file))
-            reflacx_metadata += [(phase, x) for x in md]
+        print("file not found, generating metadata from reflacx and mimic.")
         
-        dicom_metadata = {}
-        
-        print("grouping reflacx metadata by dicom_id")
-        for phase, item in reflacx_metadata:
-            if (item.pop('eye_tracking_data_discarded') in ['TRUE', 'True', 'true']
-                and exclude_invalid_eyetracking):
-                continue
-
-            dicom_id = item.pop('dicom_id')
-            if dicom_id not in dicom_metadata:
-                dicom_metadata[dicom_id] = {}
-            
-            id = item.pop('id')
-            if id not in dicom_metadata[dicom_id]:
-                dicom_metadata[dicom_id][id] = {}
-            
-            item['image'] = "{}{}{}.dcm".format(mimic_dir, os.sep, dicom_id)
-            eyetracking_path = "{}{}{}{}{}".format(reflacx_dir,
-                                                os.sep,
-                                                reflacx_main_data_dir,
-                                                os.sep,
-                                                id)
-            for eyetracking_file in os.listdir(eyetracking_path):
-                item[eyetracking_file.split('.')[0]] = "{}{}{}".format(eyetracking_path,
-                                                                    os.sep,
-                                                                    eyetracking_file)
-            dicom_metadata[dicom_id][id] = item
-            dicom_metadata[dicom_id][id]['phase'] = phase
-        print("grouping heatmaps")
-        for dir in [item for item in os.listdir(reflacx_dir) if heatmaps_search_term in item]:
-            path = "{}{}{}".format(reflacx_dir, os.sep, dir)
-            print("getting heatmaps from {}".format(path))
-            for count, npy in enumerate(os.listdir(path)):
-                if count % 100 == 0:
-                    print("loading {}th npy".format(count))
-                npy_path = "{}{}{}".format(path, os.sep, npy)
-                heatmap = np.load(npy_path, allow_pickle=True).item()
-                dicom_id = heatmap.pop('img_path').split('/')[-1].split('.')[0]
-                id = heatmap.pop('id')
-                dicom_metadata[dicom_id][id]['heatmaps'] = npy_path
-
-        self.metadata = dicom_metadata
-        self.make_idx(reflacx_idx_path, idx_path, splits_path)
-
-
-        with open(full_meta_path, 'w') as f:
-            json.dump(self.metadata, f)
+        metadata, sources = build_metadata(reflacx_dir,
+                                           mimic_dir,
+                                           reflacx_main_data_dir=reflacx_main_data_dir,
+                                           heatmaps_search_term=heatmaps_search_term,
+                                           heatmap_store_search_term=heatmap_store_search_term,
+                                           metadata_search_term=metadata_search_term,
+                                           exclude_invalid_eyetracking=exclude_invalid_eyetracking,
+                                           workers=scan_workers,
+                                           return_sources=True)
+        self.store.save_metadata(metadata)
+        dump_json_atomic(self.sources_path, sources)
+        self.make_idx()
         
         print("done")
 
     
-    def make_idx(self, reflacx_idx_path, idx_path, splits_path):
-        self.reflacx_idx = {}
-        self.idx = {}
-        self.splits = {}
-        i = 0
-        for did in self.metadata:
-            for rid in self.metadata[did]:
-                if self.valid_fixations_only or self.valid_img_only:
-                    sample = self.get_sample(did, rid)
-                    if ((sample.get_dicom_img() is None and self.valid_img_only) or
-                        (len(sample.get_fixations()) == 0 and self.valid_fixations_only)):
-                        continue
-                self.reflacx_idx[rid] = did
-                self.idx[i] = rid
-                phase = self.metadata[did][rid]['phase']
-                split = self.metadata[did][rid]['split']
-                if phase not in self.splits:
-                    self.splits[phase] = {}
-                if split not in self.splits[phase]:
-                    self.splits[phase][split] = []
-                self.splits[phase][split].append(i)
-                i += 1
-
-        with open(reflacx_idx_path, 'w') as f:
-            json.dump(self.reflacx_idx, f)
-        with open(idx_path, 'w') as f:
-            json.dump(self.idx, f)
-        with open(splits_path, 'w') as f:
-            json.dump(self.splits, f)
+    def has_current_sources(self):
+        """whether the metadata's sources.json was made with the current
+        build_settings. Metadata built otherwise, or before they were
+        recorded, may keep samples it shouldn't and is refreshed on load"""
+        if not os.path.exists(self.sources_path):
+            return False
+        with open(self.sources_path) as f:
+            settings = json.load(f).get('settings')
+        if settings != build_settings(self.init_kwargs['exclude_invalid_eyetracking']):
+            print("metadata was built with other settings {}".format(settings))
+            return False
+        return True
+
+
+    @instrumented('metadata.refresh')
+    def refresh(self):
+        """rescans only the metadata csvs, trial folders and heatmaps folders
+        that changed since the last build or refresh, patches the store and
+        recalculates indices if anything changed.
+        returns a dict of 'added', 'removed' and 'updated' reflacx_ids"""
+        start = time.time()
+        sources = {}
+        if os.path.exists(self.sources_path):
+            with open(self.sources_path) as f:
+                sources = json.load(f)
+        else:
+            print("no fingerprints of metadata sources, rescanning everything")
+        
+        current = {rid: (did, data) for did, rid, data in self.store.items()}
+        kwargs = self.init_kwargs
+        upserts, removed, sources = refresh_metadata(current,
+                                                     sources,
+                                                     kwargs['reflacx_dir'],
+                                                     kwargs['mimic_dir'],
+                                                     reflacx_main_data_dir=kwargs['reflacx_main_data_dir'],
+                                                     heatmaps_search_term=kwargs['heatmaps_search_term'],
+                                                     heatmap_store_search_term=kwargs['heatmap_store_search_term'],
+                                                     metadata_search_term=kwargs['metadata_search_term'],
+                                                     exclude_invalid_eyetracking=kwargs['exclude_invalid_eyetracking'],
+                                                     workers=self.scan_workers)
+        report = {'added': [rid for rid in upserts if rid not in current],
+                  'removed': [rid for rid in removed if rid not in upserts],
+                  'updated': [rid for rid in upserts if rid in current]}
+        if len(upserts) > 0 or len(removed) > 0:
+            self.prefetched.clear()
+            self.fixation_index = None
+            self.store.update_samples(upserts, removed)
+            self.make_idx()
+        dump_json_atomic(self.sources_path, sources)
+        print("refreshed in {:.1f}s: {} added, {} removed, {} updated".format(time.time() - start,
+                                                                             len(report['added']),
+                                                                             len(report['removed']),
+                                                                             len(report['updated'])))
+        return report
+    
+
+    def filters(self):
+        return {'valid_img_only': self.valid_img_only,
+                'valid_fixations_only': self.valid_fixations_only}
+    
+
+    @instrumented('metadata.make_idx')
+    def make_idx(self):
+        items = list(self.store.items())
+        valid = None
+        if self.valid_fixations_only or self.valid_img_only:
+            start = time.time()
+            valid = self.validity.check(items,
+                                        check_img=self.valid_img_only,
+                                        check_fixations=self.valid_fixations_only,
+                                        tables=self.tables,
+                                        pixel_cache=self.imgs_lib.pixel_cache,
+                                        workers=self.scan_workers)
+            print("checked {} samples in {:.1f}s, {} invalid".format(len(valid),
+                                                                   time.time() - start,
+                                                                   len(valid) - sum(valid.values())))
+        index = SampleIndex.build((rid, did, data['phase'], data['split'])
+                                  for did, rid, data in items
+                                  if valid is None or valid[rid])
+        self.store.save_idx(index)
+        self.validity.save(self.filters())
                 
     
     def get_split(self, split, phase=None):
-        #TODO add asserts
-        if phase is not None:
-            return self.splits[phase][split].copy()
-        result = []
-        for phase in self.splits:
-            result += self.splits[phase][split].copy()
-        return result
+        """returns the indices of a split's samples, as a read only int32
+        array, of :param phase: only if given"""
+        return self.store.get_split(split, phase)
     
 
     def get_phase(self, phase):
-        result = []
-        for split in self.splits[phase]:
-            result += self.splits[phase][split].copy()
-        return result
+        return self.store.get_phase(phase)
     
     
     def list_dicom_ids(self, n_samples=None, reverse=False, random_samples=False):
-        if n_samples is None:
-            n_samples = len(self.metadata)
-        else:
-            n_samples = min(n_samples, len(self.metadata))
-        if not random_samples:
-            result = (list(self.metadata.keys())[:n_samples]
-                      if not reverse
-                      else list(self.metadata.keys())[-n_samples:])
-        else:
-            keys = list(self.metadata.keys())
-            result = [keys.pop(randint(0, len(keys) - 1))
-                      for i in range(n_samples)]
-            
-        return result
+        return self.store.list_dicom_ids(n_samples, reverse, random_samples)
     
     
     def list_reflacx_ids(self, dicom_id):
-        if dicom_id in self.metadata:
-            return list(self.metadata[dicom_id].keys())
-        return []
+        return self.store.list_reflacx_ids(dicom_id)
     
 
+    @instrumented('metadata.get_sample')
     def get_sample(self, dicom_id, reflacx_id):
+        sample = self.prefetched.get(reflacx_id)
+        if sample is not None and sample.dicom_id == dicom_id:
+            return sample
         try:
             return ReflacxSample(dicom_id,
                                  reflacx_id,
-                                 self.metadata[dicom_id][reflacx_id],
-                                 imgs_lib=self.imgs_lib)
+                                 self.store.get(dicom_id, reflacx_id),
+                                 imgs_lib=self.imgs_lib,
+                                 tables=self.tables,
+                                 renderer=self.renderer)
         except KeyError:
             self.log("missing pair from metadata: {} --- {}".format(dicom_id, reflacx_id), False)
             return None
         
 
     def get_sample_r(self, reflacx_id):
-        return self.get_sample(self.reflacx_idx[reflacx_id], reflacx_id)
+        return self.get_sample(self.store.dicom_id(reflacx_id), reflacx_id)
     
 
     def __getitem__(self, i):
-        rid = self.idx[i]
+        rid = self.store.reflacx_id(int(i))
         return self.get_sample_r(rid)
     
     
     def __len__(self):
-        return len(self.idx)
+        return len(self.store)
         
 
-    def get_dicom_img(self, dicom_id):
+    def prefetch(self, indices, fields=DEFAULT_FIELDS, concurrency=16):
+        """loads :param fields: of the samples of :param indices: ahead of
+        use, over :param concurrency: threads, blocking until they're
+        loaded. Images go to the DicomImgs cache, and the samples, with
+        their other fields loaded, are handed out by get_sample and
+        __getitem__ until max_prefetched newer ones are prefetched.
+        fields are among prefetch.FIELDS.
+        returns {'loaded', 'skipped'}, counts of fields, see prefetch.py"""
+        return prefetch(self.prefetch_samples(indices), fields, concurrency)
+
+
+    async def aprefetch(self, indices, fields=DEFAULT_FIELDS, concurrency=16):
+        """prefetch, awaitable from an event loop"""
+        return await aprefetch(self.prefetch_samples(indices), fields, concurrency)
+
+
+    def prefetch_samples(self, indices):
+        samples = []
+        for i in indices:
+            sample = self[i]
+            if sample is not None:
+                self.prefetched.put(sample)
+                samples.append(sample)
+        return samples
+
+
+    @instrumented('metadata.get_timed_sentences')
+    def get_timed_sentences(self, indices):
+        """returns the timed sentences of many samples, aligning all their
+        fixations at once. Each sample's result is also cached in it, if
+        it's used again"""
+        samples = [self[i] for i in indices]
+        results = align_batch([(sample.get_sentences(), sample.get_fixations())
+                               for sample in samples],
+                              return_indices=True)
+        for sample, (timed_sentences, sentence_indices) in zip(samples, results):
+            sample.timed_sentences = timed_sentences
+            sample.sentence_indices = sentence_indices
+        return [timed_sentences for timed_sentences, _ in results]
+    
+
+    def iter_split(self,
+                   split,
+                   phase=None,
+                   batch_size=32,
+                   fields=('img', 'heatmap', 'fixations'),
+                   size=None,
+                   workers=4,
+                   prefetch=8,
+                   executor='thread',
+                   shuffle=True,
+                   seed=0,
+                   epoch=0,
+                   rank=0,
+                   world_size=1,
+                   drop_last=False):
+        """yields batches of a split's samples, as dicts of field: values,
+        see batch_loader.py for fields and executors.
+        The order is set by :param seed: and :param epoch:, and each of
+        :param world_size: ranks gets its own share of the epoch, all of the
+        same length"""
+        indices = epoch_indices(self.get_split(split, phase),
+                                shuffle=shuffle,
+                                seed=seed,
+                                epoch=epoch,
+                                rank=rank,
+                                world_size=world_size)
+        return iter_batches(self,
+                            indices,
+                            batch_size=batch_size,
+                            fields=fields,
+                            size=size,
+                            workers=workers,
+                            prefetch=prefetch,
+                            executor=executor,
+                            drop_last=drop_last)
+    
+
+    @instrumented('metadata.get_consensus_heatmap')
+    def get_consensus_heatmap(self, dicom_id, weighting='uniform', chest_only=False, size=None):
+        """returns the weighted mean of the heatmaps of every reader of
+        :param dicom_id:, normalized to [0, 1], see consensus.py.
+        If :param chest_only:, it's cropped to the union of the readers'
+        chest bounding boxes and normalized to sum 1.
+        :param size: optional (width, height) of the result.
+        With a consensus_dir, it's computed once and read from there.
+        returns None if :param chest_only: and no reader has a chest
+        bounding box"""
+        samples = [self.get_sample(dicom_id, rid) for rid in self.list_reflacx_ids(dicom_id)]
+        key = consensus_key(dicom_id, weighting)
+        if self.consensus is not None and is_fresh(self.consensus, samples, weighting):
+            levels = self.consensus.get_levels(key)
+        else:
+            heatmap, info = consensus_heatmap(samples, weighting)
+            levels = [heatmap]
+            if self.consensus is not None:
+                self.consensus.put(key, heatmap, **info)
+                self.consensus.flush()
+                levels = self.consensus.get_levels(key)
+
+        if not chest_only:
+            if size is None:
+                return levels[0]
+            result = resample(levels, size)
+            top = np.max(result)
+            return result / top if top > 0 else result
+
+        crops = np.array([sample.chest_crop()
+                          for sample in readers(samples)
+                          if sample.get_chest_bounding_box() is not None])
+        if len(crops) == 0:
+            return None
+        crop = (crops[:, 0].min(), crops[:, 1].min(), crops[:, 2].max(), crops[:, 3].max())
+        result = resample(levels, size, crop)
+        total = np.sum(result)
+        return result / total if total > 0 else result
+    
+
+    def get_fixation_index(self):
+        """returns the FixationIndex of every sample's fixations, valid or
+        not, see fixation_index.py. With a fixation_index_dir, it's built
+        once and read from there, until refresh changes the metadata"""
+        if self.fixation_index is not None:
+            return self.fixation_index
+        sources = file_digest(self.sources_path)
+        path = self.fixation_index_dir
+        if path is not None and FixationIndex.exists(path):
+            index = FixationIndex.load(path)
+            if index.sources == sources:
+                self.fixation_index = index
+                return index
+        print("indexing fixations")
+        index = build_fixation_index((self.get_sample(did, rid) for did, rid, _ in self.store.items()),
+                                     sources=sources,
+                                     workers=self.scan_workers)
+        if path is not None:
+            index.save(path)
+        self.fixation_index = index
+        return index
+
+
+    @instrumented('metadata.get_dicom_img')
+    def get_dicom_img(self, dicom_id, copy=False, size=None):
         sample = self.get_sample(dicom_id, self.list_reflacx_ids(dicom_id)[0])
-        return sample.get_dicom_img()
+        return sample.get_dicom_img(copy=copy, size=size)
         
 
     def debug_fixation(self, dicom_id, reflacx_id, fixation_idx, stdevs=1):
@@ -0,0 +1,275 @@
+# builds the dict of dicom_id -> reflacx_id -> sample data used by Metadata
+# from REFLACX's main_data folder and its heatmaps folders.
+# Trial folders are listed concurrently and pickled heatmaps have only the
+# fields needed to place them read, see heatmap_store.read_heatmap_owner.
+# refresh_metadata rescans only the csvs, trial folders and heatmaps folders
+# whose fingerprints changed since the last build, and every csv's rows if
+# they were read with other settings, see build_settings
+
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tools import csv2dictlist
+from heatmap_store import HeatmapStore, read_heatmap_owner
+
+# bumped when csv rows are read differently, so metadata built before reads
+# them again on its next refresh
+FORMAT_VERSION = 2
+
+
+def build_settings(exclude_invalid_eyetracking):
+    """what the samples kept from the metadata csvs' rows depend on, other
+    than the csvs themselves"""
+    return {'format_version': FORMAT_VERSION,
+            'exclude_invalid_eyetracking': bool(exclude_invalid_eyetracking)}
+
+
+def list_files(path):
+    """returns a dict of filename without extension: full path"""
+    with os.scandir(path) as it:
+        return {entry.name.split('.')[0]: entry.path
+                for entry in it
+                if entry.is_file()}
+
+
+def metadata_csvs(main_data_dir, metadata_search_term='metadata'):
+    """returns a sorted list of (phase, filename) of the phases' metadata csvs"""
+    return [(int(metadata_file.split("_")[-1].split('.')[0]), metadata_file)
+            for metadata_file in sorted([item
+                                         for item in os.listdir(main_data_dir)
+                                         if metadata_search_term in item])]
+
+
+def read_reflacx_metadata(main_data_dir, metadata_search_term='metadata'):
+    """returns a list of (phase, row dict) for every row of every phase's
+    metadata csv"""
+    reflacx_metadata = []
+    for phase, metadata_file in metadata_csvs(main_data_dir, metadata_search_term):
+        md = csv2dictlist(os.path.join(main_data_dir, metadata_file))
+        reflacx_metadata += [(phase, x) for x in md]
+    return reflacx_metadata
+
+
+def file_stamp(path):
+    """[mtime_ns, size] of a file or folder, None if it doesn't exist"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def scan_trials(main_data_dir, reflacx_ids, workers=32):
+    """lists the files of every trial folder over a thread pool.
+    returns a dict of reflacx_id: result of list_files"""
+    paths = [os.path.join(main_data_dir, id) for id in reflacx_ids]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(zip(reflacx_ids, pool.map(list_files, paths)))
+
+
+def heatmap_dirs(reflacx_dir,
+                 heatmaps_search_term='heatmaps_phase_',
+                 heatmap_store_search_term='heatmaps_store_phase_'):
+    """returns (path, is_store) of every heatmaps folder, in increasing
+    order of precedence"""
+    listing = sorted(os.listdir(reflacx_dir))
+    return ([(os.path.join(reflacx_dir, dir), False)
+             for dir in listing if heatmaps_search_term in dir] +
+            [(os.path.join(reflacx_dir, dir), True)
+             for dir in listing if heatmap_store_search_term in dir])
+
+
+def heatmap_dir_stamp(path, is_store):
+    """changes whenever heatmaps are added to or removed from a folder"""
+    if is_store:
+        return file_stamp(os.path.join(path, HeatmapStore.index_name))
+    return [file_stamp(path), file_stamp(os.path.join(path, 'manifest.json'))]
+
+
+def read_heatmap_dir(path, is_store, workers=32):
+    """returns a list of (dicom_id, reflacx_id, heatmap path) of a folder.
+    Pickled heatmaps are placed by their folder's manifest.json, if there is
+    one, and by reading their pickle's header otherwise"""
+    print("getting heatmaps from {}".format(path))
+    if is_store:
+        store = HeatmapStore(path)
+        return [(store.index[id]['dicom_id'], id, store.array_path(id))
+                for id in store.ids()]
+
+    manifest_path = os.path.join(path, 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    
+    with os.scandir(path) as it:
+        npys = sorted(entry.path for entry in it if entry.name.endswith('.npy'))
+    
+    to_read = [npy for npy in npys if os.path.basename(npy) not in manifest]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        owners = dict(zip(to_read, pool.map(read_heatmap_owner, to_read)))
+    result = []
+    for npy in npys:
+        if npy in owners:
+            dicom_id, id = owners[npy]
+        else:
+            entry = manifest[os.path.basename(npy)]
+            dicom_id, id = entry['dicom_id'], entry['id']
+        result.append((dicom_id, id, npy))
+    return result
+
+
+def find_heatmaps(reflacx_dir,
+                  heatmaps_search_term='heatmaps_phase_',
+                  heatmap_store_search_term='heatmaps_store_phase_',
+                  workers=32):
+    """returns a dict of (dicom_id, reflacx_id): heatmap path. Heatmaps in a
+    HeatmapStore take precedence"""
+    heatmaps = {}
+    for path, is_store in heatmap_dirs(reflacx_dir, heatmaps_search_term, heatmap_store_search_term):
+        for dicom_id, id, npy in read_heatmap_dir(path, is_store, workers):
+            heatmaps[(dicom_id, id)] = npy
+    return heatmaps
+
+
+def refresh_metadata(current,
+                     sources,
+                     reflacx_dir,
+                     mimic_dir,
+                     reflacx_main_data_dir='main_data',
+                     heatmaps_search_term='heatmaps_phase_',
+                     heatmap_store_search_term='heatmaps_store_phase_',
+                     metadata_search_term='metadata',
+                     exclude_invalid_eyetracking=True,
+                     workers=32):
+    """rescans only the sources that changed since they were fingerprinted.
+    :param current: dict of reflacx_id: (dicom_id, sample data) already built
+    :param sources: fingerprints returned by the build that made
+    :param current:, {} to scan everything. They are the metadata csvs'
+    mtimes and sizes, each trial folder's mtime and files, and each heatmaps
+    folder's mtime, with the heatmaps it held, and the build_settings rows
+    were read with. Rows of every csv are read again if those differ.
+    returns (upserts, removed, sources), upserts being a dict of reflacx_id:
+    (dicom_id, sample data) of new or changed samples, removed one of
+    reflacx_id: dicom_id of samples that are gone or moved to another
+    dicom_id, and sources the new fingerprints"""
+    main_data_dir = os.path.join(reflacx_dir, reflacx_main_data_dir)
+    old_trials = sources.get('trials', {})
+    settings = build_settings(exclude_invalid_eyetracking)
+    new_sources = {'metadata': {}, 'trials': {}, 'heatmaps': {}, 'settings': settings}
+    same_settings = sources.get('settings') == settings
+
+    # (phase, dicom_id, csv row) of every kept trial. Rows of unchanged csvs
+    # aren't read again, their samples are kept as they are
+    rows = {}
+    for phase, metadata_file in metadata_csvs(main_data_dir, metadata_search_term):
+        path = os.path.join(main_data_dir, metadata_file)
+        stamp = file_stamp(path)
+        new_sources['metadata'][metadata_file] = stamp
+        if same_settings and sources.get('metadata', {}).get(metadata_file) == stamp:
+            rows.update({rid: (phase, did, None)
+                         for rid, (did, data) in current.items()
+                         if data['phase'] == phase})
+            continue
+        for item in csv2dictlist(path):
+            if (str(item.pop('eye_tracking_data_discarded')) in ['TRUE', 'True', 'true']
+                and exclude_invalid_eyetracking):
+                continue
+            id = item.pop('id')
+            rows[id] = (phase, item.pop('dicom_id'), item)
+
+    ids = list(rows.keys())
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        trial_stamps = dict(zip(ids, pool.map(file_stamp,
+                                              [os.path.join(main_data_dir, id) for id in ids])))
+    to_scan = [id for id in ids
+               if id not in current
+               or id not in old_trials
+               or old_trials[id][0] != trial_stamps[id]]
+    print("listing {} trial folders".format(len(to_scan)))
+    trial_files = scan_trials(main_data_dir, to_scan, workers)
+
+    print("grouping heatmaps")
+    heatmaps = {}
+    for path, is_store in heatmap_dirs(reflacx_dir, heatmaps_search_term, heatmap_store_search_term):
+        name = os.path.basename(path)
+        stamp = heatmap_dir_stamp(path, is_store)
+        old = sources.get('heatmaps', {}).get(name)
+        entries = (old['heatmaps']
+                   if old is not None and old['stamp'] == stamp
+                   else read_heatmap_dir(path, is_store, workers))
+        new_sources['heatmaps'][name] = {'stamp': stamp, 'heatmaps': entries}
+        for dicom_id, id, npy in entries:
+            heatmaps[(dicom_id, id)] = npy
+
+    upserts = {}
+    for id, (phase, dicom_id, row) in rows.items():
+        old = current.get(id)
+        if id in trial_files:
+            files = trial_files[id]
+        else:
+            files = {key: old[1][key] for key in old_trials[id][1]}
+        
+        if row is None:
+            old_files = set(old_trials.get(id, [None, []])[1])
+            item = {key: value for key, value in old[1].items()
+                    if key not in old_files and key != 'heatmaps'}
+            item.update(files)
+        else:
+            item = dict(row)
+            item['image'] = "{}{}{}.dcm".format(mimic_dir, os.sep, dicom_id)
+            item.update(files)
+            item['phase'] = phase
+        if (dicom_id, id) in heatmaps:
+            item['heatmaps'] = heatmaps[(dicom_id, id)]
+        new_sources['trials'][id] = [trial_stamps[id], sorted(files)]
+
+        # compared as json, since that's how they're stored, and NaN != NaN
+        if (old is None
+            or old[0] != dicom_id
+            or json.dumps(old[1], sort_keys=True) != json.dumps(item, sort_keys=True)):
+            upserts[id] = (dicom_id, item)
+    
+    removed = {id: dicom_id
+               for id, (dicom_id, _) in current.items()
+               if id not in rows or rows[id][1] != dicom_id}
+    return upserts, removed, new_sources
+
+
+def build_metadata(reflacx_dir,
+                   mimic_dir,
+                   reflacx_main_data_dir='main_data',
+                   heatmaps_search_term='heatmaps_phase_',
+                   heatmap_store_search_term='heatmaps_store_phase_',
+                   metadata_search_term='metadata',
+                   exclude_invalid_eyetracking=True,
+                   workers=32,
+                   return_sources=False):
+    """returns the dict of dicom_id -> reflacx_id -> sample data, and the
+    fingerprints of its sources if :param return_sources:, see
+    refresh_metadata"""
+    start = time.time()
+    upserts, _, sources = refresh_metadata({},
+                                           {},
+                                           reflacx_dir,
+                                           mimic_dir,
+                                           reflacx_main_data_dir=reflacx_main_data_dir,
+                                           heatmaps_search_term=heatmaps_search_term,
+                                           heatmap_store_search_term=heatmap_store_search_term,
+                                           metadata_search_term=metadata_search_term,
+                                           exclude_invalid_eyetracking=exclude_invalid_eyetracking,
+                                           workers=workers)
+
+    dicom_metadata = {}
+    
+    print("grouping reflacx metadata by dicom_id")
+    for id, (dicom_id, item) in upserts.items():
+        if dicom_id not in dicom_metadata:
+            dicom_metadata[dicom_id] = {}
+        dicom_metadata[dicom_id][id] = item
+    
+    print("metadata built in {:.1f}s".format(time.time() - start))
+    if return_sources:
+        return dicom_metadata, sources
+    return dicom_metadata
@@ -0,0 +1,487 @@
+# storage backends for Metadata.
+# JsonMetadataStore is the original format: full_meta.json plus reflacx_idx.json,
+# idx.json and splits.json next to it, loaded at startup. The indices are kept
+# in memory as a SampleIndex, arrays instead of dicts of python objects.
+# SQLiteMetadataStore keeps the same data in a single indexed sqlite file and
+# answers queries from it, so startup doesn't parse anything and each process
+# only holds the rows it asks for.
+#
+# usage: python metadata_store.py <full_meta.json>
+# converts a json store to sqlite and compares both startup times
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from random import randint
+import numpy as np
+
+
+def read_only(array):
+    array.setflags(write=False)
+    return array
+
+
+def string_table(values):
+    """fixed width array of :param values:, a byte per character if they're
+    ascii, as ids are"""
+    try:
+        return np.array(values, dtype=bytes)
+    except UnicodeEncodeError:
+        return np.array(values, dtype=str)
+
+
+def table_key(table, value):
+    return value.encode() if table.dtype.kind == 'S' else value
+
+
+def table_value(table, i):
+    value = table[i]
+    return value.decode() if table.dtype.kind == 'S' else str(value)
+
+
+class SampleIndex:
+    """Indices of the valid samples, in arrays instead of dicts of python
+    objects, so they are small and forked workers reading them don't copy
+    them by touching refcounts.
+    Ids are interned in fixed width string tables, sample i being
+    reflacx_ids[i] of the x-ray dicom_ids[dicom_codes[i]]. splits are
+    {phase: {split: int32 array of sample indices}}, and queries return read
+    only views of them, or of their concatenations by split and by phase,
+    made once"""
+    def __init__(self, reflacx_ids, dicom_ids, dicom_codes, splits):
+        self.reflacx_ids = read_only(string_table(reflacx_ids))
+        self.dicom_ids = read_only(string_table(dicom_ids))
+        self.dicom_codes = read_only(np.asarray(dicom_codes, dtype=np.int32))
+        self.order = read_only(np.argsort(self.reflacx_ids, kind='stable').astype(np.int32))
+        self.splits = {phase: {split: read_only(np.asarray(indices, dtype=np.int32))
+                               for split, indices in phase_splits.items()}
+                       for phase, phase_splits in splits.items()}
+
+        # the same order the dicts of lists used to be concatenated in
+        names = []
+        for phase_splits in self.splits.values():
+            names += [split for split in phase_splits if split not in names]
+        self.by_split = {split: read_only(np.concatenate(
+                             [np.zeros(0, dtype=np.int32)] +
+                             [phase_splits[split] for phase_splits in self.splits.values()
+                              if split in phase_splits]))
+                         for split in names}
+        self.by_phase = {phase: read_only(np.concatenate(
+                             [np.zeros(0, dtype=np.int32)] + list(phase_splits.values())))
+                         for phase, phase_splits in self.splits.items()}
+
+
+    @classmethod
+    def intern(cls, reflacx_ids, dicom_ids, splits):
+        """:param dicom_ids: the dicom_id of each sample"""
+        table, codes = np.unique(string_table(dicom_ids), return_inverse=True)
+        return cls(reflacx_ids, table, codes, splits)
+
+
+    @classmethod
+    def build(cls, samples):
+        """:param samples: (reflacx_id, dicom_id, phase, split) of every
+        valid sample, in index order"""
+        samples = list(samples)
+        splits = {}
+        for i, (_, _, phase, split) in enumerate(samples):
+            splits.setdefault(phase, {}).setdefault(split, []).append(i)
+        return cls.intern([s[0] for s in samples], [s[1] for s in samples], splits)
+
+
+    @classmethod
+    def from_dicts(cls, reflacx_idx, idx, splits):
+        """from the dicts of reflacx_idx.json, idx.json and splits.json"""
+        rids = [idx[i] for i in range(len(idx))]
+        return cls.intern(rids, [reflacx_idx[rid] for rid in rids], splits)
+
+
+    def to_dicts(self):
+        """returns (reflacx_idx, idx, splits), as saved in json"""
+        rids = [table_value(self.reflacx_ids, i) for i in range(len(self))]
+        dids = [table_value(self.dicom_ids, code) for code in self.dicom_codes.tolist()]
+        return (dict(zip(rids, dids)),
+                dict(enumerate(rids)),
+                {phase: {split: indices.tolist() for split, indices in phase_splits.items()}
+                 for phase, phase_splits in self.splits.items()})
+
+
+    def rows(self):
+        """iterates over (i, reflacx_id, phase, split)"""
+        for phase, phase_splits in self.splits.items():
+            for split, indices in phase_splits.items():
+                for i in indices.tolist():
+                    yield i, table_value(self.reflacx_ids, i), phase, split
+
+
+    def position(self, reflacx_id):
+        key = table_key(self.reflacx_ids, reflacx_id)
+        j = np.searchsorted(self.reflacx_ids, key, sorter=self.order)
+        if j == len(self.order) or self.reflacx_ids[self.order[j]] != key:
+            raise KeyError(reflacx_id)
+        return int(self.order[j])
+
+
+    def dicom_id(self, reflacx_id):
+        return table_value(self.dicom_ids, self.dicom_codes[self.position(reflacx_id)])
+
+
+    def reflacx_id(self, i):
+        if not 0 <= i < len(self.reflacx_ids):
+            raise KeyError(i)
+        return table_value(self.reflacx_ids, i)
+
+
+    def get_split(self, split, phase=None):
+        if phase is not None:
+            return self.splits[phase][split]
+        if split not in self.by_split:
+            return read_only(np.zeros(0, dtype=np.int32))
+        return self.by_split[split]
+
+
+    def get_phase(self, phase):
+        return self.by_phase[phase]
+
+
+    def __len__(self):
+        return len(self.reflacx_ids)
+
+
+class JsonMetadataStore:
+    def __init__(self, full_meta_path):
+        self.full_meta_path = full_meta_path
+        full_meta_dir = full_meta_path.rpartition(os.sep)[0]
+        mk_pth = lambda s: os.sep.join([full_meta_dir, s])
+        self.reflacx_idx_path = mk_pth('reflacx_idx.json')
+        self.idx_path = mk_pth('idx.json')
+        self.splits_path = mk_pth('splits.json')
+
+        self.metadata = None
+        self.index = None
+
+
+    def exists(self):
+        return os.path.exists(self.full_meta_path)
+
+
+    def has_idx(self):
+        return self.index is not None
+
+
+    def load(self):
+        with open(self.full_meta_path) as f:
+            self.metadata = json.load(f)
+        if (os.path.exists(self.reflacx_idx_path) and
+            os.path.exists(self.idx_path) and
+            os.path.exists(self.splits_path)):
+            with open(self.reflacx_idx_path, 'r') as f:
+                reflacx_idx = json.load(f)
+            with open(self.idx_path, 'r') as f:
+                idx = json.load(f)
+                idx = {int(k): idx[k] for k in idx}
+            with open(self.splits_path, 'r') as f:
+                splits = json.load(f)
+                splits = {int(k): splits[k] for k in splits}
+            self.index = SampleIndex.from_dicts(reflacx_idx, idx, splits)
+
+
+    def save_metadata(self, metadata):
+        self.metadata = metadata
+        with open(self.full_meta_path, 'w') as f:
+            json.dump(self.metadata, f)
+
+
+    def update_samples(self, upserts, removed):
+        """:param upserts: dict of reflacx_id: (dicom_id, data) to add or
+        replace, :param removed: dict of reflacx_id: dicom_id to delete first"""
+        for rid, did in removed.items():
+            self.metadata[did].pop(rid, None)
+            if len(self.metadata[did]) == 0:
+                del self.metadata[did]
+        for rid, (did, data) in upserts.items():
+            self.metadata.setdefault(did, {})[rid] = data
+        self.save_metadata(self.metadata)
+
+
+    def save_idx(self, index):
+        """:param index: a SampleIndex"""
+        self.index = index
+        reflacx_idx, idx, splits = index.to_dicts()
+        with open(self.reflacx_idx_path, 'w') as f:
+            json.dump(reflacx_idx, f)
+        with open(self.idx_path, 'w') as f:
+            json.dump(idx, f)
+        with open(self.splits_path, 'w') as f:
+            json.dump(splits, f)
+
+
+    def items(self):
+        """iterates over (dicom_id, reflacx_id, sample data)"""
+        for did in self.metadata:
+            for rid in self.metadata[did]:
+                yield did, rid, self.metadata[did][rid]
+
+
+    def get(self, dicom_id, reflacx_id):
+        return self.metadata[dicom_id][reflacx_id]
+
+
+    def dicom_id(self, reflacx_id):
+        return self.index.dicom_id(reflacx_id)
+
+
+    def reflacx_id(self, i):
+        return self.index.reflacx_id(i)
+
+
+    def list_dicom_ids(self, n_samples=None, reverse=False, random_samples=False):
+        if n_samples is None:
+            n_samples = len(self.metadata)
+        else:
+            n_samples = min(n_samples, len(self.metadata))
+        if not random_samples:
+            result = (list(self.metadata.keys())[:n_samples]
+                      if not reverse
+                      else list(self.metadata.keys())[-n_samples:])
+        else:
+            keys = list(self.metadata.keys())
+            result = [keys.pop(randint(0, len(keys) - 1))
+                      for i in range(n_samples)]
+
+        return result
+
+
+    def list_reflacx_ids(self, dicom_id):
+        if dicom_id in self.metadata:
+            return list(self.metadata[dicom_id].keys())
+        return []
+
+
+    def get_split(self, split, phase=None):
+        return self.index.get_split(split, phase)
+
+
+    def get_phase(self, phase):
+        return self.index.get_phase(phase)
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+class SQLiteMetadataStore:
+    """Metadata in a sqlite file, with tables
+    dicoms(dicom_id), in insertion order,
+    samples(reflacx_id, dicom_id, phase, split, data), data being the json of
+    the sample's dict, and
+    idx(i, reflacx_id, phase, split), the valid samples' indices.
+    Connections are opened lazily, one per thread and process"""
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._len = None
+
+
+    @property
+    def db(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+
+    def exists(self):
+        if not os.path.exists(self.path):
+            return False
+        return self.db.execute("SELECT COUNT(*) FROM sqlite_master "
+                               "WHERE type = 'table' AND name = 'samples'").fetchone()[0] > 0
+
+
+    def has_idx(self):
+        try:
+            return self.db.execute("SELECT COUNT(*) FROM meta WHERE key = 'idx'").fetchone()[0] > 0
+        except sqlite3.OperationalError:
+            return False
+
+
+    def load(self):
+        self._len = None
+
+
+    def save_metadata(self, metadata):
+        db = self.db
+        with db:
+            db.executescript("""
+                DROP TABLE IF EXISTS meta;
+                DROP TABLE IF EXISTS dicoms;
+                DROP TABLE IF EXISTS samples;
+                DROP TABLE IF EXISTS idx;
+                CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE dicoms (dicom_id TEXT PRIMARY KEY);
+                CREATE TABLE samples (reflacx_id TEXT PRIMARY KEY,
+                                      dicom_id TEXT NOT NULL,
+                                      phase INTEGER,
+                                      split TEXT,
+                                      data TEXT NOT NULL);
+                CREATE INDEX samples_dicom_id ON samples (dicom_id);
+                CREATE TABLE idx (i INTEGER PRIMARY KEY,
+                                  reflacx_id TEXT NOT NULL,
+                                  phase INTEGER,
+                                  split TEXT);
+                CREATE INDEX idx_split ON idx (phase, split, i);
+            """)
+            db.executemany("INSERT INTO dicoms VALUES (?)",
+                           ((did,) for did in metadata))
+            db.executemany("INSERT INTO samples VALUES (?, ?, ?, ?, ?)",
+                           ((rid, did, data.get('phase'), data.get('split'), json.dumps(data))
+                            for did in metadata
+                            for rid, data in metadata[did].items()))
+        self._len = None
+
+
+    def update_samples(self, upserts, removed):
+        db = self.db
+        with db:
+            db.executemany("DELETE FROM samples WHERE reflacx_id = ?",
+                           ((rid,) for rid in removed))
+            db.executemany("INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?)",
+                           ((rid, did, data.get('phase'), data.get('split'), json.dumps(data))
+                            for rid, (did, data) in upserts.items()))
+            db.executemany("INSERT OR IGNORE INTO dicoms VALUES (?)",
+                           ((did,) for did, _ in upserts.values()))
+            db.execute("DELETE FROM dicoms WHERE dicom_id NOT IN (SELECT dicom_id FROM samples)")
+        self._len = None
+
+
+    def save_idx(self, index):
+        """:param index: a SampleIndex"""
+        db = self.db
+        with db:
+            db.execute("DELETE FROM idx")
+            db.executemany("INSERT INTO idx VALUES (?, ?, ?, ?)", index.rows())
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('idx', '1')")
+        self._len = None
+
+
+    def items(self):
+        for did, rid, data in self.db.execute(
+                "SELECT dicom_id, reflacx_id, data FROM samples ORDER BY rowid"):
+            yield did, rid, json.loads(data)
+
+
+    def get(self, dicom_id, reflacx_id):
+        row = self.db.execute("SELECT data FROM samples WHERE reflacx_id = ? AND dicom_id = ?",
+                              (reflacx_id, dicom_id)).fetchone()
+        if row is None:
+            raise KeyError((dicom_id, reflacx_id))
+        return json.loads(row[0])
+
+
+    def dicom_id(self, reflacx_id):
+        row = self.db.execute("SELECT dicom_id FROM samples WHERE reflacx_id = ?",
+                              (reflacx_id,)).fetchone()
+        if row is None:
+            raise KeyError(reflacx_id)
+        return row[0]
+
+
+    def reflacx_id(self, i):
+        row = self.db.execute("SELECT reflacx_id FROM idx WHERE i = ?", (i,)).fetchone()
+        if row is None:
+            raise KeyError(i)
+        return row[0]
+
+
+    def list_dicom_ids(self, n_samples=None, reverse=False, random_samples=False):
+        limit = -1 if n_samples is None else n_samples
+        order = ('RANDOM()' if random_samples
+                 else 'rowid DESC' if reverse
+                 else 'rowid')
+        result = [row[0] for row in self.db.execute(
+            "SELECT dicom_id FROM dicoms ORDER BY {} LIMIT ?".format(order), (limit,))]
+        if reverse and not random_samples:
+            result.reverse()
+        return result
+
+
+    def list_reflacx_ids(self, dicom_id):
+        return [row[0] for row in self.db.execute(
+            "SELECT reflacx_id FROM samples WHERE dicom_id = ? ORDER BY rowid", (dicom_id,))]
+
+
+    def indices(self, query, args):
+        return np.fromiter((row[0] for row in self.db.execute(query, args)), dtype=np.int32)
+
+
+    def get_split(self, split, phase=None):
+        if phase is not None:
+            result = self.indices("SELECT i FROM idx WHERE phase = ? AND split = ? ORDER BY i",
+                                  (phase, split))
+            if len(result) == 0:
+                raise KeyError((phase, split))
+            return result
+        return self.indices("SELECT i FROM idx WHERE split = ? ORDER BY phase, i", (split,))
+
+
+    def get_phase(self, phase):
+        result = self.indices("SELECT i FROM idx WHERE phase = ? ORDER BY i", (phase,))
+        if len(result) == 0:
+            raise KeyError(phase)
+        return result
+
+
+    def __len__(self):
+        if self._len is None:
+            self._len = self.db.execute("SELECT COUNT(*) FROM idx").fetchone()[0]
+        return self._len
+
+
+def make_store(full_meta_path, backend='json'):
+    """returns the store for :param backend:, 'json' or 'sqlite'.
+    The sqlite file sits next to full_meta.json, with a .sqlite extension.
+    If there's a json store but no sqlite one yet, it is converted"""
+    if backend == 'json':
+        return JsonMetadataStore(full_meta_path)
+    if backend != 'sqlite':
+        raise ValueError("unknown metadata backend {}".format(backend))
+
+    store = SQLiteMetadataStore(os.path.splitext(full_meta_path)[0] + '.sqlite')
+    json_store = JsonMetadataStore(full_meta_path)
+    if not store.exists() and json_store.exists():
+        print("converting {} to {}".format(full_meta_path, store.path))
+        json_store.load()
+        store.save_metadata(json_store.metadata)
+        if json_store.has_idx():
+            store.save_idx(json_store.index)
+    return store
+
+
+def compare_startup(full_meta_path):
+    """times loading both backends and answering a first query"""
+    make_store(full_meta_path, 'sqlite')
+    times = {}
+    for backend in ['json', 'sqlite']:
+        start = time.time()
+        store = make_store(full_meta_path, backend)
+        store.load()
+        len(store)
+        times[backend] = time.time() - start
+        print("{}: {:.3f}s".format(backend, times[backend]))
+    return times
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='converts full_meta.json to sqlite and compares startup times')
+    parser.add_argument('full_meta_path')
+    args = parser.parse_args(argv)
+    compare_startup(args.full_meta_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+# localization metrics of gaze heatmaps against anomaly ellipses.
+# For each sample and each label marked in its anomaly_location_ellipses, the
+# label's mask is the union of its ellipses, and the heatmap is scored by
+# - ncc, the normalized cross correlation of the heatmap and the mask,
+# - auc, the area under the ROC curve of heatmap values separating pixels
+#   inside the mask from outside, and
+# - mass_inside, the fraction of the heatmap's mass inside the mask.
+# Masks are computed analytically, as the ellipses inscribed in each anomaly's
+# bounding box, for all labels of a sample at once, at the resolution the
+# heatmap is read at.
+# Samples are scored over a process pool and rows are written to a csv as
+# they come, so memory doesn't grow with the number of samples.
+#
+# usage: python metrics.py <reflacx_dir> <mimic_dir> <full_meta.json> <out.csv> --split test --size 512 512 --workers 8
+
+import argparse
+import csv
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from batch_loader import init_worker_metadata, worker_metadata
+
+BOX_COLUMNS = ['xmin', 'ymin', 'xmax', 'ymax']
+COLUMNS = ['index', 'reflacx_id', 'dicom_id', 'phase', 'split', 'label', 'certainty',
+           'n_ellipses', 'mask_fraction', 'ncc', 'auc', 'mass_inside']
+
+
+def ellipse_masks(boxes, size_x, size_y, size=None):
+    """returns a (n, height, width) boolean array of the ellipses inscribed
+    in :param boxes:, (n, 4) xmin, ymin, xmax, ymax in full resolution
+    pixels of an image of :param size_x: x :param size_y:, rasterized at
+    :param size:, (width, height), if given"""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    width, height = (int(size_x), int(size_y)) if size is None else (int(size[0]), int(size[1]))
+    # full resolution coordinates of the output's pixel centers
+    xs = (np.arange(width) + 0.5) * (size_x / width) - 0.5
+    ys = (np.arange(height) + 0.5) * (size_y / height) - 0.5
+    cx = (boxes[:, 0] + boxes[:, 2]) / 2
+    cy = (boxes[:, 1] + boxes[:, 3]) / 2
+    rx = np.maximum((boxes[:, 2] - boxes[:, 0]) / 2, 0.5)
+    ry = np.maximum((boxes[:, 3] - boxes[:, 1]) / 2, 0.5)
+    dx = ((xs[None, :] - cx[:, None]) / rx[:, None]) ** 2
+    dy = ((ys[None, :] - cy[:, None]) / ry[:, None]) ** 2
+    return dy[:, :, None] + dx[:, None, :] <= 1
+
+
+def label_masks(ellipses, size_x, size_y, size=None):
+    """returns (labels, masks, certainties, counts) of a sample's anomaly
+    ellipses, masks being the union of each label's ellipses"""
+    if ellipses is None or len(ellipses) == 0:
+        return [], np.zeros((0, 0, 0), dtype=bool), [], []
+    masks = ellipse_masks([[ellip[c] for c in BOX_COLUMNS] for ellip in ellipses],
+                          size_x, size_y, size)
+    labels = []
+    for ellip in ellipses:
+        labels += [key for key in ellip if str(ellip[key]) == 'True' and key not in labels]
+    members = np.array([[str(ellip.get(label)) == 'True' for ellip in ellipses]
+                        for label in labels], dtype=bool).reshape(len(labels), len(ellipses))
+    union = np.stack([masks[m].any(axis=0) for m in members]) if len(labels) > 0 else masks[:0]
+    certainties = [max([ellip.get('certainty', np.nan) for ellip, m in zip(ellipses, member) if m])
+                   for member in members]
+    return labels, union, certainties, members.sum(axis=1).tolist()
+
+
+def scores(heatmap, masks):
+    """returns (ncc, auc, mass_inside), arrays with one score per mask of
+    :param masks:, (n, height, width), against :param heatmap:"""
+    from scipy.stats import rankdata
+    h = np.asarray(heatmap, dtype=np.float64).ravel()
+    m = masks.reshape(len(masks), -1).astype(np.float64)
+    n_pixels = h.size
+    positives = m.sum(axis=1)
+    negatives = n_pixels - positives
+
+    hc = h - h.mean()
+    mc = m - (positives / n_pixels)[:, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ncc = (mc @ hc) / (np.sqrt((mc ** 2).sum(axis=1)) * np.sqrt((hc ** 2).sum()))
+        # Mann-Whitney U over the heatmap's ranks, ties counted as half
+        ranks = rankdata(h)
+        auc = ((m @ ranks) - positives * (positives + 1) / 2) / (positives * negatives)
+        mass_inside = (m @ h) / h.sum()
+    return ncc, auc, mass_inside
+
+
+def sample_heatmap(sample, size=None, from_fixations=False):
+    if from_fixations:
+        return sample.get_fixation_splats().heatmap(size=size)
+    return sample.get_heatmap(size=size)
+
+
+def score_sample(sample, i=None, size=None, from_fixations=False):
+    """returns the rows of a sample, one per label of its anomaly ellipses"""
+    if from_fixations and len(sample.get_fixations()) == 0:
+        return []
+    if not from_fixations and 'heatmaps' not in sample.data:
+        return []
+    labels, masks, certainties, counts = label_masks(sample.get_anomaly_ellipses(),
+                                                     sample.data['image_size_x'],
+                                                     sample.data['image_size_y'],
+                                                     size)
+    if len(labels) == 0:
+        return []
+    heatmap = sample_heatmap(sample, size, from_fixations)
+    ncc, auc, mass_inside = scores(heatmap, masks)
+    mask_fraction = masks.reshape(len(masks), -1).mean(axis=1)
+    return [{'index': i,
+             'reflacx_id': sample.reflacx_id,
+             'dicom_id': sample.dicom_id,
+             'phase': sample.data.get('phase'),
+             'split': sample.data.get('split'),
+             'label': labels[j],
+             'certainty': certainties[j],
+             'n_ellipses': counts[j],
+             'mask_fraction': float(mask_fraction[j]),
+             'ncc': float(ncc[j]),
+             'auc': float(auc[j]),
+             'mass_inside': float(mass_inside[j])}
+            for j in range(len(labels))]
+
+
+def _score_in_worker(indices, size, from_fixations):
+    metadata = worker_metadata()
+    rows = []
+    for i in indices:
+        rows += score_sample(metadata[i], i, size, from_fixations)
+    return rows
+
+
+def evaluate(metadata, indices, out_path, size=(512, 512), from_fixations=False,
+             workers=None, chunksize=16, log_every=1000):
+    """scores the samples of :param indices: over a process pool, writing
+    rows to the csv at :param out_path: in order, as they come.
+    :param from_fixations: scores heatmaps drawn from fixations at
+    :param size:, instead of stored ones"""
+    indices = list(indices)
+    chunks = [indices[i:i + chunksize] for i in range(0, len(indices), chunksize)]
+    workers = workers or os.cpu_count()
+    log_chunks = max(1, log_every // chunksize)
+    with open(out_path, 'w', newline='') as f, \
+         ProcessPoolExecutor(max_workers=workers,
+                             initializer=init_worker_metadata,
+                             initargs=(metadata.init_kwargs,)) as pool:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        # at most two chunks per worker in flight, so results don't pile up
+        pending = deque()
+        chunks = iter(chunks)
+        done = 0
+        while True:
+            while len(pending) < 2 * workers:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pending.append(pool.submit(_score_in_worker, chunk, size, from_fixations))
+            if len(pending) == 0:
+                break
+            writer.writerows(pending.popleft().result())
+            done += 1
+            if done % log_chunks == 0:
+                print("{}/{} samples scored".format(min(done * chunksize, len(indices)), len(indices)))
+    print("{} samples scored".format(len(indices)))
+
+
+def summarize(results_path):
+    """returns the mean and count of each score by label"""
+    import pandas as pd
+    results = pd.read_csv(results_path)
+    return results.groupby('label')[['ncc', 'auc', 'mass_inside']].agg(['mean', 'count'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='scores gaze heatmaps against anomaly ellipses')
+    parser.add_argument('reflacx_dir')
+    parser.add_argument('mimic_dir')
+    parser.add_argument('full_meta_path')
+    parser.add_argument('out_path')
+    parser.add_argument('--backend', default='json')
+    parser.add_argument('--tables-dir', default=None)
+    parser.add_argument('--split', default=None)
+    parser.add_argument('--phase', type=int, default=None)
+    parser.add_argument('--size', type=int, nargs=2, default=[512, 512], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--from-fixations', action='store_true')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+
+    from metadata import Metadata
+    metadata = Metadata(args.reflacx_dir,
+                        args.mimic_dir,
+                        args.full_meta_path,
+                        backend=args.backend,
+                        tables_dir=args.tables_dir)
+    if args.split is not None:
+        indices = metadata.get_split(args.split, args.phase)
+    elif args.phase is not None:
+        indices = metadata.get_phase(args.phase)
+    else:
+        indices = range(len(metadata))
+    evaluate(metadata,
+             indices,
+             args.out_path,
+             size=tuple(args.size),
+             from_fixations=args.from_fixations,
+             workers=args.workers)
+    print(summarize(args.out_path))
+
+
+if __name__ == '__main__':
+    main()
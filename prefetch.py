@@ -0,0 +1,156 @@
+# prefetching of samples' files ahead of use, see Metadata.prefetch.
+# A sample's DICOM, heatmap and csvs are independent reads, so each one is a
+# task of its own in a bounded thread pool, and the reads of many samples are
+# in flight at once, which hides the latency of network filesystems. Decoding
+# and parsing happen in the pool's threads too, mostly outside of the GIL.
+# DICOMs are read once per dicom_id, into the DicomImgs cache. Everything else
+# fills the caches of the sample objects, which Metadata keeps in a
+# PrefetchedSamples and hands out until they are evicted. Memory mapped
+# results, of a pixel cache or heatmap store, are read through once so their
+# pages are in the OS page cache.
+# Prefetching is best effort, a field a sample doesn't have is skipped and
+# counted, it fails again, and is logged, when the sample is used.
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+FIELDS = {'img': lambda sample: sample.get_dicom_img(),
+          'heatmap': lambda sample: sample.get_heatmap(),
+          'fixations': lambda sample: sample.get_fixations(),
+          'timed_sentences': lambda sample: sample.get_timed_sentences(),
+          'chest_bounding_box': lambda sample: sample.get_chest_bounding_box(),
+          'anomaly_ellipses': lambda sample: sample.get_anomaly_ellipses()}
+DEFAULT_FIELDS = ('img', 'heatmap', 'fixations', 'chest_bounding_box', 'anomaly_ellipses')
+# timed_sentences loads the fixations itself, and the chest bounding box is
+# clamped to the image, they wait for them instead of reading them again
+DEPENDS = {'timed_sentences': 'fixations', 'chest_bounding_box': 'img'}
+READ_BLOCK = 1 << 20
+
+
+class PrefetchedSamples:
+    """the last :param max_samples: prefetched samples, by reflacx_id"""
+    def __init__(self, max_samples=256):
+        self.max_samples = max_samples
+        self.samples = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def get(self, reflacx_id):
+        with self.lock:
+            sample = self.samples.get(reflacx_id)
+            if sample is not None:
+                self.samples.move_to_end(reflacx_id)
+            return sample
+
+
+    def put(self, sample):
+        with self.lock:
+            self.samples[sample.reflacx_id] = sample
+            self.samples.move_to_end(sample.reflacx_id)
+            while len(self.samples) > self.max_samples:
+                self.samples.popitem(last=False)
+
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+
+
+    def __contains__(self, reflacx_id):
+        return reflacx_id in self.samples
+
+
+    def __len__(self):
+        return len(self.samples)
+
+
+def read_through(result):
+    """reads the file behind a memory mapped :param result:, if it is one,
+    so its pages are cached by the OS"""
+    arrays = result if isinstance(result, (list, tuple)) else [result]
+    for array in arrays:
+        if isinstance(array, np.memmap) and array.filename is not None:
+            buffer = bytearray(READ_BLOCK)
+            with open(array.filename, 'rb', buffering=0) as f:
+                while f.readinto(buffer):
+                    pass
+
+
+def load_field(sample, field):
+    """returns whether :param field: of :param sample: was loaded"""
+    try:
+        result = FIELDS[field](sample)
+    except (KeyError, OSError, ValueError):
+        return False
+    if result is None:
+        return False
+    if field == 'heatmap':
+        result = sample.heatmap_levels
+    read_through(result)
+    return True
+
+
+def load_after(before, sample, field):
+    """loads :param field: once the future :param before: it depends on is
+    done, if its field was loaded"""
+    return before.result() and load_field(sample, field)
+
+
+def check_fields(fields):
+    for field in fields:
+        if field not in FIELDS:
+            raise ValueError("unknown field {}, expected one of {}".format(field, list(FIELDS)))
+
+
+def submit_prefetch(pool, samples, fields):
+    """submits the loads of :param fields: of :param samples: to
+    :param pool:. Images are loaded once per dicom_id, and fields load after
+    those they depend on. returns the futures, each resolving to whether
+    its field was loaded"""
+    check_fields(fields)
+    images = {}
+    futures = []
+    for sample in samples:
+        loading = {}
+        for field in sorted(fields, key=lambda f: f in DEPENDS):
+            if field == 'img' and sample.dicom_id in images:
+                loading[field] = images[sample.dicom_id]
+                continue
+            before = loading.get(DEPENDS.get(field))
+            if before is None:
+                future = pool.submit(load_field, sample, field)
+            else:
+                future = pool.submit(load_after, before, sample, field)
+            loading[field] = future
+            if field == 'img':
+                images[sample.dicom_id] = future
+            futures.append(future)
+    return futures
+
+
+def prefetch(samples, fields=DEFAULT_FIELDS, concurrency=16):
+    """loads :param fields: of :param samples: over a pool of
+    :param concurrency: threads, blocking until they are all loaded.
+    returns {'loaded', 'skipped'}, counts of fields"""
+    samples = list(samples)
+    # dependent loads wait in the pool for those before them, which were
+    # submitted first, so the pool can't be filled with waiting ones
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        loaded = [future.result() for future in submit_prefetch(pool, samples, fields)]
+    return {'loaded': sum(loaded), 'skipped': len(loaded) - sum(loaded)}
+
+
+async def aprefetch(samples, fields=DEFAULT_FIELDS, concurrency=16):
+    """prefetch, awaitable from an event loop, which isn't blocked while
+    the pool loads the fields"""
+    import asyncio
+    samples = list(samples)
+    pool = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    try:
+        futures = submit_prefetch(pool, samples, fields)
+        loaded = await asyncio.gather(*[asyncio.wrap_future(future) for future in futures])
+    finally:
+        pool.shutdown(wait=False)
+    return {'loaded': sum(loaded), 'skipped': len(loaded) - sum(loaded)}
@@ -0,0 +1,70 @@
+# image pyramids for reading images and heatmaps at reduced resolution.
+# Level 0 is the full resolution array, each following level halves both
+# sides, rounding up, down to min_side pixels. A request for a given size is
+# served from the smallest level that is still at least that size, so
+# downsampling never starts from more pixels than needed.
+# Sizes are (width, height), as for cv2.resize. Crops are
+# (xmin, ymin, xmax, ymax) in full resolution pixels.
+# cv2 is imported on first resize, as in rendering.py.
+
+import numpy as np
+
+
+def level_shape(shape, level):
+    return tuple(-(-side // 2 ** level) for side in shape[:2])
+
+
+def downsample(img):
+    """halves both sides of :param img:, averaging each 2x2 block"""
+    import cv2
+    h, w = level_shape(img.shape, 1)
+    result = cv2.resize(np.ascontiguousarray(img), (w, h), interpolation=cv2.INTER_AREA)
+    return result.astype(img.dtype, copy=False)
+
+
+def build_pyramid(img, min_side=256):
+    """returns the levels past the first of :param img:'s pyramid, the
+    last one having its shortest side at least :param min_side:"""
+    levels = []
+    while min(level_shape(img.shape, 1)) >= min_side:
+        img = downsample(img)
+        levels.append(img)
+    return levels
+
+
+def pick_level(shape, n_levels, size, crop=None):
+    """returns the smallest level whose crop is at least :param size:"""
+    if crop is None:
+        crop = (0, 0, shape[1], shape[0])
+    w = crop[2] - crop[0]
+    h = crop[3] - crop[1]
+    level = 0
+    while (level + 1 < n_levels
+           and w // 2 ** (level + 1) >= size[0]
+           and h // 2 ** (level + 1) >= size[1]):
+        level += 1
+    return level
+
+
+def resample(levels, size=None, crop=None):
+    """returns a new array of :param crop: of a pyramid, resized to
+    :param size:. Either can be None.
+    :param levels: pyramid levels, full resolution first"""
+    import cv2
+    base = levels[0]
+    if size is None:
+        img = base if crop is None else base[crop[1]:crop[3], crop[0]:crop[2]]
+        return np.array(img)
+    level = pick_level(base.shape, len(levels), size, crop)
+    img = levels[level]
+    if crop is not None:
+        # the crop in this level's pixels
+        sy = img.shape[0] / base.shape[0]
+        sx = img.shape[1] / base.shape[1]
+        img = img[int(crop[1] * sy): max(int(round(crop[3] * sy)), int(crop[1] * sy) + 1),
+                  int(crop[0] * sx): max(int(round(crop[2] * sx)), int(crop[0] * sx) + 1)]
+    shrinking = img.shape[1] >= size[0] and img.shape[0] >= size[1]
+    result = cv2.resize(np.ascontiguousarray(img),
+                        tuple(int(side) for side in size),
+                        interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR)
+    return result.astype(base.dtype, copy=False)
@@ -1,47 +1,98 @@
 from rlogger import RLogger
-from tools import csv2dictlist, normalize
+from tools import csv2records, records2dictlist
 import numpy as np
-from matplotlib import cm
-import cv2
-from generate_heatmaps import create_heatmap
+from generate_heatmaps import FixationSplats
+from heatmap_store import load_heatmap_levels, read_heatmap_into
+from pyramid import resample
+from rendering import Renderer, colormap_lut, lut_colors, draw_circles, scale_of, scaled_radius
+from alignment import parse_timed_sentences, align_fixations, fixation_arrays
+from instrumentation import instrumented, record_cache, record_file
+
+_log = None
+
 
 class ReflacxSample:
-    def __init__(self, dicom_id, reflacx_id, sample_dict, imgs_lib):
+    """One REFLACX reading of a MIMIC-CXR x-ray. Samples are created on every
+    Metadata access, so they have __slots__ instead of a __dict__, share one
+    logger, and only allocate their caches when filled"""
+    __slots__ = ('data', 'dicom_id', 'reflacx_id', 'imgs_lib', 'tables', 'renderer',
+                 'dicom_img', 'chest_bb', 'fixations', 'timed_sentences', 'sentence_indices',
+                 'fixation_splats', 'heatmap_levels', 'heatmaps_by_sentence', 'anomaly_ellipses')
+
+    def __init__(self, dicom_id, reflacx_id, sample_dict, imgs_lib, tables=None, renderer=None):
+        """param:tables optional table_store.TableStore the sample's csvs
+        are read from
+        param:renderer optional rendering.Renderer, shared by samples so the
+        canvases of their x-rays are converted once"""
         self.data = sample_dict
         self.dicom_id = dicom_id
         self.reflacx_id = reflacx_id
         self.imgs_lib = imgs_lib
+        self.tables = tables
+        self.renderer = renderer if renderer is not None else Renderer(max_canvases=2)
         self.dicom_img = None
         self.chest_bb = None
         self.fixations = None
         self.timed_sentences = None
-        self.global_heatmap = None
+        self.sentence_indices = None
+        self.fixation_splats = None
+        self.heatmap_levels = None
         self.heatmaps_by_sentence = None
         self.anomaly_ellipses = None
 
-        self.color_gen = lambda cmap: lambda ratio: tuple((int(255 * comp) for comp in cmap(ratio)[:3]))
-
-        self.log = RLogger(__name__, self.__class__.__name__)
-
 
-    def canvas(self):
-        canvas = np.copy(self.get_dicom_img())
-        canvas = cv2.cvtColor(canvas, cv2.COLOR_GRAY2RGB)
-        canvas >>= 4
-        return canvas
-
-
-    def get_dicom_img(self):
-        result = self.imgs_lib.get_dicom_img(self.dicom_id, imgpath=self.data['image'])
+    @property
+    def log(self):
+        global _log
+        if _log is None:
+            _log = RLogger(__name__, self.__class__.__name__)
+        return _log
+
+
+    @instrumented('sample.canvas')
+    def canvas(self, size=None):
+        """returns a writable 8 bits RGB copy of the x-ray, at
+        :param size:, (width, height), if given"""
+        return self.renderer.canvas(self.dicom_id,
+                                    lambda: self.get_dicom_img(size=size),
+                                    size)
+
+
+    @instrumented('sample.get_dicom_img')
+    def get_dicom_img(self, copy=False, size=None):
+        """returns a read only view of the x-ray, or a writable copy if
+        :param copy: is True.
+        :param size: optional (width, height), the x-ray is then a new array
+        read from the smallest pyramid level that fits, see pyramid.py"""
+        if size is not None:
+            result = self.imgs_lib.get_resampled(self.dicom_id, self.data['image'], size)
+        else:
+            result = self.imgs_lib.get_dicom_img(self.dicom_id, imgpath=self.data['image'], copy=copy)
         if result is None:
             self.log('missing dicom img for pair {} --- {}'.format(self.dicom_id, self.reflacx_id))
         return result
     
 
+    @instrumented('sample.get_table')
+    def get_table(self, table):
+        """returns the rows of one of the sample's csvs as a record array,
+        from the TableStore if there's one.
+        raises KeyError if the sample doesn't have that csv"""
+        if self.tables is not None:
+            records = self.tables.get(table, self.data['phase'], self.reflacx_id)
+            if records is not None:
+                record_cache('tables', True)
+                return records
+            record_cache('tables', False)
+        record_file('csv', self.data[table])
+        return csv2records(self.data[table])
+
+
+    @instrumented('sample.get_chest_bounding_box')
     def get_chest_bounding_box(self):
         if self.chest_bb is None:
             try:
-                self.chest_bb = csv2dictlist(self.data['chest_bounding_box'])[0]
+                self.chest_bb = records2dictlist(self.get_table('chest_bounding_box'))[0]
             except KeyError:
                 self.log('missing chest_bb for pair {} --- {}'.format(self.dicom_id, self.reflacx_id))
                 return None
@@ -60,220 +111,250 @@ class ReflacxSample:
         return self.chest_bb
     
     
-    def get_cropped_chest_img(self):
-        bb = self.get_chest_bounding_box()
-        return np.copy(self.get_dicom_img()[bb['ymin']: bb['ymax'],
-                                            bb['xmin']: bb['xmax']])
+    @instrumented('sample.get_cropped_chest_img')
+    def get_cropped_chest_img(self, size=None):
+        """returns a copy of the chest bounding box of the x-ray, resized
+        to :param size:, (width, height), if given"""
+        return self.imgs_lib.get_resampled(self.dicom_id,
+                                           self.data['image'],
+                                           size,
+                                           self.chest_crop())
     
 
-    def get_fixations(self):
+    @instrumented('sample.get_fixations')
+    def get_fixations(self, as_dicts=False):
+        """returns the fixations as a record array, indexable by column name
+        as the dicts of csv2dictlist. A list of dicts if :param as_dicts:"""
         if self.fixations is None:
             try:
-                self.fixations = (csv2dictlist(self.data['fixations'])
+                self.fixations = (self.get_table('fixations')
                                   if 'fixations' in self.data
                                   else [])
             except KeyError:
                 self.log('missing fixations for pair {} --- {}'.format(self.dicom_id, self.reflacx_id))
+        if as_dicts and self.fixations is not None and len(self.fixations) > 0:
+            return records2dictlist(self.fixations)
         return self.fixations
     
 
-    def draw_fixations(self, cmap='jet'):
+    @instrumented('sample.draw_fixations')
+    def draw_fixations(self, cmap='jet', size=None, radius=40):
+        """draws the fixations colored by time, at :param size:,
+        (width, height), if given"""
         fixations = self.get_fixations()
-        delta_t = fixations[0]['timestamp_start_fixation'], fixations[-1]['timestamp_end_fixation']
-        f_color = self.color_gen(cm.get_cmap(cmap))
-
-        canvas = self.canvas()
+        starts, ends, xs, ys = fixation_arrays(fixations)
+        sx, sy, scale = scale_of(size, self.data['image_size_x'], self.data['image_size_y'])
+
+        median_t = (ends + starts) / 2
+        rel_t = (median_t - starts[0]) / (ends[-1] - starts[0])
+        colors = lut_colors(colormap_lut(cmap), rel_t)
+
+        valid = (xs.astype(int) >= 0) & (ys.astype(int) >= 0)
+        return draw_circles(self.canvas(size),
+                            xs[valid].astype(int) * sx,
+                            ys[valid].astype(int) * sy,
+                            colors[valid],
+                            scaled_radius(radius, scale))
+    
 
-        for fixation in fixations:
-            x = int(fixation['x_position'])
-            y = int(fixation['y_position'])
-            
-            if x < 0 or y < 0:
-                continue
+    @instrumented('sample.get_transcription')
+    def get_transcription(self):
+        record_file('transcription', self.data['transcription'])
+        with open(self.data['transcription']) as f:
+            return ''.join(f.readlines())
 
-            median_t = (fixation['timestamp_end_fixation'] + fixation['timestamp_start_fixation']) / 2
-            rel_t = (median_t - delta_t[0]) / (delta_t[1] - delta_t[0])
 
-            canvas = cv2.circle(canvas, (x, y), 40, f_color(rel_t), -1)
+    @instrumented('sample.get_sentences')
+    def get_sentences(self):
+        """returns the transcription's sentences, with their start and end
+        timestamps, but without fixations"""
+        return parse_timed_sentences(self.get_transcription(),
+                                     self.get_table('timestamps_transcription'))
 
-        return canvas
-    
 
+    @instrumented('sample.get_timed_sentences')
     def get_timed_sentences(self):
+        """returns the transcription's sentences, each with the fixations made
+        while it was dictated, see alignment.py"""
         if self.timed_sentences is None:
-            with open(self.data['transcription']) as f:
-                sentences = [sentence.strip(' \n')
-                             for sentence in ''.join(f.readlines()).split('.')
-                             if sentence != '']
-                
-            tt = csv2dictlist(self.data['timestamps_transcription'])
-
-            start_t = 0
-            end_t = 0
-
-            timed_sentences = []
-
-            new_sentence = False
-            for i, token in enumerate(tt):
-                if i == 0 or new_sentence:
-                    start_t = token['timestamp_start_word']
-                    end_t = token['timestamp_end_word']
-                    new_sentence = False
-
-                if token['word'] == '.':
-                    timed_sentences.append({'start_t': start_t,
-                                                 'end_t': end_t,
-                                                 'sentence': sentences.pop(0)})
-                    new_sentence = True
-
-                end_t = token['timestamp_end_word']
-
-            sentence_i = 0
-            sentence = timed_sentences[sentence_i]
-
-            fixations = self.get_fixations()
-
-            pre_transcript = []
-            post_transcript = []
-
-            for fixation in fixations:
-                x = fixation['x_position']
-                y = fixation['y_position']
-                
-                if x < 0 or y < 0:
-                    continue
-
-                if (sentence_i == 0
-                    and fixation['timestamp_start_fixation'] < sentence['start_t']):
-                    pre_transcript.append((fixation['timestamp_start_fixation'], fixation))
-                else:
-                    while fixation['timestamp_end_fixation'] > sentence['end_t']:
-                        if sentence_i >= len(timed_sentences) - 1:
-                            post_transcript.append((fixation['timestamp_end_fixation'], fixation))
-                            break
-                        else:
-                            sentence_i += 1
-                            sentence = timed_sentences[sentence_i]
-                    if 'fixations' not in sentence:
-                        sentence['fixations'] = []
-                    sentence['fixations'].append(fixation)
-
-            if len(pre_transcript) > 0:
-                timed_sentences.insert(0, {'start_t': pre_transcript[0][1]['timestamp_start_fixation'],
-                                           'end_t': pre_transcript[-1][1]['timestamp_end_fixation'],
-                                           'sentence': '_pre_transcript',
-                                           'fixations': [f[1] for f in pre_transcript]})
-                
-            if len(post_transcript) > 0:
-                timed_sentences.append({'start_t': post_transcript[0][1]['timestamp_start_fixation'],
-                                        'end_t': post_transcript[-1][1]['timestamp_end_fixation'],
-                                        'sentence': '_post_transcript',
-                                        'fixations': [f[1] for f in post_transcript]})
-            
-            self.timed_sentences = timed_sentences
+            self.timed_sentences, self.sentence_indices = align_fixations(self.get_sentences(),
+                                                                          self.get_fixations(),
+                                                                          return_indices=True)
         
         return self.timed_sentences
+
+
+    @instrumented('sample.get_sentence_indices')
+    def get_sentence_indices(self):
+        """returns, for each of get_timed_sentences, the index array of its
+        fixations in get_fixations"""
+        if self.sentence_indices is None:
+            self.timed_sentences = None
+            self.get_timed_sentences()
+        return self.sentence_indices
     
 
-    def draw_fixations_by_sentence(self, cmap='jet', radius=40):
+    @instrumented('sample.draw_fixations_by_sentence')
+    def draw_fixations_by_sentence(self, cmap='jet', radius=40, size=None):
+        """returns a dict of sentence: canvas with its fixations, colored by
+        order, at :param size:, (width, height), if given"""
         timed_sentences = self.get_timed_sentences()
-        f_color = self.color_gen(cm.get_cmap(cmap))
+        lut = colormap_lut(cmap)
+        sx, sy, scale = scale_of(size, self.data['image_size_x'], self.data['image_size_y'])
 
         result = {}
 
         for sentence in timed_sentences:
-            canvas = self.canvas()
-            
-            for i, fixation in enumerate(sentence['fixations']):
-                x = int(fixation['x_position'])
-                y = int(fixation['y_position'])
-
-                canvas = cv2.circle(canvas,
-                                    (x, y),
-                                    radius,
-                                    f_color(i / max(1, (len(sentence['fixations']) - 1))),
-                                    -1)
-
-                result[sentence['sentence']] = canvas
+            if 'fixations' not in sentence:
+                continue
+            _, _, xs, ys = fixation_arrays(sentence['fixations'])
+            n = len(xs)
+            colors = lut_colors(lut, np.arange(n) / max(1, n - 1))
+            result[sentence['sentence']] = draw_circles(self.canvas(size),
+                                                        xs.astype(int) * sx,
+                                                        ys.astype(int) * sy,
+                                                        colors,
+                                                        scaled_radius(radius, scale))
         
         return result
 
 
-    def get_heatmap(self, chest_only=False):
-        if self.global_heatmap is None:
-            try:
-                hm = np.load(self.data['heatmaps'], allow_pickle=True).item()['np_image']
-                self.global_heatmap = normalize(hm, type=hm.dtype)
-            except KeyError:
-                self.log('heatmaps not found for pair {} --- {}'.format(self.dicom_id, self.reflacx_id))
-                raise KeyError
-            except FileNotFoundError:
-                self.log('heatmaps FILE not found for pair {} --- {}'.format(self.dicom_id, self.reflacx_id))
-                raise FileNotFoundError
+    @instrumented('sample.get_heatmap')
+    def get_heatmap(self, chest_only=False, size=None, out=None):
+        """returns the heatmap normalized to [0, 1] as a read only view.
+        if :param chest_only: is True, returns a new array cropped to the
+        chest bounding box and normalized to sum 1.
+        :param size: optional (width, height), the heatmap is then a new
+        array read from the smallest pyramid level that fits
+        :param out: optional preallocated float array the heatmap is
+        written to, and returned. The full resolution heatmap of a .hmz
+        file not loaded yet is decoded straight into it, without being
+        cached"""
+        if out is not None and not chest_only and size is None and self.heatmap_levels is None:
+            return self.read_heatmap(read_heatmap_into, out)
+
+        if self.heatmap_levels is None:
+            self.heatmap_levels = self.read_heatmap(load_heatmap_levels)
         
         if not chest_only:
-            return np.copy(self.global_heatmap)
-        
-        bb = self.get_chest_bounding_box()
-        result = np.copy(self.global_heatmap[bb['ymin']: bb['ymax'],
-                                           bb['xmin']: bb['xmax']])
-        return result / np.sum(result)
+            if size is None:
+                result = self.heatmap_levels[0]
+            else:
+                result = resample(self.heatmap_levels, size)
+                result = result / np.max(result)
+        else:
+            result = resample(self.heatmap_levels, size, self.chest_crop())
+            result = result / np.sum(result)
+        if out is not None:
+            np.copyto(out, result, casting='same_kind')
+            return out
+        return result
     
 
-    def get_heatmaps_by_sentence(self, chest_only=False):
+    def read_heatmap(self, read, *args):
+        """returns :param read: of the heatmap's path and :param args:"""
+        try:
+            return read(self.data['heatmaps'], *args)
+        except KeyError:
+            self.log('heatmaps not found for pair {} --- {}'.format(self.dicom_id, self.reflacx_id))
+            raise KeyError
+        except FileNotFoundError:
+            self.log('heatmaps FILE not found for pair {} --- {}'.format(self.dicom_id, self.reflacx_id))
+            raise FileNotFoundError
+
+
+    @instrumented('sample.get_fixation_splats')
+    def get_fixation_splats(self):
+        """returns the FixationSplats of the sample's fixations, built once
+        and shared by every partial heatmap"""
+        if self.fixation_splats is None:
+            self.fixation_splats = FixationSplats(self.get_fixations(),
+                                                  self.data['image_size_x'],
+                                                  self.data['image_size_y'])
+        return self.fixation_splats
+
+
+    def chest_crop(self):
+        bb = self.get_chest_bounding_box()
+        return bb['xmin'], bb['ymin'], bb['xmax'], bb['ymax']
+
+
+    @instrumented('sample.get_heatmap_between')
+    def get_heatmap_between(self, t0, t1, chest_only=False, size=None):
+        """returns the heatmap of the fixations starting in [t0, t1),
+        normalized to sum 1, over the chest bounding box if :param chest_only:,
+        drawn at :param size:, (width, height), if given. It's all zeros if
+        no fixation starts in the window"""
+        return self.get_fixation_splats().between(t0, t1,
+                                                  self.chest_crop() if chest_only else None,
+                                                  size)
+
+
+    @instrumented('sample.get_heatmaps_by_sentence')
+    def get_heatmaps_by_sentence(self, chest_only=False, size=None):
+        """returns a heatmap for each timed sentence with fixations, as
+        {'title', 'img', 'start_t', 'end_t'}, cached for each value of
+        :param chest_only: and :param size:, (width, height). Heatmaps are
+        drawn directly at that size"""
+        key = (chest_only, None if size is None else tuple(size))
         if self.heatmaps_by_sentence is None:
+            self.heatmaps_by_sentence = {}
+        if key not in self.heatmaps_by_sentence:
             timed_sentences = self.get_timed_sentences()
-            get_partial_hm = lambda fixations: create_heatmap(fixations,
-                                                    self.data['image_size_x'],
-                                                    self.data['image_size_y'])
+            indices = self.get_sentence_indices()
+            splats = self.get_fixation_splats()
+            crop = self.chest_crop() if chest_only else None
             
             hms = []
 
-            for sentence in timed_sentences:
-                img = get_partial_hm(sentence['fixations'])
-
-                if chest_only:
-                    bb = self.get_chest_bounding_box()
-                    img = img[bb['ymin']: bb['ymax'], bb['xmin']: bb['xmax']]
-                    img /= np.sum(img)
-                
+            for sentence, idx in zip(timed_sentences, indices):
+                if len(idx) == 0:
+                    continue
                 hms.append({'title': sentence['sentence'],
-                            'img': img,
+                            'img': splats.heatmap(idx, crop, size),
                             'start_t': sentence['fixations'][0]['timestamp_start_fixation'],
                             'end_t': sentence['fixations'][-1]['timestamp_end_fixation']})
             
-            self.heatmaps_by_sentence = hms
+            self.heatmaps_by_sentence[key] = hms
             
-        return self.heatmaps_by_sentence
+        return self.heatmaps_by_sentence[key]
     
 
+    @instrumented('sample.get_anomaly_ellipses')
     def get_anomaly_ellipses(self):
         if self.anomaly_ellipses is None:
             try:
-                self.anomaly_ellipses = csv2dictlist(self.data['anomaly_location_ellipses'])
+                self.anomaly_ellipses = records2dictlist(self.get_table('anomaly_location_ellipses'))
             except KeyError:
                 self.log('Missing anomaly ellipses for pair {} --- {}'.format(self.dicom_id, self.reflacx_id))
         return self.anomaly_ellipses
     
 
-    def draw_anomaly_ellipses(self, color = (255, 0, 0), chest_only=False):
+    @instrumented('sample.draw_anomaly_ellipses')
+    def draw_anomaly_ellipses(self, color = (255, 0, 0), chest_only=False, size=None, thickness=15):
+        """returns a dict of anomalies: canvas with their ellipse, drawn at
+        :param size:, (width, height), if given, before cropping to the chest
+        if :param chest_only:"""
+        import cv2
         ellips = self.get_anomaly_ellipses()
+        sx, sy, scale = scale_of(size, self.data['image_size_x'], self.data['image_size_y'])
 
         result = {}
 
         for ellip in ellips:
-            x_min = ellip['xmin']
-            x_max = ellip['xmax']
-            y_min = ellip['ymin']
-            y_max = ellip['ymax']
+            x_min = ellip['xmin'] * sx
+            x_max = ellip['xmax'] * sx
+            y_min = ellip['ymin'] * sy
+            y_max = ellip['ymax'] * sy
 
-            contour = cv2.fitEllipse(np.array([(x_min, y_min), (x_min, y_max), (x_max, y_max), (x_max, y_min), (x_min, y_min)]))
+            contour = cv2.fitEllipse(np.array([(x_min, y_min), (x_min, y_max), (x_max, y_max), (x_max, y_min), (x_min, y_min)], dtype=np.float32))
 
-            canvas = self.canvas()
-            canvas = cv2.ellipse(canvas, contour, color, 15)
+            canvas = self.canvas(size)
+            canvas = cv2.ellipse(canvas, contour, color, scaled_radius(thickness, scale))
             if chest_only:
                 bb = self.get_chest_bounding_box()
-                canvas = canvas[bb['ymin']: bb['ymax'], bb['xmin']: bb['xmax']]
+                canvas = canvas[int(bb['ymin'] * sy): int(bb['ymax'] * sy),
+                                int(bb['xmin'] * sx): int(bb['xmax'] * sx)]
             anomalies = ', '.join([key for key in ellip if str(ellip[key]) == 'True'])
             result[anomalies] = canvas
 
@@ -281,6 +362,7 @@ class ReflacxSample:
     
 
     def debug_fixation(self, fixation_idx, stdevs=1):
+        import cv2
         canvas = self.canvas()
         
         #draw chest bounding box
@@ -0,0 +1,185 @@
+# drawing of fixations and anomaly ellipses over x-rays.
+# A Renderer converts each x-ray to an RGB canvas once, per size, and keeps a
+# few of them, so drawing many overlays of the same image only copies it.
+# Colormaps are looked up in a color table computed once per colormap, with
+# the same colors matplotlib's cmap(ratio) gives.
+# Overlays can be drawn at reduced resolution, coordinates and radii being
+# scaled to it.
+# cv2 and matplotlib are imported on first use, so only processes that draw
+# pay for them.
+#
+# usage: python rendering.py <reflacx_dir> <mimic_dir> <full_meta.json> <out_dir> --size 1024 1024 --workers 8
+# renders every sample's overlays to image files
+
+import argparse
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from batch_loader import init_worker_metadata, worker_metadata
+from instrumentation import instrumented, record_bytes, record_cache
+
+_LUTS = {}
+
+
+def get_cmap(name):
+    import matplotlib
+    try:
+        return matplotlib.colormaps[name]
+    except AttributeError:
+        # matplotlib < 3.5, cm.get_cmap was removed in 3.9
+        from matplotlib import cm
+        return cm.get_cmap(name)
+
+
+def colormap_lut(name):
+    """returns the (N, 3) uint8 table of a matplotlib colormap of N colors"""
+    if name not in _LUTS:
+        cmap = get_cmap(name)
+        _LUTS[name] = (cmap(np.arange(cmap.N))[:, :3] * 255).astype(np.uint8)
+    return _LUTS[name]
+
+
+def lut_colors(lut, ratios):
+    """colors of :param ratios: in [0, 1], as cmap(ratio) would give them"""
+    idx = (np.asarray(ratios, dtype=float) * len(lut)).astype(int)
+    return lut[np.clip(idx, 0, len(lut) - 1)]
+
+
+def to_canvas(img):
+    """converts a gray x-ray to an 8 bits RGB canvas"""
+    import cv2
+    canvas = np.asarray(img) >> 4
+    canvas = np.minimum(canvas, 255).astype(np.uint8)
+    return cv2.cvtColor(canvas, cv2.COLOR_GRAY2RGB)
+
+
+def draw_circles(canvas, xs, ys, colors, radius):
+    import cv2
+    for x, y, color in zip(xs, ys, colors.tolist()):
+        cv2.circle(canvas, (int(x), int(y)), radius, tuple(color), -1)
+    return canvas
+
+
+class Renderer:
+    """Base canvases of the last :param max_canvases: images drawn over,
+    by (key, size)"""
+    def __init__(self, max_canvases=8):
+        self.max_canvases = max_canvases
+        self.canvases = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    @instrumented('renderer.canvas')
+    def canvas(self, key, load, size=None):
+        """returns a writable copy of the base canvas of :param key:,
+        calling :param load: to get its gray image the first time"""
+        cache_key = (key, None if size is None else tuple(size))
+        with self.lock:
+            canvas = self.canvases.get(cache_key)
+            if canvas is not None:
+                self.canvases.move_to_end(cache_key)
+        record_cache('renderer.canvas', canvas is not None)
+        if canvas is None:
+            canvas = to_canvas(load())
+            canvas.setflags(write=False)
+            with self.lock:
+                self.canvases[cache_key] = canvas
+                while len(self.canvases) > self.max_canvases:
+                    self.canvases.popitem(last=False)
+        record_bytes('renderer.canvas_copy', canvas.nbytes)
+        return np.copy(canvas)
+
+
+def scale_of(size, size_x, size_y):
+    """(sx, sy, radius scale) from full resolution to :param size:"""
+    if size is None:
+        return 1, 1, 1
+    sx = size[0] / size_x
+    sy = size[1] / size_y
+    return sx, sy, (sx + sy) / 2
+
+
+def scaled_radius(radius, scale):
+    return max(1, int(round(radius * scale)))
+
+
+def render_sample(sample, out_dir, kinds=('fixations', 'fixations_by_sentence', 'anomaly_ellipses'),
+                  size=None, ext='.jpg'):
+    """writes a sample's overlays to :param out_dir:, as
+    {reflacx_id}_fixations, {reflacx_id}_sentence_{i} and
+    {reflacx_id}_ellipse_{i}.
+    returns the paths written"""
+    import cv2
+    images = {}
+    if 'fixations' in kinds and len(sample.get_fixations()) > 0:
+        images['fixations'] = sample.draw_fixations(size=size)
+    if 'fixations_by_sentence' in kinds:
+        for i, canvas in enumerate(sample.draw_fixations_by_sentence(size=size).values()):
+            images['sentence_{:02d}'.format(i)] = canvas
+    if 'anomaly_ellipses' in kinds and sample.get_anomaly_ellipses() is not None:
+        for i, canvas in enumerate(sample.draw_anomaly_ellipses(size=size).values()):
+            images['ellipse_{:02d}'.format(i)] = canvas
+
+    paths = []
+    for name, canvas in images.items():
+        path = os.path.join(out_dir, '{}_{}{}'.format(sample.reflacx_id, name, ext))
+        cv2.imwrite(path, cv2.cvtColor(canvas, cv2.COLOR_RGB2BGR))
+        paths.append(path)
+    return paths
+
+
+def _render_in_worker(i, out_dir, kinds, size, ext):
+    return render_sample(worker_metadata()[i], out_dir, kinds, size, ext)
+
+
+def render_batch(metadata, indices, out_dir, kinds=('fixations', 'fixations_by_sentence', 'anomaly_ellipses'),
+                 size=None, ext='.jpg', workers=None, log_every=100):
+    """renders the samples of :param indices: over a process pool, each
+    worker opening its own Metadata, see batch_loader.py.
+    returns the paths written"""
+    from concurrent.futures import ProcessPoolExecutor
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=init_worker_metadata,
+                             initargs=(metadata.init_kwargs,)) as pool:
+        futures = [pool.submit(_render_in_worker, i, out_dir, kinds, size, ext) for i in indices]
+        for count, future in enumerate(futures, 1):
+            paths += future.result()
+            if count % log_every == 0 or count == len(futures):
+                print("{}/{} samples rendered".format(count, len(futures)))
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='renders fixations and anomaly ellipses of REFLACX samples')
+    parser.add_argument('reflacx_dir')
+    parser.add_argument('mimic_dir')
+    parser.add_argument('full_meta_path')
+    parser.add_argument('out_dir')
+    parser.add_argument('--backend', default='json')
+    parser.add_argument('--pixel-cache-dir', default=None)
+    parser.add_argument('--tables-dir', default=None)
+    parser.add_argument('--size', type=int, nargs=2, default=None, metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--format', default='jpg', choices=['jpg', 'png'])
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+
+    from metadata import Metadata
+    metadata = Metadata(args.reflacx_dir,
+                        args.mimic_dir,
+                        args.full_meta_path,
+                        backend=args.backend,
+                        pixel_cache_dir=args.pixel_cache_dir,
+                        tables_dir=args.tables_dir)
+    render_batch(metadata,
+                 range(len(metadata)),
+                 args.out_dir,
+                 size=args.size,
+                 ext='.' + args.format,
+                 workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+# an image cache shared by every process of a node, see SharedImgs.
+# Kept apart from dicom_imgs.py so processes that don't share images don't
+# import multiprocessing's shared memory and managers.
+
+from collections import OrderedDict
+from multiprocessing import shared_memory, resource_tracker
+from multiprocessing.managers import BaseManager
+import sys
+import threading
+import numpy as np
+from psutil import virtual_memory
+from dicom_imgs import DicomImgs
+from instrumentation import record_cache
+
+
+def open_shared_memory(name=None, size=0):
+    """creates, or attaches to, a shared memory segment that isn't tracked by
+    this process' resource tracker, since segments outlive the worker that
+    created them and are unlinked by SharedImgs' coordinator instead"""
+    create = name is None
+    try:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    except TypeError:
+        # python < 3.13 always tracks
+        shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def unlink_shared_memory(shm):
+    shm.close()
+    if not hasattr(shm, '_track'):
+        # python < 3.13 unregisters on unlink, balance the unregister above
+        resource_tracker.register(shm._name, 'shared_memory')
+    shm.unlink()
+
+
+class SharedImgsIndex:
+    """Runs inside SharedImgs' manager process. Maps dicom_ids to the shared
+    memory segments holding their pixels, in least recently used order, and
+    unlinks segments when over the global budget"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+
+    def lookup(self, dicom_id):
+        """returns (segment name, shape, dtype) or None"""
+        with self.lock:
+            entry = self.entries.get(dicom_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(dicom_id)
+            self.hits += 1
+            return entry[:3]
+
+
+    def insert(self, dicom_id, name, shape, dtype, nbytes):
+        """returns False if the image is already there or doesn't fit the
+        budget, in which case the caller keeps ownership of its segment"""
+        with self.lock:
+            if dicom_id in self.entries or nbytes > self.max_bytes:
+                return False
+            self.entries[dicom_id] = (name, shape, dtype, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted[3]
+                self.evictions += 1
+                self.unlink(evicted[0])
+            return True
+
+
+    def names(self):
+        with self.lock:
+            return [entry[0] for entry in self.entries.values()]
+
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'bytes': self.nbytes,
+                    'max_bytes': self.max_bytes,
+                    'imgs': len(self.entries)}
+
+
+    def clear(self):
+        with self.lock:
+            for name, _, _, _ in self.entries.values():
+                self.unlink(name)
+            self.entries.clear()
+            self.nbytes = 0
+
+
+    @staticmethod
+    def unlink(name):
+        try:
+            shm = open_shared_memory(name)
+        except FileNotFoundError:
+            return
+        unlink_shared_memory(shm)
+
+
+class SharedImgsManager(BaseManager):
+    pass
+
+SharedImgsManager.register('SharedImgsIndex', SharedImgsIndex)
+
+
+class SharedImgs:
+    """Coordinator of an image cache shared by every process of a node.
+    Create it once, in the main process, before starting workers, and pass it
+    to Metadata(shared_imgs=...) or SharedDicomImgs. Images are decoded once,
+    kept in multiprocessing.shared_memory and evicted under a single budget.
+    call shutdown() when done, it unlinks every segment"""
+    def __init__(self, max_ram_percent=30):
+        assert 0 < max_ram_percent <= 100
+        self.manager = SharedImgsManager()
+        self.manager.start()
+        self.index = self.manager.SharedImgsIndex(
+            int(virtual_memory().free * max_ram_percent / 100))
+
+
+    def stats(self):
+        return self.index.stats()
+
+
+    def __getstate__(self):
+        # worker processes only need the index proxy, the manager stays
+        # with the process that started it
+        return {'manager': None, 'index': self.index}
+
+
+    def shutdown(self):
+        self.index.clear()
+        self.manager.shutdown()
+
+
+class SharedDicomImgs(DicomImgs):
+    """DicomImgs backed by a SharedImgs coordinator instead of a per process
+    dict. :param index: is SharedImgs.index, a proxy that can be used from
+    any process.
+    At most :param max_attached: segments stay mapped in this process, those
+    the coordinator evicted being dropped first. Images are views of one
+    array per mapping, which isn't closed while any of them is alive, so
+    it's never unmapped under them"""
+    def __init__(self, index, cache_dir=None, max_attached=64):
+        super().__init__(cache_dir=cache_dir)
+        self.index = index
+        self.max_attached = max_attached
+        self.attached = OrderedDict()
+        self.arrays = {}
+
+
+    def check_id(self, dicom_id):
+        return self.index.lookup(dicom_id) is not None
+
+
+    def stats(self):
+        result = self.index.stats()
+        result['local_hits'] = self.hits
+        result['local_misses'] = self.misses
+        return result
+
+
+    def attach(self, name, shape, dtype, shm=None):
+        """returns the read only array of a segment, mapping it if needed,
+        or adopting :param shm: if this process created it"""
+        with self.lock:
+            if name in self.attached:
+                self.attached.move_to_end(name)
+            else:
+                if shm is None:
+                    shm = open_shared_memory(name)
+                img = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+                img.setflags(write=False)
+                self.attached[name] = shm
+                self.arrays[name] = img
+                del img
+            self.trim(keep=name)
+            return self.arrays[name]
+
+
+    def trim(self, keep=None):
+        """keeps at most max_attached mappings, besides :param keep:,
+        dropping those of evicted segments first, then the least recently
+        used. Call with the lock"""
+        if len(self.attached) <= self.max_attached:
+            return
+        self.release_evicted(keep)
+        for name in [name for name in self.attached if name != keep]:
+            if len(self.attached) <= self.max_attached:
+                break
+            self.release(name)
+
+
+    def release_evicted(self, keep=None):
+        """drops this process' mappings of segments the coordinator evicted.
+        Segments still referenced by arrays are released later"""
+        alive = set(self.index.names())
+        for name in [name for name in self.attached if name not in alive and name != keep]:
+            self.release(name)
+
+
+    def release(self, name):
+        """unmaps a segment, unless views of its array are alive. numpy
+        doesn't hold the segment's buffer, closing it under them would
+        crash, so they're counted as references to the array"""
+        if sys.getrefcount(self.arrays[name]) > 2:
+            return False
+        del self.arrays[name]
+        self.attached.pop(name).close()
+        return True
+
+
+    def get_dicom_img(self, dicom_id, imgpath=None, copy=False):
+        entry = self.index.lookup(dicom_id)
+        img = None
+        if entry is not None:
+            try:
+                img = self.attach(*entry)
+                self.hits += 1
+            except FileNotFoundError:
+                # evicted between lookup and attach
+                img = None
+        record_cache('shared_imgs', img is not None)
+        
+        if img is None:
+            assert imgpath is not None
+            self.misses += 1
+            decoded = self.decode(dicom_id, imgpath)
+            if decoded is None:
+                return None
+            shm = open_shared_memory(size=max(decoded.nbytes, 1))
+            np.ndarray(decoded.shape, dtype=decoded.dtype, buffer=shm.buf)[...] = decoded
+            if self.index.insert(dicom_id,
+                                 shm.name,
+                                 decoded.shape,
+                                 decoded.dtype.str,
+                                 decoded.nbytes):
+                img = self.attach(shm.name, decoded.shape, decoded.dtype.str, shm)
+            else:
+                # already inserted by another process, or too big to share
+                unlink_shared_memory(shm)
+                img = decoded
+
+        return np.copy(img) if copy else img.view()
@@ -0,0 +1,296 @@
+# synthetic REFLACX and MIMIC-CXR data, with the layout Metadata expects.
+# Writes <root>/reflacx/main_data/metadata_phase_*.csv, one folder per trial
+# with fixations.csv, timestamps_transcription.csv, transcription.txt,
+# chest_bounding_box.csv and anomaly_location_ellipses.csv, the
+# <root>/reflacx/heatmaps_phase_* folders generate_heatmaps.py makes from
+# them, and small uncompressed DICOMs in <root>/mimic.
+# Everything is drawn from a seed, each image from its own, so the same
+# arguments give the same files whatever the number of workers. Readers
+# of an image look at its anomalies, so heatmaps and metrics aren't noise.
+#
+# usage: python synthetic_data.py <root> --images 100 --readers 3 --phases 1 2 3 --size 1024 1024 --workers 8
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+import generate_heatmaps
+
+LABELS = ['Atelectasis', 'Consolidation', 'Enlarged cardiac silhouette',
+          'Pleural abnormality', 'Pulmonary edema', 'Support devices']
+SPLITS = ['train', 'validate', 'test']
+SENTENCES = ['the lungs are clear', 'there is no pleural effusion',
+             'heart size is normal', 'support devices are in place',
+             'there is a small left pleural effusion', 'there is bibasilar atelectasis',
+             'the cardiac silhouette is enlarged', 'there is mild pulmonary edema',
+             'there is a right lower lobe consolidation', 'no pneumothorax is seen']
+SECONDARY_CAPTURE = '1.2.840.10008.5.1.4.1.1.7'
+
+
+def random_dicom_id(rng):
+    return '-'.join('{:08x}'.format(v) for v in rng.integers(0, 2**32, size=5))
+
+
+def chest_pixels(rng, size_x, size_y):
+    """a 12 bits gray image, bright mediastinum and darker lungs, with noise"""
+    xs = np.linspace(-1, 1, size_x, dtype=np.float32)[None, :]
+    ys = np.linspace(-1, 1, size_y, dtype=np.float32)[:, None]
+    lungs = np.exp(-((np.abs(xs) - 0.45) ** 2 / 0.08 + ys ** 2 / 0.5))
+    mediastinum = np.exp(-(xs ** 2 / 0.02))
+    img = 2500 + 1200 * mediastinum - 1500 * lungs
+    img += rng.normal(0, 60, size=(size_y, size_x)).astype(np.float32)
+    return np.clip(img, 0, 4095).astype(np.uint16)
+
+
+def write_dicom(path, pixels):
+    """writes :param pixels:, 2D uint16, as an uncompressed DICOM"""
+    meta = FileMetaDataset()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    meta.MediaStorageSOPClassUID = SECONDARY_CAPTURE
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = SECONDARY_CAPTURE
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = 'CR'
+    ds.Rows, ds.Columns = pixels.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+    ds.PixelData = pixels.astype(np.uint16).tobytes()
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    pydicom.dcmwrite(tmp_path, ds, write_like_original=False)
+    os.replace(tmp_path, path)
+
+
+def chest_box(rng, size_x, size_y):
+    return {'xmin': int(size_x * rng.uniform(0.05, 0.15)),
+            'ymin': int(size_y * rng.uniform(0.05, 0.15)),
+            'xmax': int(size_x * rng.uniform(0.85, 0.95)),
+            'ymax': int(size_y * rng.uniform(0.85, 0.95))}
+
+
+def anomaly_ellipses(rng, box, max_ellipses=3):
+    """ellipses inside the chest :param box:, each with one to two labels"""
+    ellipses = []
+    width = box['xmax'] - box['xmin']
+    height = box['ymax'] - box['ymin']
+    for _ in range(rng.integers(0, max_ellipses + 1)):
+        w = width * rng.uniform(0.1, 0.4)
+        h = height * rng.uniform(0.1, 0.4)
+        x = box['xmin'] + rng.uniform(0, width - w)
+        y = box['ymin'] + rng.uniform(0, height - h)
+        labels = set(rng.choice(LABELS, size=rng.integers(1, 3), replace=False))
+        ellipses.append({'xmin': round(x, 1), 'ymin': round(y, 1),
+                         'xmax': round(x + w, 1), 'ymax': round(y + h, 1),
+                         'certainty': int(rng.integers(1, 6)),
+                         **{label: label in labels for label in LABELS}})
+    return ellipses
+
+
+def fixations(rng, size_x, size_y, box, ellipses, n):
+    """:param n: fixations, about half of them on the anomalies, the rest
+    over the chest, with REFLACX's columns"""
+    targets = [(e['xmin'], e['ymin'], e['xmax'], e['ymax']) for e in ellipses]
+    targets = targets + [(box['xmin'], box['ymin'], box['xmax'], box['ymax'])] * max(len(targets), 1)
+    chosen = rng.integers(0, len(targets), size=n)
+    bounds = np.array(targets, dtype=float)[chosen]
+    x = rng.uniform(bounds[:, 0], bounds[:, 2])
+    y = rng.uniform(bounds[:, 1], bounds[:, 3])
+    durations = rng.gamma(2.0, 0.12, size=n) + 0.05
+    saccades = rng.uniform(0.02, 0.08, size=n)
+    starts = 1.0 + np.concatenate([[0], np.cumsum(durations + saccades)[:-1]])
+    # pixels per degree of a full image on REFLACX's screen, and zooms, that
+    # show only part of the image, for some of the fixations
+    ppd = size_x / rng.uniform(25, 35)
+    zoomed = rng.random(n) < 0.1
+    shown = np.tile([0.0, 0.0, float(size_x), float(size_y)], (n, 1))
+    shown[zoomed] = [size_x * 0.25, size_y * 0.25, size_x * 0.75, size_y * 0.75]
+    x[zoomed] = np.clip(x[zoomed], shown[zoomed, 0], shown[zoomed, 2] - 1)
+    y[zoomed] = np.clip(y[zoomed], shown[zoomed, 1], shown[zoomed, 3] - 1)
+    scale = np.where(zoomed, 2.0, 1.0)
+    return pd.DataFrame({'timestamp_start_fixation': np.round(starts, 3),
+                         'timestamp_end_fixation': np.round(starts + durations, 3),
+                         'x_position': np.round(x, 1),
+                         'y_position': np.round(y, 1),
+                         'pupil_area_normalized': np.round(rng.uniform(0.02, 0.05, size=n), 4),
+                         'angular_resolution_x_pixels_per_degree': np.round(ppd / scale, 3),
+                         'angular_resolution_y_pixels_per_degree': np.round(ppd / scale, 3),
+                         'window_level': 2048,
+                         'window_width': 4096,
+                         'xmin_shown_from_image': shown[:, 0],
+                         'ymin_shown_from_image': shown[:, 1],
+                         'xmax_shown_from_image': shown[:, 2],
+                         'ymax_shown_from_image': shown[:, 3]})
+
+
+def transcription(rng, start, stop, n_sentences):
+    """(words DataFrame, text) of a report dictated from :param start: to
+    :param stop: seconds"""
+    sentences = rng.choice(SENTENCES, size=n_sentences, replace=False)
+    words = []
+    for sentence in sentences:
+        words += sentence.split() + ['.']
+    times = np.sort(rng.uniform(start, stop, size=2 * len(words)))
+    timestamps = pd.DataFrame({'word': words,
+                               'timestamp_start_word': np.round(times[0::2], 3),
+                               'timestamp_end_word': np.round(times[1::2], 3)})
+    text = ' '.join('{}.'.format(sentence.capitalize()) for sentence in sentences)
+    return timestamps, text
+
+
+def write_trial(trial_dir, rng, size_x, size_y, box, ellipses, n_fixations):
+    os.makedirs(trial_dir, exist_ok=True)
+    fixations_df = fixations(rng, size_x, size_y, box, ellipses, n_fixations)
+    fixations_df.to_csv(os.path.join(trial_dir, 'fixations.csv'), index=False)
+    timestamps, text = transcription(rng,
+                                     fixations_df['timestamp_start_fixation'].iloc[0],
+                                     fixations_df['timestamp_end_fixation'].iloc[-1] + 2,
+                                     int(rng.integers(2, 6)))
+    timestamps.to_csv(os.path.join(trial_dir, 'timestamps_transcription.csv'), index=False)
+    with open(os.path.join(trial_dir, 'transcription.txt'), 'w') as f:
+        f.write(text)
+    pd.DataFrame([box]).to_csv(os.path.join(trial_dir, 'chest_bounding_box.csv'), index=False)
+    pd.DataFrame(ellipses, columns=['xmin', 'ymin', 'xmax', 'ymax', 'certainty'] + LABELS).to_csv(
+        os.path.join(trial_dir, 'anomaly_location_ellipses.csv'), index=False)
+
+
+def write_image(job):
+    """writes an image's DICOM and the trials of its readers.
+    returns their metadata csv rows"""
+    rng = np.random.default_rng(job['seed'])
+    size_x, size_y = job['size_x'], job['size_y']
+    write_dicom(os.path.join(job['mimic_dir'], job['dicom_id'] + '.dcm'),
+                chest_pixels(rng, size_x, size_y))
+    box = chest_box(rng, size_x, size_y)
+    ellipses = anomaly_ellipses(rng, box)
+    rows = []
+    for phase, reflacx_id, discarded in job['trials']:
+        # readers agree on the chest, more or less on the anomalies
+        reader_box = {key: int(value + rng.integers(-10, 11)) for key, value in box.items()}
+        reader_ellipses = [e for e in ellipses if rng.random() < 0.8]
+        write_trial(os.path.join(job['main_data_dir'], reflacx_id),
+                    rng, size_x, size_y, reader_box, reader_ellipses,
+                    int(rng.integers(*job['fixations_range'])))
+        rows.append({'id': reflacx_id,
+                     'split': job['split'],
+                     'eye_tracking_data_discarded': discarded,
+                     'image': job['image'],
+                     'dicom_id': job['dicom_id'],
+                     'subject_id': job['subject_id'],
+                     'image_size_x': size_x,
+                     'image_size_y': size_y,
+                     **{label: any(e[label] for e in reader_ellipses) for label in LABELS},
+                     'phase': phase})
+    return rows
+
+
+def image_jobs(reflacx_dir, mimic_dir, n_images, readers, phases, size, size_jitter,
+               fixations_range, discarded_fraction, seed, main_data_dir='main_data'):
+    """one job per image. Images are spread over :param phases:, the first
+    one's having :param readers: readers, the others' one each, as in REFLACX"""
+    rng = np.random.default_rng(seed)
+    phases = list(phases)
+    jobs = []
+    counter = 0
+    for i in range(n_images):
+        phase = phases[i * len(phases) // n_images]
+        n_readers = readers if phase == phases[0] else 1
+        trials = []
+        for reader in range(n_readers):
+            counter += 1
+            trials.append((phase,
+                           'P{}{:02d}R{:06d}'.format(phase, reader + 1, counter),
+                           bool(rng.random() < discarded_fraction)))
+        dicom_id = random_dicom_id(rng)
+        subject_id = 10000000 + i
+        jitter = 1 + rng.uniform(-size_jitter, size_jitter, size=2)
+        jobs.append({'seed': (seed, i),
+                     'reflacx_dir': reflacx_dir,
+                     'mimic_dir': mimic_dir,
+                     'main_data_dir': os.path.join(reflacx_dir, main_data_dir),
+                     'dicom_id': dicom_id,
+                     'subject_id': subject_id,
+                     'image': 'physionet.org/files/mimic-cxr/2.0.0/files/p{0}/p{1}/s{2}/{3}.dcm'.format(
+                         str(subject_id)[:2], subject_id, 50000000 + i, dicom_id),
+                     'split': SPLITS[int(rng.choice(3, p=[0.7, 0.1, 0.2]))],
+                     'size_x': int(round(size[0] * jitter[0])),
+                     'size_y': int(round(size[1] * jitter[1])),
+                     'fixations_range': fixations_range,
+                     'trials': trials})
+    return jobs
+
+
+def make_dataset(root, n_images=100, readers=3, phases=(1, 2, 3), size=(1024, 1024),
+                 size_jitter=0.1, fixations_range=(80, 200), discarded_fraction=0.05,
+                 heatmaps=True, seed=0, workers=None):
+    """writes a synthetic dataset to :param root:.
+    :param size: (width, height) images are about, :param size_jitter:
+    their relative variation
+    :param fixations_range: [low, high) number of fixations of a trial
+    returns (reflacx_dir, mimic_dir), to be given to Metadata"""
+    reflacx_dir = os.path.join(root, 'reflacx')
+    mimic_dir = os.path.join(root, 'mimic')
+    main_data_dir = os.path.join(reflacx_dir, 'main_data')
+    os.makedirs(main_data_dir, exist_ok=True)
+    os.makedirs(mimic_dir, exist_ok=True)
+
+    jobs = image_jobs(reflacx_dir, mimic_dir, n_images, readers, phases, size, size_jitter,
+                      tuple(fixations_range), discarded_fraction, seed)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        rows = [row for image_rows in pool.map(write_image, jobs, chunksize=4) for row in image_rows]
+    print("{} images, {} trials written".format(len(jobs), len(rows)))
+
+    rows = pd.DataFrame(rows)
+    for phase, phase_rows in rows.groupby('phase'):
+        phase_rows.drop(columns='phase').to_csv(
+            os.path.join(main_data_dir, 'metadata_phase_{}.csv'.format(phase)), index=False)
+    if heatmaps:
+        generate_heatmaps.main([reflacx_dir,
+                                '--phase', *[str(phase) for phase in sorted(set(rows['phase']))],
+                                '--workers', str(workers or os.cpu_count())])
+    return reflacx_dir, mimic_dir
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='writes a synthetic REFLACX and MIMIC-CXR dataset')
+    parser.add_argument('root')
+    parser.add_argument('--images', type=int, default=100)
+    parser.add_argument('--readers', type=int, default=3,
+                        help="readers of each image of the first phase")
+    parser.add_argument('--phases', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('--size', type=int, nargs=2, default=[1024, 1024], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--size-jitter', type=float, default=0.1)
+    parser.add_argument('--fixations', type=int, nargs=2, default=[80, 200], metavar=('LOW', 'HIGH'))
+    parser.add_argument('--discarded', type=float, default=0.05,
+                        help='fraction of trials with eye_tracking_data_discarded')
+    parser.add_argument('--no-heatmaps', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+
+    reflacx_dir, mimic_dir = make_dataset(args.root,
+                                          n_images=args.images,
+                                          readers=args.readers,
+                                          phases=args.phases,
+                                          size=tuple(args.size),
+                                          size_jitter=args.size_jitter,
+                                          fixations_range=tuple(args.fixations),
+                                          discarded_fraction=args.discarded,
+                                          heatmaps=not args.no_heatmaps,
+                                          seed=args.seed,
+                                          workers=args.workers)
+    print("reflacx_dir: {}\nmimic_dir: {}".format(reflacx_dir, mimic_dir))
+
+
+if __name__ == '__main__':
+    main()
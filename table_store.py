@@ -0,0 +1,113 @@
+# columnar storage for the per sample csvs of REFLACX.
+# Each table (fixations, timestamps_transcription, chest_bounding_box and
+# anomaly_location_ellipses) of each phase is a single structured array,
+# {table}_phase_{phase}.npy, holding the rows of every sample one after the
+# other, and a {table}_phase_{phase}.json of reflacx_id: [start, stop].
+# Arrays are memory-mapped, so a sample's rows are a read only record array
+# slice, without parsing any csv.
+#
+# usage: python table_store.py <full_meta.json> <out_dir> [--backend sqlite]
+
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from tools import frame2records, save_atomic, dump_json_atomic
+from metadata_store import make_store
+
+TABLES = ['fixations',
+          'timestamps_transcription',
+          'chest_bounding_box',
+          'anomaly_location_ellipses']
+
+
+class TableStore:
+    def __init__(self, path):
+        self.path = path
+        self.arrays = {}
+        self.offsets = {}
+
+
+    def table_path(self, table, phase):
+        return os.path.join(self.path, '{}_phase_{}'.format(table, phase))
+
+
+    def load(self, table, phase):
+        key = (table, phase)
+        if key not in self.offsets:
+            base = self.table_path(table, phase)
+            try:
+                with open(base + '.json') as f:
+                    self.offsets[key] = json.load(f)
+                self.arrays[key] = np.load(base + '.npy', mmap_mode='r')
+            except FileNotFoundError:
+                self.offsets[key] = {}
+                self.arrays[key] = None
+        return self.arrays[key], self.offsets[key]
+
+
+    def get(self, table, phase, reflacx_id):
+        """returns the sample's rows as a read only record array, None if the
+        store doesn't have them"""
+        array, offsets = self.load(table, phase)
+        if reflacx_id not in offsets:
+            return None
+        start, stop = offsets[reflacx_id]
+        return array[start:stop].view(np.recarray)
+
+
+def build_table(csv_paths):
+    """concatenates the csvs of :param csv_paths:, a dict of
+    reflacx_id: path, into one record array.
+    returns (records, offsets)"""
+    import pandas as pd
+    ids = list(csv_paths.keys())
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        frames = list(pool.map(pd.read_csv, [csv_paths[id] for id in ids]))
+
+    offsets = {}
+    start = 0
+    for id, frame in zip(ids, frames):
+        offsets[id] = [start, start + len(frame)]
+        start += len(frame)
+    # header only csvs have object columns, which would make those of the
+    # whole table object too, they add no rows
+    filled = [frame for frame in frames if len(frame) > 0]
+    records = frame2records(pd.concat(filled if len(filled) > 0 else frames, ignore_index=True))
+    return np.asarray(records), offsets
+
+
+def build_table_store(full_meta_path, out_dir, backend='json', tables=TABLES):
+    """writes the TableStore of every sample in a metadata store"""
+    store = make_store(full_meta_path, backend)
+    store.load()
+    os.makedirs(out_dir, exist_ok=True)
+    table_store = TableStore(out_dir)
+
+    for table in tables:
+        by_phase = {}
+        for _, rid, data in store.items():
+            if table in data:
+                by_phase.setdefault(data['phase'], {})[rid] = data[table]
+        for phase, csv_paths in by_phase.items():
+            print("building {} of phase {} from {} csvs".format(table, phase, len(csv_paths)))
+            records, offsets = build_table(csv_paths)
+            base = table_store.table_path(table, phase)
+            save_atomic(base + '.npy', records)
+            dump_json_atomic(base + '.json', offsets)
+    return table_store
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='packs REFLACX per sample csvs into memory-mappable tables')
+    parser.add_argument('full_meta_path')
+    parser.add_argument('out_dir')
+    parser.add_argument('--backend', default='json')
+    args = parser.parse_args(argv)
+    build_table_store(args.full_meta_path, args.out_dir, args.backend)
+    print("done")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import numpy as np
+from alignment import align_batch, align_fixations, parse_timed_sentences
+
+
+def legacy_timed_sentences(transcription, tokens, fixations):
+    """the loop ReflacxSample.get_timed_sentences used before alignment.py,
+    kept as the reference alignment.py must agree with"""
+    sentences = [sentence.strip(' \n')
+                 for sentence in transcription.split('.')
+                 if sentence != '']
+
+    start_t = 0
+    end_t = 0
+
+    timed_sentences = []
+
+    new_sentence = False
+    for i, token in enumerate(tokens):
+        if i == 0 or new_sentence:
+            start_t = token['timestamp_start_word']
+            end_t = token['timestamp_end_word']
+            new_sentence = False
+
+        if token['word'] == '.':
+            timed_sentences.append({'start_t': start_t,
+                                    'end_t': end_t,
+                                    'sentence': sentences.pop(0)})
+            new_sentence = True
+
+        end_t = token['timestamp_end_word']
+
+    sentence_i = 0
+    sentence = timed_sentences[sentence_i]
+
+    pre_transcript = []
+    post_transcript = []
+
+    for fixation in fixations:
+        x = fixation['x_position']
+        y = fixation['y_position']
+
+        if x < 0 or y < 0:
+            continue
+
+        if (sentence_i == 0
+            and fixation['timestamp_start_fixation'] < sentence['start_t']):
+            pre_transcript.append((fixation['timestamp_start_fixation'], fixation))
+        else:
+            while fixation['timestamp_end_fixation'] > sentence['end_t']:
+                if sentence_i >= len(timed_sentences) - 1:
+                    post_transcript.append((fixation['timestamp_end_fixation'], fixation))
+                    break
+                else:
+                    sentence_i += 1
+                    sentence = timed_sentences[sentence_i]
+            if 'fixations' not in sentence:
+                sentence['fixations'] = []
+            sentence['fixations'].append(fixation)
+
+    if len(pre_transcript) > 0:
+        timed_sentences.insert(0, {'start_t': pre_transcript[0][1]['timestamp_start_fixation'],
+                                   'end_t': pre_transcript[-1][1]['timestamp_end_fixation'],
+                                   'sentence': '_pre_transcript',
+                                   'fixations': [f[1] for f in pre_transcript]})
+
+    if len(post_transcript) > 0:
+        timed_sentences.append({'start_t': post_transcript[0][1]['timestamp_start_fixation'],
+                                'end_t': post_transcript[-1][1]['timestamp_end_fixation'],
+                                'sentence': '_post_transcript',
+                                'fixations': [f[1] for f in post_transcript]})
+    return timed_sentences
+
+
+def token(word, start, end):
+    return {'word': word, 'timestamp_start_word': start, 'timestamp_end_word': end}
+
+
+def fixation(start, end, x=100.0, y=100.0):
+    return {'timestamp_start_fixation': start,
+            'timestamp_end_fixation': end,
+            'x_position': x,
+            'y_position': y}
+
+
+# 'no. . effusion.', the second sentence being only its period
+TRANSCRIPTION = 'no. . effusion.'
+TOKENS = [token('no', 1.0, 1.5),
+          token('.', 1.5, 1.6),
+          token('.', 2.0, 2.1),
+          token('effusion', 2.5, 3.0),
+          token('.', 3.0, 3.2)]
+
+
+def random_sample(rng):
+    sentences = []
+    tokens = []
+    t = float(rng.uniform(0, 2))
+    for i in range(rng.integers(1, 6)):
+        # sentences after the first can be only a period
+        n_words = rng.integers(1 if i == 0 else 0, 4)
+        for _ in range(n_words):
+            tokens.append(token('w', t, t + 0.5))
+            t += float(rng.choice([0.5, 0.75]))
+        sentences.append(' '.join(['w'] * n_words) + '.')
+        tokens.append(token('.', t, t + 0.25))
+        t += float(rng.choice([0.25, 0.5]))
+    transcription = ' '.join(sentences)
+
+    ends = np.array([tok['timestamp_end_word'] for tok in tokens])
+    fixations = []
+    for _ in range(rng.integers(0, 30)):
+        start = float(rng.uniform(-1, t + 2))
+        # a third of the fixations end exactly when a word or sentence does
+        end = float(rng.choice(ends)) if rng.random() < 1 / 3 else start + float(rng.uniform(0.05, 1))
+        start = min(start, end)
+        x, y = (float(v) for v in rng.uniform(-50, 500, 2))
+        fixations.append(fixation(start, end, x, y))
+    if rng.random() < 0.5:
+        fixations.sort(key=lambda f: f['timestamp_start_fixation'])
+    return transcription, tokens, fixations
+
+
+def test_parse_matches_legacy_sentences():
+    expected = legacy_timed_sentences(TRANSCRIPTION, TOKENS, [])
+    assert parse_timed_sentences(TRANSCRIPTION, TOKENS) == expected
+    assert [s['sentence'] for s in expected] == ['no', '', 'effusion']
+
+
+def test_ties_unsorted_and_negative_fixations():
+    fixations = [fixation(0.5, 1.2),                # pre transcript
+                 fixation(1.0, 1.5),                # ends with the first sentence
+                 fixation(0.2, 0.4, x=-1.0),        # negative, ignored
+                 fixation(1.6, 2.1),                # ends with the empty sentence
+                 fixation(0.8, 0.9),                # earlier, but after moving on
+                 fixation(2.5, 3.0, y=-3.0),
+                 fixation(2.9, 3.0),
+                 fixation(3.1, 4.0)]                # post transcript
+    expected = legacy_timed_sentences(TRANSCRIPTION, TOKENS, fixations)
+    result = align_fixations(parse_timed_sentences(TRANSCRIPTION, TOKENS), fixations)
+    assert result == expected
+    assert [s['sentence'] for s in result] == ['_pre_transcript', 'no', '', 'effusion', '_post_transcript']
+
+
+def test_random_samples_match_legacy():
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        transcription, tokens, fixations = random_sample(rng)
+        expected = legacy_timed_sentences(transcription, tokens, fixations)
+        assert align_fixations(parse_timed_sentences(transcription, tokens), fixations) == expected
+
+
+def test_batch_matches_single_samples():
+    rng = np.random.default_rng(1)
+    samples = [random_sample(rng) for _ in range(50)]
+    batch = [(parse_timed_sentences(transcription, tokens), fixations)
+             for transcription, tokens, fixations in samples]
+    # samples without sentences or without fixations in the batch
+    batch.insert(3, ([], [fixation(1.0, 2.0)]))
+    batch.insert(7, (parse_timed_sentences(TRANSCRIPTION, TOKENS), []))
+    expected = [align_fixations(sentences, fixations) for sentences, fixations in batch]
+    assert align_batch(batch) == expected
+    assert expected[3] == []
+    assert expected[7] == legacy_timed_sentences(TRANSCRIPTION, TOKENS, [])
+    for (transcription, tokens, fixations), result in zip(samples, expected[:3] + expected[4:7] + expected[8:]):
+        assert result == legacy_timed_sentences(transcription, tokens, fixations)
+
+
+def test_record_arrays_match_lists():
+    rng = np.random.default_rng(2)
+    for _ in range(50):
+        transcription, tokens, fixations = random_sample(rng)
+        if len(fixations) == 0:
+            continue
+        records = np.rec.fromrecords([tuple(f.values()) for f in fixations], names=list(fixations[0]))
+        sentences = parse_timed_sentences(transcription, tokens)
+        expected = align_fixations(sentences, fixations)
+        result = align_fixations(sentences, records)
+        assert len(result) == len(expected)
+        for r, e in zip(result, expected):
+            assert {k: v for k, v in r.items() if k != 'fixations'} == \
+                   {k: v for k, v in e.items() if k != 'fixations'}
+            assert [dict(zip(records.dtype.names, row.tolist())) for row in r.get('fixations', [])] == \
+                   e.get('fixations', [])
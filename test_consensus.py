@@ -0,0 +1,77 @@
+import glob
+import os
+import shutil
+import numpy as np
+from heatmap_store import load_heatmap
+from metadata import Metadata
+
+
+def open_metadata(reflacx_dir, mimic_dir, tmp_path):
+    return Metadata(reflacx_dir, mimic_dir, str(tmp_path / 'full_meta.json'))
+
+
+def shared_dicom_id(metadata):
+    return next(did for did in metadata.list_dicom_ids() if len(metadata.list_reflacx_ids(did)) == 2)
+
+
+def expected_consensus(samples):
+    # the uniform mean of the readers' gaze probability maps, scaled to [0, 1]
+    result = np.mean([load_heatmap(sample.data['heatmaps']) / np.sum(load_heatmap(sample.data['heatmaps']))
+                      for sample in samples], axis=0)
+    return result / result.max()
+
+
+def test_consensus_of_two_readers(synthetic_dataset, tmp_path):
+    metadata = open_metadata(*synthetic_dataset, tmp_path)
+    dicom_id = shared_dicom_id(metadata)
+    samples = [metadata.get_sample(dicom_id, rid) for rid in metadata.list_reflacx_ids(dicom_id)]
+    expected = expected_consensus(samples)
+
+    result = metadata.get_consensus_heatmap(dicom_id)
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-5)
+    assert result.max() == 1
+
+    crops = np.array([sample.chest_crop() for sample in samples])
+    xmin, ymin = crops[:, :2].min(axis=0)
+    xmax, ymax = crops[:, 2:].max(axis=0)
+    chest = metadata.get_consensus_heatmap(dicom_id, chest_only=True)
+    assert chest.shape == (ymax - ymin, xmax - xmin)
+    np.testing.assert_allclose(chest, expected[ymin:ymax, xmin:xmax] / expected[ymin:ymax, xmin:xmax].sum(),
+                               rtol=1e-4, atol=1e-9)
+
+
+def test_chest_only_consensus_without_boxes(synthetic_dataset, tmp_path):
+    reflacx_dir, mimic_dir = (shutil.copytree(path, str(tmp_path / os.path.basename(path)))
+                              for path in synthetic_dataset)
+    metadata = open_metadata(reflacx_dir, mimic_dir, tmp_path)
+    dicom_id = shared_dicom_id(metadata)
+    reflacx_ids = metadata.list_reflacx_ids(dicom_id)
+
+    # one reader without a box, the consensus is cropped to the other's
+    os.remove(glob.glob(os.path.join(reflacx_dir, 'main_data', reflacx_ids[0], 'chest_bounding_box*'))[0])
+    metadata = Metadata(reflacx_dir, mimic_dir, str(tmp_path / 'full_meta_one_box.json'))
+    box = metadata.get_sample(dicom_id, reflacx_ids[1]).chest_crop()
+    chest = metadata.get_consensus_heatmap(dicom_id, chest_only=True, size=(32, 24))
+    assert chest.shape == (24, 32)
+    assert abs(chest.sum() - 1) < 1e-4
+    assert metadata.get_consensus_heatmap(dicom_id, chest_only=True).shape == (box[3] - box[1], box[2] - box[0])
+
+    # no reader with a box
+    os.remove(glob.glob(os.path.join(reflacx_dir, 'main_data', reflacx_ids[1], 'chest_bounding_box*'))[0])
+    metadata = Metadata(reflacx_dir, mimic_dir, str(tmp_path / 'full_meta_no_box.json'))
+    assert metadata.get_consensus_heatmap(dicom_id, chest_only=True) is None
+    assert metadata.get_consensus_heatmap(dicom_id).max() == 1
+
+
+def test_all_zero_consensus(synthetic_dataset, tmp_path):
+    reflacx_dir, mimic_dir = (shutil.copytree(path, str(tmp_path / os.path.basename(path)))
+                              for path in synthetic_dataset)
+    metadata = open_metadata(reflacx_dir, mimic_dir, tmp_path)
+    dicom_id = shared_dicom_id(metadata)
+    for rid in metadata.list_reflacx_ids(dicom_id):
+        path = metadata.get_sample(dicom_id, rid).data['heatmaps']
+        np.save(path, np.zeros_like(load_heatmap(path)))
+    result = metadata.get_consensus_heatmap(dicom_id, size=(32, 24))
+    assert result.shape == (24, 32) and not result.any()
+    chest = metadata.get_consensus_heatmap(dicom_id, chest_only=True)
+    assert not np.isnan(chest).any() and not chest.any()
@@ -0,0 +1,120 @@
+import numpy as np
+from fixation_index import FixationIndex, build_fixation_index
+from metadata import Metadata
+
+
+def brute_force(samples, dicom_id=None, reflacx_id=None, box=None, ellipse=None, t0=None, t1=None):
+    """{(reflacx_id, row)} of the fixations matching select's conditions,
+    checked one by one"""
+    found = set()
+    for sample in samples:
+        if dicom_id is not None and sample.dicom_id != dicom_id:
+            continue
+        if reflacx_id is not None and sample.reflacx_id != reflacx_id:
+            continue
+        for row, fixation in enumerate(sample.get_fixations()):
+            x = np.float32(fixation['x_position'])
+            y = np.float32(fixation['y_position'])
+            t = fixation['timestamp_start_fixation']
+            if box is not None and not (box[0] <= x <= box[2] and box[1] <= y <= box[3]):
+                continue
+            if ellipse is not None:
+                if not (ellipse[0] <= x <= ellipse[2] and ellipse[1] <= y <= ellipse[3]):
+                    continue
+                rx = max((ellipse[2] - ellipse[0]) / 2, 0.5)
+                ry = max((ellipse[3] - ellipse[1]) / 2, 0.5)
+                cx = (ellipse[0] + ellipse[2]) / 2
+                cy = (ellipse[1] + ellipse[3]) / 2
+                if ((x - cx) / rx) ** 2 + ((y - cy) / ry) ** 2 > 1:
+                    continue
+            if (t0 is not None and t < t0) or (t1 is not None and t >= t1):
+                continue
+            found.add((sample.reflacx_id, row))
+    return found
+
+
+def found(index, records):
+    return set(zip(index.reflacx_ids_of(records), records['row'].tolist()))
+
+
+def random_box(rng, sample):
+    xs = np.float32(sample.get_fixations()['x_position'])
+    # edges on fixations, to check they're inclusive
+    xmin, xmax = np.sort(rng.choice(xs, 2))
+    ymin, ymax = np.sort(rng.uniform(0, sample.data['image_size_y'], 2))
+    return float(xmin), float(ymin), float(xmax), float(ymax)
+
+
+def open_samples(synthetic_dataset, tmp_path, **kwargs):
+    metadata = Metadata(*synthetic_dataset, str(tmp_path / 'full_meta.json'), **kwargs)
+    return metadata, [metadata.get_sample(did, rid) for did, rid, _ in metadata.store.items()]
+
+
+def test_queries_match_brute_force(synthetic_dataset, tmp_path):
+    _, samples = open_samples(synthetic_dataset, tmp_path)
+    index = build_fixation_index(samples, workers=2)
+    assert len(index) == sum(len(sample.get_fixations()) for sample in samples)
+
+    rng = np.random.default_rng(0)
+    for sample in samples:
+        ends = sample.get_fixations()['timestamp_start_fixation']
+        for _ in range(20):
+            box = random_box(rng, sample) if rng.random() < 0.7 else None
+            ellipse = random_box(rng, sample) if rng.random() < 0.5 else None
+            t0, t1 = (float(t) if rng.random() < 0.5 else None for t in np.sort(rng.choice(ends, 2)))
+            for conditions in [{'dicom_id': sample.dicom_id},
+                               {'reflacx_id': sample.reflacx_id},
+                               {'dicom_id': sample.dicom_id, 'reflacx_id': sample.reflacx_id},
+                               {}]:
+                conditions = dict(conditions, box=box, ellipse=ellipse, t0=t0, t1=t1)
+                expected = brute_force(samples, **conditions)
+                assert found(index, index.query(**conditions)) == expected
+                readers = {rid for rid, _ in expected}
+                if 'reflacx_id' not in conditions:
+                    assert set(index.readers(**conditions)) == readers
+
+    # a sample's fixations in their order
+    for sample in samples:
+        fixations = index.sample_fixations(sample.reflacx_id)
+        np.testing.assert_array_equal(fixations['x_position'],
+                                      np.float32(sample.get_fixations()['x_position']))
+        assert set(index.dicom_ids_of(fixations)) <= {sample.dicom_id}
+
+
+def test_mismatched_and_unknown_ids(synthetic_dataset, tmp_path):
+    _, samples = open_samples(synthetic_dataset, tmp_path)
+    index = build_fixation_index(samples, workers=2)
+    other = next(s for s in samples if s.dicom_id != samples[0].dicom_id)
+    assert len(index.query(dicom_id=other.dicom_id, reflacx_id=samples[0].reflacx_id)) == 0
+    assert len(index.query(dicom_id='unknown')) == 0
+    assert len(index.query(reflacx_id='unknown')) == 0
+    assert len(index.query(reflacx_id='unknown', box=(0, 0, 1e6, 1e6))) == 0
+    assert index.readers(dicom_id='unknown') == []
+    # an empty box, and an empty time window
+    assert len(index.query(dicom_id=other.dicom_id, box=(10, 10, 5, 5))) == 0
+    assert len(index.query(t0=5.0, t1=5.0)) == 0
+
+
+def test_save_load_round_trip(synthetic_dataset, tmp_path):
+    index_dir = str(tmp_path / 'fixation_index')
+    metadata, samples = open_samples(synthetic_dataset, tmp_path, fixation_index_dir=index_dir)
+    index = metadata.get_fixation_index()
+    assert FixationIndex.exists(index_dir)
+
+    loaded = FixationIndex.load(index_dir)
+    assert loaded.sources == index.sources is not None
+    for name in index.columns:
+        np.testing.assert_array_equal(loaded.columns[name], index.columns[name])
+        assert loaded.columns[name].dtype == index.columns[name].dtype
+    np.testing.assert_array_equal(loaded.sample_dicoms, index.sample_dicoms)
+    box = (0, 0, 60, 60)
+    for sample in samples:
+        assert (found(loaded, loaded.query(dicom_id=sample.dicom_id, box=box))
+                == found(index, index.query(dicom_id=sample.dicom_id, box=box))
+                == brute_force(samples, dicom_id=sample.dicom_id, box=box))
+
+    # a new Metadata reads it back instead of building it again
+    metadata = Metadata(*synthetic_dataset, str(tmp_path / 'full_meta.json'), fixation_index_dir=index_dir)
+    reread = metadata.get_fixation_index()
+    assert isinstance(reread.columns['x_position'], np.memmap)
+    assert len(reread) == len(index)
@@ -0,0 +1,101 @@
+import argparse
+import glob
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from generate_heatmaps import FixationSplats, create_heatmap, create_heatmap_dense, main, tolerance_arg
+from synthetic_data import make_dataset
+
+SIZE_X, SIZE_Y = 120, 90
+
+
+def fixation(x, y, start, end, shown=(10, 5, 110, 80), resolution=(8.0, 6.5)):
+    return {'x_position': x,
+            'y_position': y,
+            'timestamp_start_fixation': start,
+            'timestamp_end_fixation': end,
+            'xmin_shown_from_image': shown[0],
+            'ymin_shown_from_image': shown[1],
+            'xmax_shown_from_image': shown[2],
+            'ymax_shown_from_image': shown[3],
+            'angular_resolution_x_pixels_per_degree': resolution[0],
+            'angular_resolution_y_pixels_per_degree': resolution[1]}
+
+
+FIXATIONS = [fixation(60.3, 40.7, 0.0, 0.4),
+             fixation(30.0, 20.0, 0.4, 0.55, resolution=(5.0, 5.0)),
+             # at the edges of the shown rect, and past them
+             fixation(10.0, 5.0, 0.6, 0.9),
+             fixation(109.6, 79.4, 1.0, 1.2),
+             fixation(115.0, 40.0, 1.2, 1.3),
+             fixation(50.0, 2.0, 1.3, 1.8),
+             # shown rects that aren't whole pixels, and other rects
+             fixation(70.0, 45.0, 1.8, 2.5, shown=(20.4, 10.6, 100.5, 70.2)),
+             fixation(0.0, 0.0, 2.5, 2.6, shown=(0, 0, SIZE_X, SIZE_Y), resolution=(12.0, 10.0))]
+
+
+def test_untruncated_matches_dense():
+    dense = create_heatmap_dense(FIXATIONS, SIZE_X, SIZE_Y)
+    result = create_heatmap(FIXATIONS, SIZE_X, SIZE_Y, tolerance=None)
+    assert result.shape == dense.shape == (SIZE_Y, SIZE_X)
+    np.testing.assert_allclose(result, dense, rtol=0, atol=1e-5 * dense.max())
+    assert abs(result.sum() - 1) < 1e-5
+
+
+def test_truncated_matches_dense_within_tolerance():
+    dense = create_heatmap_dense(FIXATIONS, SIZE_X, SIZE_Y)
+    for tolerance in [1e-4, 1e-2]:
+        result = create_heatmap(FIXATIONS, SIZE_X, SIZE_Y, tolerance=tolerance)
+        # each gaussian misses at most tolerance times its peak
+        np.testing.assert_allclose(result, dense, rtol=0, atol=2 * tolerance * dense.max())
+
+
+def test_nothing_drawn_outside_shown_rects():
+    result = create_heatmap(FIXATIONS[:6], SIZE_X, SIZE_Y, tolerance=None)
+    assert result[:5].sum() == 0 and result[80:].sum() == 0
+    assert result[:, :10].sum() == 0 and result[:, 110:].sum() == 0
+
+
+def test_splats_match_create_heatmap():
+    for tolerance in [None, 1e-4]:
+        expected = create_heatmap(FIXATIONS, SIZE_X, SIZE_Y, tolerance=tolerance)
+        splats = FixationSplats(FIXATIONS, SIZE_X, SIZE_Y, tolerance=tolerance)
+        np.testing.assert_allclose(splats.heatmap(), expected, rtol=0, atol=1e-5 * expected.max())
+
+
+def test_empty_selections_are_zeros():
+    splats = FixationSplats(FIXATIONS, SIZE_X, SIZE_Y)
+    with np.errstate(all='raise'):
+        for t0, t1 in [(0.41, 0.59), (1.0, 1.0), (2.0, 1.0), (10.0, 20.0)]:
+            result = splats.between(t0, t1)
+            assert result.shape == (SIZE_Y, SIZE_X) and not result.any()
+        assert not splats.between(0.41, 0.59, crop=(20, 10, 60, 40), size=(16, 12)).any()
+        # fixations that are selected, but all outside the crop
+        assert not splats.between(1.0, 1.2, crop=(0, 0, 40, 30)).any()
+        assert not splats.heatmap([]).any()
+        empty = FixationSplats(FIXATIONS[:0], SIZE_X, SIZE_Y)
+        assert empty.heatmap().shape == (SIZE_Y, SIZE_X) and not empty.heatmap().any()
+    nonempty = splats.between(0.0, 0.41)
+    assert abs(nonempty.sum() - 1) < 1e-5
+
+
+def test_tolerance_argument():
+    assert tolerance_arg('none') is None and tolerance_arg('None') is None
+    assert tolerance_arg('1e-4') == 1e-4
+    for value in ['0', '1', '-0.5', 'exact']:
+        with pytest.raises(argparse.ArgumentTypeError):
+            tolerance_arg(value)
+
+
+def test_untruncated_heatmaps_from_the_command_line(tmp_path):
+    reflacx_dir, _ = make_dataset(str(tmp_path), n_images=2, readers=1, phases=(1,), size=(64, 48),
+                                  fixations_range=(5, 10), discarded_fraction=0, heatmaps=False, workers=1)
+    main([reflacx_dir, '--phase', '1', '--workers', '1', '--tolerance', 'none'])
+    paths = sorted(glob.glob(os.path.join(reflacx_dir, 'heatmaps_phase_1', '*.npy')))
+    assert len(paths) == 2
+    for path in paths:
+        info = np.load(path, allow_pickle=True).item()
+        fixations = pd.read_csv(os.path.join(reflacx_dir, 'main_data', info['id'], 'fixations.csv')).to_dict('records')
+        dense = create_heatmap_dense(fixations, *info['np_image'].shape[::-1])
+        np.testing.assert_allclose(info['np_image'], dense, rtol=0, atol=1e-5 * dense.max())
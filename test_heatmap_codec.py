@@ -0,0 +1,124 @@
+import os
+import numpy as np
+import pytest
+from heatmap_codec import QUANTIZATIONS, TILE, decode_into, encode, heatmap_shape, nonzero_rect, write_heatmap
+from heatmap_store import HeatmapStore, load_heatmap, load_heatmap_levels, read_heatmap_into
+
+
+def gaze_heatmap(shape=(90, 100), rect=(5, 37, 19, 71), seed=0):
+    """a [0, 1] heatmap of a few gaussians, zero outside rect, (ymin, ymax,
+    xmin, xmax), which isn't aligned to TILE"""
+    rng = np.random.default_rng(seed)
+    ys, xs = np.mgrid[:shape[0], :shape[1]]
+    heatmap = np.zeros(shape, dtype=np.float64)
+    ymin, ymax, xmin, xmax = rect
+    for _ in range(4):
+        cy, cx = rng.uniform(ymin, ymax), rng.uniform(xmin, xmax)
+        sigma = rng.uniform(3, 8)
+        heatmap += rng.uniform(0.2, 1) * np.exp(-((ys - cy) ** 2 + (xs - cx) ** 2) / (2 * sigma ** 2))
+    outside = np.ones(shape, dtype=bool)
+    outside[ymin:ymax, xmin:xmax] = False
+    heatmap[outside] = 0
+    return (heatmap / heatmap.max()).astype(np.float32)
+
+
+def max_error(dtype, heatmap):
+    """the error each quantization is allowed, per pixel"""
+    if dtype == 'uint8':
+        return heatmap.max() / 255 / 2 * (1 + 1e-5)
+    if dtype == 'uint16':
+        return heatmap.max() / 65535 / 2 * (1 + 1e-5)
+    if dtype == 'float16':
+        # half a unit in the last place, subnormals below 2**-14
+        return np.maximum(np.abs(heatmap) * 2.0 ** -11, 2.0 ** -25)
+    return 0
+
+
+def round_trip(tmp_path, heatmap, out=None, **kwargs):
+    path = str(tmp_path / 'heatmap.hmz')
+    size = write_heatmap(path, heatmap, **kwargs)
+    assert size == os.path.getsize(path)
+    assert heatmap_shape(path) == heatmap.shape
+    return decode_into(path, out)
+
+
+@pytest.mark.parametrize('dtype', QUANTIZATIONS)
+@pytest.mark.parametrize('codec', ['zlib', 'none'])
+def test_round_trip_error_bounds(tmp_path, dtype, codec):
+    heatmap = gaze_heatmap()
+    result = round_trip(tmp_path, heatmap, dtype=dtype, codec=codec)
+    assert result.dtype == np.float32 and result.shape == heatmap.shape
+    assert np.all(np.abs(result - heatmap) <= max_error(dtype, heatmap))
+    # zeros stay exactly zero
+    assert not result[heatmap == 0].any()
+
+
+def test_all_zero_heatmap(tmp_path):
+    heatmap = np.zeros((40, 50), dtype=np.float32)
+    assert nonzero_rect(heatmap) == (0, 0, 0, 0)
+    for dtype in QUANTIZATIONS:
+        out = np.full(heatmap.shape, np.nan, dtype=np.float32)
+        result = round_trip(tmp_path, heatmap, out=out, dtype=dtype)
+        assert result is out and not result.any()
+
+
+def test_rect_not_aligned_to_tiles(tmp_path):
+    rect = (5, 37, 19, 71)
+    heatmap = gaze_heatmap(rect=rect)
+    ymin, ymax, xmin, xmax = nonzero_rect(heatmap)
+    assert (ymin, xmin) == (0, TILE) and (ymax, xmax) == (48, 80)
+    # the rect is rounded out to tiles, but not past the heatmap
+    edge = gaze_heatmap(shape=(45, 75), rect=(30, 45, 60, 75))
+    assert nonzero_rect(edge) == (16, 45, 48, 75)
+    for heatmap in [heatmap, edge]:
+        # garbage in the output buffer is overwritten, including outside the rect
+        out = np.full(heatmap.shape, 7, dtype=np.float64)
+        result = round_trip(tmp_path, heatmap, out=out, dtype='float32')
+        np.testing.assert_array_equal(result, heatmap)
+
+
+@pytest.mark.parametrize('dtype', ['uint8', 'uint16', 'float32'])
+def test_blocks_smaller_than_the_rect(tmp_path, dtype):
+    heatmap = gaze_heatmap(shape=(90, 100), rect=(2, 88, 3, 97))
+    # rows of zeros inside the rect, making blocks that aren't stored
+    heatmap[40:60] = 0
+    data = encode(heatmap, dtype=dtype, rows_per_block=3)
+    expected = round_trip(tmp_path, heatmap, dtype=dtype)
+    for rows_per_block in [1, 3, 7]:
+        path = str(tmp_path / 'blocks.hmz')
+        write_heatmap(path, heatmap, dtype=dtype, rows_per_block=rows_per_block)
+        np.testing.assert_array_equal(decode_into(path), expected)
+    assert len(data) < len(encode(heatmap, dtype=dtype, rows_per_block=3, codec='none'))
+
+
+def test_not_a_heatmap_file(tmp_path):
+    path = tmp_path / 'heatmap.hmz'
+    path.write_bytes(b'\x93NUMPY' + bytes(100))
+    with pytest.raises(ValueError):
+        decode_into(str(path))
+
+
+@pytest.mark.parametrize('quantization', ['uint16', 'float32'])
+def test_store_of_hmz_files(tmp_path, quantization):
+    heatmap = gaze_heatmap(shape=(160, 140), rect=(10, 150, 7, 133))
+    store = HeatmapStore(str(tmp_path / 'store'), min_side=32, quantization=quantization)
+    store.put('P102R000001', heatmap, dicom_id='dicom')
+    store.flush()
+
+    store = HeatmapStore(str(tmp_path / 'store'))
+    path = store.array_path('P102R000001')
+    assert path.endswith('.hmz') and store.index['P102R000001']['quantization'] == quantization
+    bound = max_error(quantization, heatmap)
+
+    loaded = load_heatmap(path)
+    assert not loaded.flags.writeable
+    assert np.all(np.abs(loaded - heatmap) <= bound)
+    np.testing.assert_array_equal(store.get('P102R000001'), loaded)
+
+    out = np.empty(heatmap.shape, dtype=np.float32)
+    assert read_heatmap_into(path, out) is out
+    np.testing.assert_array_equal(out, loaded)
+
+    levels = load_heatmap_levels(path)
+    assert [level.shape for level in levels] == [(160, 140), (80, 70), (40, 35)]
+    np.testing.assert_array_equal(levels[0], loaded)
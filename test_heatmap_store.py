@@ -0,0 +1,56 @@
+import json
+import os
+import shutil
+import numpy as np
+import pytest
+from heatmap_store import HeatmapStore, convert_heatmaps
+
+
+def copy_reflacx_dir(synthetic_dataset, tmp_path):
+    return shutil.copytree(synthetic_dataset[0], str(tmp_path / 'reflacx'))
+
+
+def count_unpickling(monkeypatch):
+    loads = []
+    load = np.load
+    def counting_load(*args, **kwargs):
+        if kwargs.get('allow_pickle'):
+            loads.append(args[0])
+        return load(*args, **kwargs)
+    monkeypatch.setattr(np, 'load', counting_load)
+    return loads
+
+
+def test_resumed_conversion_skips_without_unpickling(synthetic_dataset, tmp_path, monkeypatch):
+    reflacx_dir = copy_reflacx_dir(synthetic_dataset, tmp_path)
+    converted = convert_heatmaps(reflacx_dir)
+    assert len(converted) > 0
+
+    loads = count_unpickling(monkeypatch)
+    assert convert_heatmaps(reflacx_dir) == converted
+    assert loads == []
+
+
+def test_interrupted_conversion_keeps_flushed_heatmaps(synthetic_dataset, tmp_path, monkeypatch):
+    reflacx_dir = copy_reflacx_dir(synthetic_dataset, tmp_path)
+    write = HeatmapStore.write
+    calls = []
+    def failing_write(self, *args, **kwargs):
+        calls.append(args[0])
+        if len(calls) == 4:
+            raise KeyboardInterrupt
+        return write(self, *args, **kwargs)
+    monkeypatch.setattr(HeatmapStore, 'write', failing_write)
+    with pytest.raises(KeyboardInterrupt):
+        convert_heatmaps(reflacx_dir, flush_every=2)
+
+    store_dir = os.path.join(reflacx_dir, 'heatmaps_store_phase_1')
+    with open(os.path.join(store_dir, HeatmapStore.index_name)) as f:
+        assert sorted(json.load(f)) == sorted(calls[:2])
+
+    # the rest is converted on the next run, the flushed ones aren't again
+    monkeypatch.setattr(HeatmapStore, 'write', write)
+    loads = count_unpickling(monkeypatch)
+    converted = convert_heatmaps(reflacx_dir, flush_every=2)
+    assert all(reflacx_id in converted for reflacx_id in calls)
+    assert len(loads) == len(converted) - 2
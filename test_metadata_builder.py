@@ -0,0 +1,76 @@
+import glob
+import json
+import os
+import pandas as pd
+import pytest
+from metadata import Metadata
+from metadata_builder import build_metadata, refresh_metadata
+from synthetic_data import make_dataset
+
+
+def reflacx_ids(metadata):
+    return {rid for samples in metadata.values() for rid in samples}
+
+
+@pytest.fixture
+def discarded_dataset(tmp_path):
+    """(reflacx_dir, mimic_dir, trials, discarded) of a dataset with half
+    of its trials discarded"""
+    reflacx_dir, mimic_dir = make_dataset(str(tmp_path), n_images=6, readers=2, phases=(1, 2),
+                                          size=(64, 64), fixations_range=(5, 10),
+                                          discarded_fraction=0.5, heatmaps=False, workers=2)
+    trials = pd.concat([pd.read_csv(path) for path in glob.glob(reflacx_dir + '/main_data/metadata_phase_*.csv')])
+    # pandas reads the column as bools, not as the strings of the csv
+    assert trials['eye_tracking_data_discarded'].dtype == bool
+    discarded = set(trials['id'][trials['eye_tracking_data_discarded']])
+    assert 0 < len(discarded) < len(trials)
+    return reflacx_dir, mimic_dir, set(trials['id']), discarded
+
+
+def test_discarded_trials_are_excluded(discarded_dataset):
+    reflacx_dir, mimic_dir, trials, discarded = discarded_dataset
+    assert reflacx_ids(build_metadata(reflacx_dir, mimic_dir)) == trials - discarded
+    assert reflacx_ids(build_metadata(reflacx_dir, mimic_dir,
+                                      exclude_invalid_eyetracking=False)) == trials
+
+
+def test_refresh_reads_rows_again_when_settings_change(discarded_dataset):
+    reflacx_dir, mimic_dir, trials, discarded = discarded_dataset
+    kept, sources = build_metadata(reflacx_dir, mimic_dir,
+                                   exclude_invalid_eyetracking=False, return_sources=True)
+    current = {rid: (did, data) for did, samples in kept.items() for rid, data in samples.items()}
+
+    # unchanged csvs, but the discarded trials are no longer wanted
+    upserts, removed, new_sources = refresh_metadata(current, sources, reflacx_dir, mimic_dir)
+    assert len(upserts) == 0 and set(removed) == discarded
+    assert refresh_metadata(current, new_sources, reflacx_dir, mimic_dir,
+                            exclude_invalid_eyetracking=False)[:2] == ({}, {})
+
+    # sources of builds from before settings were recorded
+    old_sources = {key: value for key, value in sources.items() if key != 'settings'}
+    upserts, removed, _ = refresh_metadata(current, old_sources, reflacx_dir, mimic_dir,
+                                           exclude_invalid_eyetracking=False)
+    assert len(upserts) == 0 and len(removed) == 0
+    assert set(refresh_metadata(current, old_sources, reflacx_dir, mimic_dir)[1]) == discarded
+
+
+def test_metadata_built_with_other_settings_is_refreshed(discarded_dataset, tmp_path):
+    reflacx_dir, mimic_dir, trials, discarded = discarded_dataset
+    full_meta_path = str(tmp_path / 'full_meta.json')
+    metadata = Metadata(reflacx_dir, mimic_dir, full_meta_path, exclude_invalid_eyetracking=False)
+    assert {rid for _, rid, _ in metadata.store.items()} == trials
+
+    metadata = Metadata(reflacx_dir, mimic_dir, full_meta_path)
+    assert {rid for _, rid, _ in metadata.store.items()} == trials - discarded
+    assert metadata.has_current_sources()
+
+    # as left by a build from before settings were recorded
+    sources_path = os.path.join(str(tmp_path), 'sources.json')
+    with open(sources_path) as f:
+        sources = json.load(f)
+    del sources['settings']
+    with open(sources_path, 'w') as f:
+        json.dump(sources, f)
+    metadata = Metadata(reflacx_dir, mimic_dir, full_meta_path, exclude_invalid_eyetracking=False)
+    assert {rid for _, rid, _ in metadata.store.items()} == trials
+    assert metadata.has_current_sources()
@@ -0,0 +1,78 @@
+import os
+import subprocess
+import sys
+import numpy as np
+from metrics import ellipse_masks, label_masks, scores
+
+
+def box_mask(shape, box):
+    mask = np.zeros(shape, dtype=bool)
+    xmin, ymin, xmax, ymax = box
+    mask[ymin:ymax, xmin:xmax] = True
+    return mask
+
+
+def test_scores_of_known_inputs():
+    shape = (30, 40)
+    mask = box_mask(shape, (10, 5, 25, 20))
+    full = np.ones(shape, dtype=bool)
+    rng = np.random.default_rng(0)
+    heatmap = rng.random(shape)
+
+    # ncc of a map with itself, auc of a map that is high exactly on the mask
+    ncc, auc, mass_inside = scores(mask.astype(float), mask[None])
+    assert np.isclose(ncc[0], 1) and np.isclose(auc[0], 1) and np.isclose(mass_inside[0], 1)
+    ncc, auc, _ = scores(~mask * 1.0, mask[None])
+    assert np.isclose(ncc[0], -1) and np.isclose(auc[0], 0)
+
+    # a perfect mask, the heatmap's positive values being its pixels
+    inside = np.where(mask, heatmap + 1, heatmap * 0.5)
+    _, auc, mass_inside = scores(inside, mask[None])
+    assert np.isclose(auc[0], 1)
+    assert np.isclose(mass_inside[0], inside[mask].sum() / inside.sum())
+
+    # all of the mass is inside a full mask
+    _, _, mass_inside = scores(heatmap, full[None])
+    assert np.isclose(mass_inside[0], 1)
+
+    # a constant heatmap ranks every pixel the same
+    _, auc, mass_inside = scores(np.ones(shape), mask[None])
+    assert np.isclose(auc[0], 0.5) and np.isclose(mass_inside[0], mask.mean())
+
+
+def test_scores_of_several_masks_at_once():
+    shape = (30, 40)
+    masks = np.stack([box_mask(shape, (10, 5, 25, 20)), box_mask(shape, (0, 0, 5, 30))])
+    heatmap = np.random.default_rng(1).random(shape)
+    together = scores(heatmap, masks)
+    for j in range(len(masks)):
+        alone = scores(heatmap, masks[j:j + 1])
+        for score, expected in zip(together, alone):
+            assert np.isclose(score[j], expected[0])
+
+
+def test_ellipse_masks():
+    masks = ellipse_masks([[10, 10, 30, 20], [0, 0, 0, 0]], 40, 30)
+    assert masks.shape == (2, 30, 40)
+    assert masks[0, 15, 20] and not masks[0, 10, 10] and not masks[0, 15, 31]
+    # a degenerate box is a single pixel
+    assert masks[1].sum() == 1 and masks[1, 0, 0]
+    small = ellipse_masks([[10, 10, 30, 20]], 40, 30, size=(20, 15))
+    assert small.shape == (1, 15, 20) and small[0, 7, 10]
+
+
+def test_label_masks_union_ellipses():
+    ellipses = [{'xmin': 0, 'ymin': 0, 'xmax': 10, 'ymax': 10, 'certainty': 3, 'Nodule': True, 'Mass': False},
+                {'xmin': 20, 'ymin': 20, 'xmax': 30, 'ymax': 30, 'certainty': 5, 'Nodule': True, 'Mass': True}]
+    labels, masks, certainties, counts = label_masks(ellipses, 40, 40)
+    assert labels == ['Nodule', 'Mass']
+    assert certainties == [5, 5] and counts == [2, 1]
+    assert masks[0, 5, 5] and masks[0, 25, 25] and not masks[1, 5, 5] and masks[1, 25, 25]
+    assert label_masks([], 40, 40)[0] == []
+
+
+def test_heavy_dependencies_are_imported_on_use():
+    # in a fresh interpreter, as this one has them imported already
+    check = ('import sys, metrics; '
+             'assert "pandas" not in sys.modules and "scipy.stats" not in sys.modules')
+    subprocess.run([sys.executable, '-c', check], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
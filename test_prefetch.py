@@ -0,0 +1,116 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metadata import Metadata
+from prefetch import FIELDS, PrefetchedSamples, prefetch, submit_prefetch
+
+
+class FakeSample:
+    """records the order its fields are loaded in, each taking a while"""
+    def __init__(self, dicom_id, reflacx_id, log):
+        self.dicom_id = dicom_id
+        self.reflacx_id = reflacx_id
+        self.log = log
+        self.heatmap_levels = None
+
+    def load(self, field):
+        time.sleep(0.001)
+        self.log.append((self.reflacx_id, field))
+        return field
+
+    def get_dicom_img(self):
+        return self.load('img')
+
+    def get_heatmap(self):
+        return self.load('heatmap')
+
+    def get_fixations(self):
+        return self.load('fixations')
+
+    def get_timed_sentences(self):
+        return self.load('timed_sentences')
+
+    def get_chest_bounding_box(self):
+        return self.load('chest_bounding_box')
+
+    def get_anomaly_ellipses(self):
+        return self.load('anomaly_ellipses')
+
+
+def run_with_timeout(function, timeout=60):
+    """returns function(), failing if it doesn't finish in time, as when
+    the pool deadlocks"""
+    result = []
+    thread = threading.Thread(target=lambda: result.append(function()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'prefetching deadlocked'
+    return result[0]
+
+
+def test_dependent_fields_load_after_their_dependencies():
+    log = []
+    # readers of the same images, so their image loads are shared
+    samples = [FakeSample('dicom{}'.format(i // 3), 'R{}'.format(i), log) for i in range(30)]
+    fields = list(FIELDS)
+    for workers in [1, 2, 8]:
+        log.clear()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = submit_prefetch(pool, samples, fields)
+            assert run_with_timeout(lambda: [future.result() for future in futures]) == [True] * len(futures)
+        assert len(futures) == len(samples) * (len(fields) - 1) + 10
+        position = {entry: i for i, entry in enumerate(log)}
+        for sample in samples:
+            assert position[(sample.reflacx_id, 'fixations')] < position[(sample.reflacx_id, 'timed_sentences')]
+            first_reader = 'R{}'.format(int(sample.reflacx_id[1:]) // 3 * 3)
+            assert position[(first_reader, 'img')] < position[(sample.reflacx_id, 'chest_bounding_box')]
+        assert sum(field == 'img' for _, field in log) == 10
+
+
+def test_prefetched_samples_are_bounded():
+    prefetched = PrefetchedSamples(max_samples=3)
+    samples = [FakeSample('dicom', 'R{}'.format(i), []) for i in range(5)]
+    for sample in samples[:3]:
+        prefetched.put(sample)
+    # used samples are kept over older ones
+    assert prefetched.get('R0') is samples[0]
+    for sample in samples[3:]:
+        prefetched.put(sample)
+    assert len(prefetched) == 3
+    assert [rid in prefetched for rid in ['R0', 'R1', 'R2', 'R3', 'R4']] == [True, False, False, True, True]
+    assert prefetched.get('R1') is None
+
+
+def test_metadata_prefetch_past_max_prefetched(synthetic_dataset, tmp_path):
+    metadata = Metadata(*synthetic_dataset, str(tmp_path / 'full_meta.json'), max_prefetched=2)
+    n = len(metadata)
+    assert n > 2
+    fields = list(FIELDS)
+    for concurrency in [1, 4]:
+        metadata.prefetched.clear()
+        counts = run_with_timeout(lambda: metadata.prefetch(range(n), fields, concurrency=concurrency))
+        assert counts['skipped'] == 0 and counts['loaded'] > n * (len(fields) - 1)
+
+        assert len(metadata.prefetched) == 2
+        kept = [metadata.store.reflacx_id(i) for i in range(n - 2, n)]
+        assert all(rid in metadata.prefetched for rid in kept)
+        assert metadata.store.reflacx_id(0) not in metadata.prefetched
+        # kept samples are handed out with their fields loaded, evicted ones are new
+        sample = metadata[n - 1]
+        assert sample is metadata.prefetched.get(kept[-1])
+        assert sample.fixations is not None and sample.timed_sentences is not None
+        assert metadata[0].fixations is None
+
+    counts = run_with_timeout(lambda: asyncio.run(metadata.aprefetch(range(n), fields, concurrency=1)))
+    assert counts['skipped'] == 0 and len(metadata.prefetched) == 2
+
+
+def test_prefetch_skips_missing_fields():
+    class Missing(FakeSample):
+        def get_fixations(self):
+            raise KeyError('fixations')
+    samples = [Missing('dicom', 'R0', []), FakeSample('dicom', 'R1', [])]
+    counts = run_with_timeout(lambda: prefetch(samples, ['img', 'fixations', 'timed_sentences'], concurrency=1))
+    # the missing fixations, and the timed sentences waiting for them
+    assert counts == {'loaded': 3, 'skipped': 2}
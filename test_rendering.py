@@ -0,0 +1,55 @@
+import numpy as np
+from rendering import Renderer, colormap_lut, get_cmap, lut_colors
+
+
+def cmap_colors(name, ratios):
+    """the colors ReflacxSample used to draw with, one cmap call per ratio"""
+    cmap = get_cmap(name)
+    return np.array([tuple(int(255 * comp) for comp in cmap(ratio)[:3]) for ratio in ratios])
+
+
+def test_lut_colors_match_cmap():
+    rng = np.random.default_rng(0)
+    heatmap = rng.random((12, 16)) ** 3
+    normalized = heatmap / heatmap.max()
+    for name in ['jet', 'viridis', 'gray']:
+        lut = colormap_lut(name)
+        n = len(lut)
+        assert lut.shape == (get_cmap(name).N, 3) and lut.dtype == np.uint8
+        # bounds, and ratios on and next to the edges of the table's bins
+        ratios = np.concatenate([normalized.ravel(), [0, 1, 0.5],
+                                 np.arange(n) / n, np.nextafter(np.arange(1, n) / n, 0)])
+        np.testing.assert_array_equal(lut_colors(lut, ratios), cmap_colors(name, ratios))
+        colored = lut_colors(lut, normalized)
+        assert colored.shape == (12, 16, 3)
+        np.testing.assert_array_equal(colored.reshape(-1, 3), cmap_colors(name, normalized.ravel()))
+        assert colormap_lut(name) is lut
+
+
+def test_canvas_cache_is_bounded():
+    renderer = Renderer(max_canvases=2)
+    loads = []
+    def loader(key):
+        def load():
+            loads.append(key)
+            return np.full((6, 8), 16 * (len(loads) + 1), dtype=np.uint16)
+        return load
+
+    first = renderer.canvas('a', loader('a'))
+    assert first.shape == (6, 8, 3) and first.dtype == np.uint8
+    # copies are writable and don't change the cached canvas
+    first[:] = 0
+    assert renderer.canvas('a', loader('a')).any()
+    renderer.canvas('b', loader('b'))
+    renderer.canvas('a', loader('a'))
+    renderer.canvas('c', loader('c'))
+    assert loads == ['a', 'b', 'c']
+    assert len(renderer.canvases) == 2
+    assert set(renderer.canvases) == {('a', None), ('c', None)}
+    assert all(not canvas.flags.writeable for canvas in renderer.canvases.values())
+
+    # b was the least recently used, it's loaded again, and sizes are keys of their own
+    renderer.canvas('b', loader('b'))
+    renderer.canvas('b', loader('b'), size=(4, 3))
+    assert loads == ['a', 'b', 'c', 'b', 'b']
+    assert set(renderer.canvases) == {('b', None), ('b', (4, 3))}
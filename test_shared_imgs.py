@@ -0,0 +1,54 @@
+import numpy as np
+from shared_imgs import SharedDicomImgs, SharedImgsIndex
+from synthetic_data import write_dicom
+
+
+def write_dicoms(tmp_path, n, side=64):
+    rng = np.random.default_rng(0)
+    paths = {}
+    for i in range(n):
+        path = str(tmp_path / '{}.dcm'.format(i))
+        write_dicom(path, rng.integers(0, 4096, (side, side), dtype=np.uint16))
+        paths[str(i)] = path
+    return paths
+
+
+def test_misses_keep_at_most_max_attached(tmp_path):
+    paths = write_dicoms(tmp_path, 12)
+    img_bytes = 64 * 64 * 2
+    index = SharedImgsIndex(max_bytes=3 * img_bytes)
+    imgs_lib = SharedDicomImgs(index, max_attached=2)
+    try:
+        for dicom_id, path in paths.items():
+            assert imgs_lib.get_dicom_img(dicom_id, path).shape == (64, 64)
+        assert index.stats()['evictions'] == 9
+        assert len(imgs_lib.attached) <= 2
+        alive = set(index.names())
+        assert all(name in alive for name in imgs_lib.attached)
+
+        # hits reattach segments that are still shared
+        for dicom_id in list(paths)[-3:]:
+            assert imgs_lib.get_dicom_img(dicom_id, paths[dicom_id]).shape == (64, 64)
+        assert len(imgs_lib.attached) <= 2
+    finally:
+        for name in list(imgs_lib.attached):
+            imgs_lib.release(name)
+        index.clear()
+
+
+def test_referenced_segments_stay_attached(tmp_path):
+    paths = write_dicoms(tmp_path, 4)
+    index = SharedImgsIndex(max_bytes=10 * 64 * 64 * 2)
+    imgs_lib = SharedDicomImgs(index, max_attached=1)
+    try:
+        kept = [imgs_lib.get_dicom_img(dicom_id, path) for dicom_id, path in paths.items()]
+        # mappings in use can't be closed, their arrays stay readable
+        assert len(imgs_lib.attached) == 4
+        assert all(img.shape == (64, 64) for img in kept)
+        del kept
+        imgs_lib.get_dicom_img('0', paths['0'])
+        assert len(imgs_lib.attached) <= 1
+    finally:
+        for name in list(imgs_lib.attached):
+            imgs_lib.release(name)
+        index.clear()
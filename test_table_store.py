@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+from table_store import build_table
+from tools import csv2records
+
+FIXATIONS = pd.DataFrame({'timestamp_start_fixation': [0.5, 1.25, 2.0],
+                          'timestamp_end_fixation': [1.0, 1.75, 2.5],
+                          'x_position': [100.5, 2000.25, -3.0],
+                          'y_position': [50.0, 1500.0, 10.0]})
+
+
+def write_csvs(tmp_path, frames):
+    paths = {}
+    for reflacx_id, frame in frames.items():
+        path = tmp_path / '{}.csv'.format(reflacx_id)
+        frame.to_csv(path, index=False)
+        paths[reflacx_id] = str(path)
+    return paths
+
+
+def test_header_only_csv_keeps_the_phase_types(tmp_path):
+    paths = write_csvs(tmp_path, {'P1': FIXATIONS,
+                                  'P2': FIXATIONS.iloc[:0],
+                                  'P3': FIXATIONS.iloc[1:]})
+    records, offsets = build_table(paths)
+
+    assert offsets == {'P1': [0, 3], 'P2': [3, 3], 'P3': [3, 5]}
+    for name in FIXATIONS.columns:
+        assert records.dtype[name] == np.float64
+    assert (records['timestamp_start_fixation'] >= 1.0).tolist() == [False, True, True, True, True]
+    np.testing.assert_array_equal(records['x_position'][3:], FIXATIONS['x_position'][1:])
+
+
+def test_header_only_csv_alone(tmp_path):
+    paths = write_csvs(tmp_path, {'P1': FIXATIONS.iloc[:0]})
+    records, offsets = build_table(paths)
+
+    assert offsets == {'P1': [0, 0]}
+    assert len(records) == 0
+    for name in FIXATIONS.columns:
+        assert records.dtype[name].kind == 'f'
+    alone = csv2records(paths['P1'])
+    assert alone.dtype['x_position'].kind == 'f'
+    assert len(alone[alone['x_position'] > 0]) == 0
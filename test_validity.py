@@ -0,0 +1,50 @@
+import numpy as np
+import pydicom
+from pydicom.uid import RLELossless
+from synthetic_data import write_dicom
+from validity import check_dicom
+
+
+def write_dicoms(tmp_path):
+    pixels = np.random.default_rng(0).integers(0, 4096, (64, 64), dtype=np.uint16)
+    native = str(tmp_path / 'native.dcm')
+    write_dicom(native, pixels)
+    ds = pydicom.dcmread(native)
+    ds.compress(RLELossless)
+    compressed = str(tmp_path / 'compressed.dcm')
+    ds.save_as(compressed)
+    return native, compressed
+
+
+def truncate(path, n):
+    with open(path, 'rb') as f:
+        data = f.read()
+    truncated = path.replace('.dcm', '_truncated.dcm')
+    with open(truncated, 'wb') as f:
+        f.write(data[:len(data) - n])
+    return truncated
+
+
+def test_complete_dicoms_are_valid(tmp_path):
+    native, compressed = write_dicoms(tmp_path)
+    assert check_dicom(native)
+    assert check_dicom(compressed)
+
+
+def test_truncated_dicoms_are_invalid(tmp_path):
+    for path in write_dicoms(tmp_path):
+        # the sequence delimiter only, a fragment's end, and most pixels
+        for n in [8, 100, 4000]:
+            assert not check_dicom(truncate(path, n))
+
+
+def test_dicoms_without_pixels_are_invalid(tmp_path):
+    native, _ = write_dicoms(tmp_path)
+    ds = pydicom.dcmread(native)
+    del ds.PixelData
+    path = str(tmp_path / 'no_pixels.dcm')
+    ds.save_as(path)
+    assert not check_dicom(path)
+    not_dicom = tmp_path / 'not_dicom.dcm'
+    not_dicom.write_bytes(b'\x00' * 1000)
+    assert not check_dicom(str(not_dicom))
@@ -1,13 +1,82 @@
 import os
+import json
 import numpy as np
-import pandas as pd
 
 def csv2dictlist(csv_file):
     """generate a list of dictionaries from a csv with a header for first line"""
+    import pandas as pd
     csv = pd.read_csv(csv_file)
     return [dict(row[1]) for row in csv.iterrows()]
 
 
+def frame2records(df):
+    """converts a DataFrame to a record array. Text columns become fixed
+    width unicode, so the result has no python objects and can be saved and
+    memory-mapped. Columns of booleans with missing values become False.
+    Columns without any value, as those of a csv with only a header, become
+    float"""
+    import pandas as pd
+    columns = []
+    dtypes = []
+    for name in df.columns:
+        col = df[name]
+        if pd.api.types.is_bool_dtype(col.dtype) or pd.api.types.is_numeric_dtype(col.dtype):
+            values = col.to_numpy()
+        elif len(col.dropna()) == 0:
+            values = col.to_numpy(dtype=float)
+        elif col.dropna().map(lambda v: isinstance(v, (bool, np.bool_))).all():
+            values = col.fillna(False).to_numpy(dtype=bool)
+        else:
+            values = col.fillna('').astype(str).to_numpy(dtype=str)
+            if values.dtype.itemsize == 0:
+                values = values.astype('U1')
+        columns.append(values)
+        dtypes.append((str(name), values.dtype))
+    records = np.empty(len(df), dtype=dtypes)
+    for (name, _), values in zip(dtypes, columns):
+        records[name] = values
+    return records.view(np.recarray)
+
+
+def csv2records(csv_file):
+    """generate a record array from a csv with a header for first line"""
+    import pandas as pd
+    return frame2records(pd.read_csv(csv_file))
+
+
+def records2dictlist(records):
+    """list of dictionaries view of a record array, as csv2dictlist returns"""
+    names = records.dtype.names
+    return [dict(zip(names, row)) for row in records.tolist()]
+
+
+def save_atomic(path, obj):
+    """saves :param obj: with np.save to a temporary file and moves it into
+    place, so an interrupted write never leaves a truncated file behind.
+    returns the size of the written file"""
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, obj, allow_pickle=True)
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def dump_json_atomic(path, obj):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def file_digest(path):
+    """sha1 of a file's contents, None if it doesn't exist"""
+    import hashlib
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
 def normalize(img, value_range=(0, 1), type=float, by_channel=False):
     """returns an image normalized in a given range and type
     if :param by_channel: is True, normalizes each color channel separately
@@ -0,0 +1,171 @@
+# validity checks behind Metadata's valid_img_only and valid_fixations_only.
+# Images are checked from their DICOM header, and the item headers of
+# compressed pixels, without decoding them, and fixations by counting csv
+# rows, over a thread pool.
+# Results are kept in validity.json, next to full_meta.json, with each
+# source file's mtime and size, so later scans only check new or changed
+# samples. It also records the filters the indices were last built with.
+
+import json
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from tools import dump_json_atomic
+
+PIXEL_DATA = (0x7FE0, 0x0010)
+ITEM = (0xFFFE, 0xE000)
+SEQUENCE_DELIMITER = (0xFFFE, 0xE0DD)
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+
+def file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def check_fragments(f, endian, size, frames):
+    """returns whether the encapsulated pixel data :param f: is at, items
+    of fragments, ends with its sequence delimiter within :param size:,
+    with an offset table and at least a fragment per frame"""
+    items = 0
+    position = f.tell()
+    while position + 8 <= size:
+        group, element, length = struct.unpack(endian + 'HHI', f.read(8))
+        position += 8
+        if (group, element) == SEQUENCE_DELIMITER:
+            return items - 1 >= frames
+        if (group, element) != ITEM or position + length > size:
+            return False
+        items += 1
+        position += length
+        f.seek(position)
+    return False
+
+
+def check_dicom(imgpath):
+    """returns whether the DICOM's header describes pixels that are all in
+    the file, reading headers only. Native pixels must fit in the file,
+    encapsulated (compressed) ones must be items that do, up to their
+    sequence delimiter. Whether compressed fragments decode isn't checked"""
+    import pydicom
+    from pydicom.uid import DeflatedExplicitVRLittleEndian
+    try:
+        size = os.path.getsize(imgpath)
+        with open(imgpath, 'rb') as f:
+            ds = pydicom.dcmread(f, stop_before_pixels=True)
+            syntax = getattr(ds, 'file_meta', {}).get('TransferSyntaxUID')
+            if syntax == DeflatedExplicitVRLittleEndian:
+                # positions are in the inflated dataset, not in the file
+                return 'PixelData' in pydicom.dcmread(imgpath)
+            # f is left at the start of the pixel data element
+            endian = '<' if ds.is_little_endian else '>'
+            header = f.read(8)
+            if len(header) < 8 or struct.unpack(endian + 'HH', header[:4]) != PIXEL_DATA:
+                return False
+            if ds.is_implicit_VR:
+                length, = struct.unpack(endian + 'I', header[4:])
+            else:
+                length, = struct.unpack(endian + 'I', f.read(4))
+            frames = int(ds.get('NumberOfFrames', 1) or 1)
+            if length == UNDEFINED_LENGTH:
+                return check_fragments(f, endian, size, frames)
+            expected = (ds.Rows
+                        * ds.Columns
+                        * ds.get('SamplesPerPixel', 1)
+                        * frames
+                        * ds.BitsAllocated // 8)
+            return f.tell() + expected <= size
+    except (OSError, ValueError, KeyError, AttributeError, TypeError, struct.error,
+            pydicom.errors.InvalidDicomError):
+        return False
+
+
+def count_rows(csv_path):
+    """number of data rows of a csv, without parsing it"""
+    with open(csv_path) as f:
+        return max(sum(1 for line in f if line.strip()) - 1, 0)
+
+
+def check_sample(rid, data, check_img, check_fixations, tables, pixel_cache):
+    """returns the validity entry of a sample, {'img', 'img_stamp',
+    'fixations', 'fixations_stamp'} with only the checks asked for"""
+    entry = {}
+    if check_img:
+        imgpath = data['image']
+        entry['img_stamp'] = file_stamp(imgpath)
+        entry['img'] = (entry['img_stamp'] is not None
+                        and ((pixel_cache is not None
+                              and pixel_cache.is_valid(data['dicom_id'], imgpath))
+                             or check_dicom(imgpath)))
+    if check_fixations:
+        entry['fixations_stamp'] = None
+        entry['fixations'] = 0
+        offsets = tables.load('fixations', data['phase'])[1] if tables is not None else {}
+        if rid in offsets:
+            entry['fixations'] = offsets[rid][1] - offsets[rid][0]
+        elif 'fixations' in data:
+            entry['fixations_stamp'] = file_stamp(data['fixations'])
+            if entry['fixations_stamp'] is not None:
+                entry['fixations'] = count_rows(data['fixations'])
+    return entry
+
+
+class ValidityManifest:
+    """validity.json, {'filters': the filters of the last indices built,
+    'samples': {reflacx_id: entry of check_sample}}"""
+    def __init__(self, full_meta_path):
+        self.path = os.path.join(os.path.dirname(full_meta_path), 'validity.json')
+        self.filters = None
+        self.samples = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                manifest = json.load(f)
+            self.filters = manifest['filters']
+            self.samples = manifest['samples']
+
+
+    def is_fresh(self, entry, data, check_img, check_fixations, tables):
+        if entry is None:
+            return False
+        if check_img and ('img' not in entry
+                          or entry['img_stamp'] != file_stamp(data['image'])):
+            return False
+        if check_fixations:
+            if 'fixations' not in entry:
+                return False
+            # counts from a table store don't have a stamp and are cheap to redo
+            if tables is not None or entry['fixations_stamp'] is None:
+                return False
+            if entry['fixations_stamp'] != file_stamp(data['fixations']):
+                return False
+        return True
+
+
+    def check(self, items, check_img=False, check_fixations=False,
+              tables=None, pixel_cache=None, workers=32):
+        """returns {reflacx_id: valid} for :param items:, (dicom_id,
+        reflacx_id, sample data) tuples. Samples with a fresh entry aren't
+        checked again"""
+        def job(item):
+            did, rid, data = item
+            data = dict(data, dicom_id=did)
+            if self.is_fresh(self.samples.get(rid), data, check_img, check_fixations, tables):
+                return rid, self.samples[rid]
+            entry = check_sample(rid, data, check_img, check_fixations, tables, pixel_cache)
+            return rid, dict(self.samples.get(rid, {}), **entry)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = dict(pool.map(job, items))
+        self.samples.update(results)
+
+        return {rid: ((not check_img or entry['img'])
+                      and (not check_fixations or entry['fixations'] > 0))
+                for rid, entry in results.items()}
+
+
+    def save(self, filters):
+        self.filters = filters
+        dump_json_atomic(self.path, {'filters': self.filters, 'samples': self.samples})